@@ -1,18 +1,25 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, Response, request, jsonify, session, stream_with_context, g
 from flask_cors import CORS
-import requests
 import json
 import uuid
-from datetime import datetime
+import time
+import atexit
+import threading
 import traceback
 import logging
-from db_manager import DatabaseManager
+from db_manager import DatabaseManager, estimate_tokens
 from vector_db_manager import VectorDBManager
-from prompts import get_system_prompt
+from prompt_builder import PromptBuilder
+from prompts import get_generation_policy, GENERATION_POLICIES
 from function_handler import FunctionHandler
-from function_schemas import FUNCTION_SCHEMAS
+from model_handler import ModelHandler
+from summarizer import ConversationSummarizer
+from model_transport import get_transport, close_transports
+from embedding import get_embedder
+from memory_queue import MemoryIngestionQueue
+from context_cache import ModelContextCache
+from metrics import registry, span, observe_stages, CONTENT_TYPE
 import os
-import re
 
 # Configure logging
 logging.basicConfig(
@@ -24,22 +31,199 @@ logging.basicConfig(
 )
 logger = logging.getLogger('dnd_gm_assistant')
 
+# Request-level metrics; the stages of each turn are timed with metrics.span
+HTTP_SECONDS = registry.histogram(
+    'dnd_http_request_seconds', 'Time to produce each HTTP response', ('method', 'endpoint', 'status')
+)
+TURN_SECONDS = registry.histogram(
+    'dnd_chat_turn_seconds', 'End-to-end time of a chat turn', ('model_id', 'stream')
+)
+MODEL_SECONDS = registry.histogram(
+    'dnd_model_request_seconds', 'Time spent waiting on a model API', ('provider', 'mode')
+)
+MODEL_FIRST_TOKEN_SECONDS = registry.histogram(
+    'dnd_model_first_token_seconds', 'Time until a streamed model response produced its first token', ('provider',)
+)
+MODEL_FINISHED = registry.counter(
+    'dnd_model_finish_total', 'Model generations by provider and why they ended', ('provider', 'reason')
+)
+PROMPT_CHARS = registry.gauge('dnd_prompt_chars', 'Size of the most recent prompt in characters', ('part',))
+PROMPT_TOKENS = registry.gauge('dnd_prompt_tokens_estimate', 'Estimated tokens in the most recent prompt')
+
 app = Flask(__name__)
 CORS(app, supports_credentials=True)  # Enable CORS with credentials support
 app.config['SECRET_KEY'] = 'your-secret-key-here'  # Change this to a secure random key
 
-# Initialize databases and function handler
-db = DatabaseManager()
-vector_db = VectorDBManager()  # Initialize the vector database
-function_handler = FunctionHandler(db, vector_db)  # Pass both database managers
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if db is None:
+        # Served by something that didn't call create_app() (e.g. gunicorn without our config)
+        init_services()
+
+@app.after_request
+def record_request_time(response):
+    # Streamed responses are timed until their first byte is ready, not until they finish
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_SECONDS.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+            status=response.status_code
+        )
+    return response
+
+# Conversation window sent to the model: the most recent messages that fit the budget
+HISTORY_MESSAGE_LIMIT = int(os.environ.get("HISTORY_MESSAGE_LIMIT", "20"))
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "2000"))
+
+# Chroma server for multi-process deployments; without it each process opens chroma_db itself
+CHROMA_HOST = os.environ.get("CHROMA_HOST", "")
+CHROMA_PORT = int(os.environ.get("CHROMA_PORT", "8000"))
 
 # Ollama API endpoint - adjust if Ollama is running on a different host
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
+OLLAMA_API_URL = os.environ.get("OLLAMA_API_URL", "http://localhost:11434/api/generate")
+OLLAMA_BASE_URL = OLLAMA_API_URL.rsplit("/api/", 1)[0]
+DEFAULT_OLLAMA_MODEL = os.environ.get("DEFAULT_OLLAMA_MODEL", "mistral-nemo:latest")
+# Keep the model (and its prompt cache) loaded between turns
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", "0"))  # 0 keeps the model's own setting
+# Continue each session's returned context instead of re-sending the whole prompt.
+# The reused context plus the new turn and the reply all have to fit in num_ctx,
+# or Ollama silently drops the start of the context, so OLLAMA_CONTEXT_MAX_TOKENS
+# defaults (0) to the model's context window - OLLAMA_NUM_CTX, or the model's own
+# num_ctx - minus the largest reply budget in GENERATION_POLICIES
+OLLAMA_CONTEXT_CACHE = os.environ.get("OLLAMA_CONTEXT_CACHE", "1") == "1"
+OLLAMA_CONTEXT_MAX_TOKENS = int(os.environ.get("OLLAMA_CONTEXT_MAX_TOKENS", "0"))
 
 # Gemini API endpoint and key 
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_API_URL = f"{GEMINI_API_BASE}/models/gemini-2.0-flash:generateContent"
+GEMINI_STREAM_URL = f"{GEMINI_API_BASE}/models/gemini-2.0-flash:streamGenerateContent"
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")  # Set this as an environment variable
 
+# Providers whose model API gets the functions declared as tools instead of
+# documented in the prompt; /chat/stream keeps the text protocol. Ollama is
+# opt-in (NATIVE_TOOL_CALLING=gemini,ollama): its tool calls go through
+# /api/chat, which can't continue the cached context, and its templates render
+# the declarations larger than the prompt documentation they replace.
+# "1" enables every provider, "0" none.
+NATIVE_TOOL_CALLING = os.environ.get("NATIVE_TOOL_CALLING", "gemini").strip().lower()
+if NATIVE_TOOL_CALLING == "1":
+    NATIVE_TOOL_PROVIDERS = {"gemini", "ollama"}
+else:
+    NATIVE_TOOL_PROVIDERS = {name.strip() for name in NATIVE_TOOL_CALLING.split(",")} - {"", "0"}
+TOOL_CALL_ROUNDS = int(os.environ.get("TOOL_CALL_ROUNDS", "3"))  # Model requests per turn at most
+
+# Older turns are folded into a rolling summary in the background; the most
+# recent SUMMARY_KEEP_RECENT messages always stay raw
+SUMMARY_KEEP_RECENT = int(os.environ.get("SUMMARY_KEEP_RECENT", str(HISTORY_MESSAGE_LIMIT)))
+SUMMARY_BATCH_SIZE = int(os.environ.get("SUMMARY_BATCH_SIZE", "20"))
+
+# Databases, function handler and background workers. They are created per
+# process by create_app() - in each gunicorn worker after the fork, see
+# gunicorn.conf.py - never at import time, so no SQLite or Chroma handle and
+# no worker thread is ever shared between processes.
+db = None
+vector_db = None
+memory_queue = None
+function_handler = None
+prompt_builder = None
+summarizer = None
+context_cache = None
+model_handler = None
+_services_lock = threading.Lock()
+
+def preload():
+    """
+    Load what forked workers can safely share: the embedding model. Called
+    once in the gunicorn master (preload_app) so every worker starts with
+    the weights already in memory, copy-on-write, instead of loading its own.
+    """
+    get_embedder()
+
+def init_services():
+    """Create this process's database managers, function handler and background workers."""
+    global db, vector_db, memory_queue, function_handler, prompt_builder, summarizer, context_cache, model_handler
+    with _services_lock:
+        if db is not None:
+            return
+        
+        database = DatabaseManager(
+            history_limit=HISTORY_MESSAGE_LIMIT,
+            history_max_tokens=HISTORY_TOKEN_BUDGET
+        )
+        vector_db = VectorDBManager(  # Initialize the vector database
+            partitioning=os.environ.get("VECTOR_PARTITIONING", "global"),
+            shards=int(os.environ.get("VECTOR_SHARDS", "16")),
+            max_open_partitions=int(os.environ.get("VECTOR_MAX_OPEN_PARTITIONS", "64")),
+            memory_limit_bytes=int(os.environ.get("VECTOR_MEMORY_LIMIT_BYTES", "0")) or None,
+            sequence_store=database,  # Orders conversation memories for recency-aware retrieval
+            recency_weight=float(os.environ.get("VECTOR_RECENCY_WEIGHT", "0.3")),
+            recency_half_life=float(os.environ.get("VECTOR_RECENCY_HALF_LIFE", "20")),
+            host=CHROMA_HOST or None,
+            port=CHROMA_PORT
+        )
+        memory_queue = MemoryIngestionQueue(database, vector_db)  # Embeds vector memories in the background
+        function_handler = FunctionHandler(database, vector_db, memory_queue)  # Pass both database managers
+        prompt_builder = PromptBuilder()
+        model_handler = ModelHandler(
+            OLLAMA_BASE_URL,
+            DEFAULT_OLLAMA_MODEL,
+            gemini_api_url=GEMINI_API_URL,
+            gemini_api_key=GEMINI_API_KEY,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+            num_ctx=OLLAMA_NUM_CTX,
+            max_rounds=TOOL_CALL_ROUNDS
+        )
+        if OLLAMA_CONTEXT_CACHE:
+            max_tokens = OLLAMA_CONTEXT_MAX_TOKENS
+            if not max_tokens:
+                # Leave room in the window for the longest reply any mode asks for
+                reply_budget = max(policy["max_tokens"] for policy in GENERATION_POLICIES.values())
+                max_tokens = max(0, model_handler.context_window() - reply_budget)
+            context_cache = ModelContextCache(max_tokens=max_tokens)
+            logger.info(f"Reusing Ollama contexts of up to {max_tokens} tokens")
+        summarizer = ConversationSummarizer(
+            database,
+            vector_db,
+            summarize_fn=lambda prompt: call_ollama_api(prompt),  # Defined further down
+            keep_recent=SUMMARY_KEEP_RECENT,
+            min_batch=SUMMARY_BATCH_SIZE,
+            memory_queue=memory_queue
+        )
+        # Set last: requests treat a non-None db as "everything is ready"
+        db = database
+        logger.info(f"Initialized services in process {os.getpid()}")
+
+def shutdown_services(timeout=10.0):
+    """
+    Graceful shutdown: finish queued summaries, drain the memory queue (up
+    to timeout seconds), then close model connections and database handles.
+    Safe to call more than once.
+    """
+    global db, vector_db, memory_queue, function_handler, prompt_builder, summarizer, context_cache, model_handler
+    with _services_lock:
+        if db is None:
+            return
+        
+        summarizer.shutdown(wait=True)
+        memory_queue.shutdown(timeout)
+        close_transports()
+        vector_db.close()
+        db.close()
+        
+        db = vector_db = memory_queue = function_handler = prompt_builder = summarizer = context_cache = None
+        model_handler = None
+        logger.info(f"Shut down services in process {os.getpid()}")
+
+def create_app():
+    """Initialize this process's services and return the Flask app."""
+    init_services()
+    atexit.register(shutdown_services)
+    return app
+
 @app.route('/session', methods=['POST'])
 def create_session():
     """Create a new game session."""
@@ -66,20 +250,29 @@ def get_models():
             'capabilities': ['text']
         }
     
+    for model in models.values():
+        provider = model_provider(model['id'])
+        if provider in NATIVE_TOOL_PROVIDERS and model_handler.supports_tools(provider):
+            model['capabilities'].append('tools')
+    
     logger.info(f"Available models: {', '.join(models.keys())}")
     return jsonify(models)
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    try:
-        data = request.json
-        user_message = data.get('message', '')
-        session_id = data.get('session_id', '')
-        model_id = data.get('model_id', 'local')  # Default to local model
-        
-        logger.info(f"Chat request - Session: {session_id}, Model: {model_id}")
-        logger.info(f"User message: {user_message[:50]}{'...' if len(user_message) > 50 else ''}")
-        
+def prepare_turn(data, stream=False):
+    """
+    Everything that happens before the model is called: resolve the session,
+    load its state, record the player's message and build the prompt.
+    """
+    started = time.perf_counter()
+    timings = {}
+    user_message = data.get('message', '')
+    session_id = data.get('session_id', '')
+    model_id = data.get('model_id', 'local')  # Default to local model
+    
+    logger.info(f"Chat request - Session: {session_id}, Model: {model_id}")
+    logger.info(f"User message: {user_message[:50]}{'...' if len(user_message) > 50 else ''}")
+    
+    with span("db", timings):
         # If no session_id provided, create a new one
         if not session_id:
             session_id = db.create_session()
@@ -88,116 +281,351 @@ def chat():
             # Update last active timestamp
             db.update_session_activity(session_id)
         
-        # Get current game state
-        game_state = db.get_game_state(session_id) or "character_creation"
-        logger.info(f"Current game state: {game_state}")
-        
-        # Get message history from database
-        message_history = db.get_messages(session_id)
-        
-        # Save user message to database AND vector database
-        db.save_message(session_id, "user", user_message)
-        vector_db.add_conversation_memory(session_id, "user", user_message)
-        
-        # Get character information if available
-        character = db.get_character(session_id)
-        
-        # Get world information if available
-        locations = db.get_locations(session_id)
-        npcs = db.get_npcs(session_id)
-        quests = db.get_quests(session_id)
-        combat_state = db.get_combat_state(session_id)
+        # Load game state, history, character and world in one round trip
+        snapshot = db.load_session_snapshot(session_id)
+    game_state = snapshot.game_state or "character_creation"
+    logger.info(f"Current game state: {game_state}")
+    
+    with span("vector", timings):
+        # Make sure memories queued by earlier turns are searchable before querying
+        memory_queue.flush(session_id)
         
         # Get relevant context from vector database
         vector_context = vector_db.generate_narrative_context(session_id, user_message)
-        logger.info("Generated vector context for prompt")
-        
-        # Format message history and add system prompt with vector context
-        system_prompt = get_system_prompt(game_state, vector_context)
-        formatted_messages = format_messages(
-            message_history, 
-            user_message, 
-            system_prompt, 
-            character, 
-            locations, 
-            npcs, 
-            quests, 
-            combat_state
+    logger.info("Generated vector context for prompt")
+    
+    # Save user message to database AND vector database (embedded in the background)
+    with span("db", timings):
+        db.save_message(session_id, "user", user_message)
+    with span("vector", timings):
+        memory_queue.add_conversation_memory(session_id, "user", user_message)
+    
+    # Functions are declared to the model as tools when it supports them, and
+    # the prompt then leaves out their documentation
+    provider = model_provider(model_id)
+    native_tools = not stream and provider in NATIVE_TOOL_PROVIDERS and model_handler.supports_tools(provider)
+    
+    # Build the prompt: cached system prefix, world state, history, then this turn's context
+    with span("prompt", timings):
+        prompt = prompt_builder.build(
+            session_id,
+            game_state,
+            user_message,
+            history=snapshot.messages,
+            character=snapshot.character,
+            locations=snapshot.locations,
+            npcs=snapshot.npcs,
+            quests=snapshot.quests,
+            combat_state=snapshot.combat_state,
+            summary=snapshot.summary,
+            vector_context=vector_context,
+            native_tools=native_tools
         )
-        
-        # Choose the model endpoint based on model_id
-        if model_id == 'gemini' and GEMINI_API_KEY:
-            logger.info("Using Google Gemini model for generation")
-            ai_response = call_gemini_api(formatted_messages)
-        else:
-            logger.info("Using local Ollama model for generation")
-            # Default to local Ollama model
-            ai_response = call_ollama_api(formatted_messages)
-        
+    logger.info(f"Prompt built in {prompt.metrics['build_ms']:.2f} ms - "
+                f"{prompt.metrics['prompt_chars']} chars, {prompt.metrics['prefix_chars']} stable, "
+                f"re-rendered: {prompt.metrics['sections_rendered'] or 'none'}")
+    PROMPT_CHARS.set(prompt.metrics['prompt_chars'], part="total")
+    PROMPT_CHARS.set(prompt.metrics['prefix_chars'], part="prefix")
+    PROMPT_CHARS.set(prompt.metrics['prompt_chars'] - prompt.metrics['prefix_chars'], part="suffix")
+    PROMPT_TOKENS.set(estimate_tokens(prompt.text))
+    
+    # With the session's previous Ollama context the model has already seen
+    # everything up to its last reply, so only what changed since is sent
+    model_prompt = prompt.text
+    model_context = None
+    if context_cache and not use_gemini(model_id) and not native_tools:
+        delta = prompt.turn
+        if prompt.updates:
+            delta = f"# UPDATED GAME STATE\n{prompt.updates}{delta}"
+        model_context = context_cache.lookup(
+            session_id,
+            game_state,
+            snapshot.messages[-1] if snapshot.messages else None,
+            estimate_tokens(delta),
+            summary_changed='summary' in prompt.metrics['sections_rendered']
+        )
+        if model_context:
+            model_prompt = delta
+            logger.info(f"Continuing Ollama context of {len(model_context)} tokens - "
+                        f"sending {len(delta)} of {len(prompt.text)} prompt chars")
+    
+    return {
+        "session_id": session_id,
+        "model_id": model_id,
+        "game_state": game_state,
+        "snapshot": snapshot,
+        "character": snapshot.character,
+        "prompt": prompt,
+        "model_prompt": model_prompt,
+        "model_context": model_context,
+        "native_tools": native_tools,
+        "generation": get_generation_policy(game_state),  # Stop sequences and token budget
+        "started": started,
+        "timings": timings,
+        "include_timings": bool(data.get('timings'))  # Per-stage breakdown in the response
+    }
+
+def use_gemini(model_id):
+    return model_id == 'gemini' and bool(GEMINI_API_KEY)
+
+def model_provider(model_id):
+    return "gemini" if use_gemini(model_id) else "ollama"
+
+def finish_turn(turn, ai_response, function_results=None, stream=False, cleaned_response=None):
+    """
+    Everything that happens after generation: run (or, when streaming already
+    ran them, strip) function calls, clean and store the reply, and return the
+    response payload. A stream passes the text it showed as cleaned_response.
+    """
+    session_id = turn["session_id"]
+    snapshot = turn["snapshot"]
+    character = turn["character"]
+    timings = turn["timings"]
+    
+    with span("functions", timings):
         # Process function calls in the response
-        cleaned_response, function_results = function_handler.parse_and_execute_functions(ai_response, session_id)
-        
-        # Clean up any remaining function calls in the text
-        cleaned_response = re.sub(r'```function.*?```', '', cleaned_response, flags=re.DOTALL)
-        cleaned_response = re.sub(r'function\s+\w+\s*\(.*?\)', '', cleaned_response, flags=re.DOTALL)
-
-        # Check if the model is trying to speak for the player
-        if "Player:" in cleaned_response:
-            # Truncate at the point where the model speaks for the player
-            cleaned_response = cleaned_response.split("Player:")[0]
-            # Add a reminder
-            cleaned_response += "\n\n[Waiting for your input...]"
-        
-        # Ensure responses are properly prefixed with "Game Master:"
-        if not cleaned_response.startswith("Game Master:"):
-            cleaned_response = "Game Master: " + cleaned_response
-        
-        # Save cleaned assistant message to database AND vector database
+        if function_results is None:
+            cleaned_response, function_results = function_handler.parse_and_execute_functions(ai_response, session_id)
+        elif cleaned_response is None:
+            cleaned_response = function_handler.strip_function_calls(ai_response)
+    
+    # Check if the model is trying to speak for the player (the stop sequences
+    # normally end generation there; this covers providers that ignore them)
+    if "Player:" in cleaned_response:
+        # Truncate at the point where the model speaks for the player
+        cleaned_response = cleaned_response.split("Player:")[0]
+        # Add a reminder
+        cleaned_response += "\n\n[Waiting for your input...]"
+    
+    # Ensure responses are properly prefixed with "Game Master:"
+    if not cleaned_response.startswith("Game Master:"):
+        cleaned_response = "Game Master: " + cleaned_response
+    
+    # Save cleaned assistant message to database AND vector database (embedded in the background)
+    with span("db", timings):
         db.save_message(session_id, "assistant", cleaned_response)
-        vector_db.add_conversation_memory(session_id, "assistant", cleaned_response)
-        
-        # Get current game state after function calls
-        game_state = db.get_game_state(session_id)
+    with span("vector", timings):
+        memory_queue.add_conversation_memory(session_id, "assistant", cleaned_response)
+    
+    with span("db", timings):
+        # Re-read only the tables the function calls wrote to
+        db.refresh_session_snapshot(snapshot, function_handler.tables_touched(function_results))
+        game_state = snapshot.game_state
         if game_state == "character_creation" and character and character.get('name') and 'ready to begin' in ai_response.lower():
             db.update_game_state(session_id, "adventure")
             game_state = "adventure"
+    
+    # Get updated character data
+    character = snapshot.character
+    
+    # The next turn can continue from where the model left off, unless what it
+    # generated was cut short above and the player never saw the rest
+    if context_cache and turn.get("next_context") and "Player:" not in ai_response:
+        context_cache.store(session_id, turn["game_state"], cleaned_response, turn["next_context"])
+    
+    # Fold older turns into the rolling summary off the request path
+    summarizer.schedule(session_id)
+    
+    logger.info(f"Response generated - Length: {len(cleaned_response)} chars")
+    if function_results:
+        logger.info(f"Functions executed: {[result.get('function') for result in function_results if result.get('success')]}")
+    
+    payload = {
+        "response": cleaned_response,
+        "session_id": session_id,
+        "game_state": game_state,
+        "function_calls": function_results,
+        "character": character
+    }
+    total = time.perf_counter() - turn["started"]
+    observe_stages(timings)
+    TURN_SECONDS.observe(total, model_id=turn["model_id"], stream=str(stream).lower())
+    if turn["include_timings"]:
+        payload["timings"] = dict(timings, total=total * 1000)
+    return payload
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    try:
+        turn = prepare_turn(request.json)
+        if turn["native_tools"]:
+            ai_response, function_results = generate_with_tools(turn)
+            return jsonify(finish_turn(turn, ai_response, function_results, cleaned_response=ai_response))
         
-        # Get updated character data
-        character = db.get_character(session_id)
+        formatted_messages = turn["prompt"].text
         
-        logger.info(f"Response generated - Length: {len(cleaned_response)} chars")
-        if function_results:
-            logger.info(f"Functions executed: {[result.get('function') for result in function_results if result.get('success')]}")
+        # Choose the model endpoint based on model_id
+        with span("model", turn["timings"]):
+            if use_gemini(turn["model_id"]):
+                logger.info("Using Google Gemini model for generation")
+                ai_response = call_gemini_api(formatted_messages, policy=turn["generation"])
+            else:
+                logger.info("Using local Ollama model for generation")
+                # Default to local Ollama model
+                ai_response = call_ollama_api(turn["model_prompt"], context=turn["model_context"], state=turn,
+                                              policy=turn["generation"])
         
-        return jsonify({
-            "response": cleaned_response,
-            "session_id": session_id,
-            "game_state": game_state,
-            "function_calls": function_results,
-            "character": character
-        })
+        return jsonify(finish_turn(turn, ai_response))
     
     except Exception as e:
         logger.error(f"Error processing chat request: {str(e)}")
         logger.error(traceback.format_exc())
         return jsonify({"error": str(e)}), 500
 
-def call_ollama_api(formatted_messages):
-    """Call the Ollama API with the formatted messages."""
+def generate_with_tools(turn):
+    """
+    Generate through ModelHandler with the functions as native tools. The
+    calls of each model response run as one batch as soon as it arrives;
+    their time is counted under "functions" and the rest under "model".
+    Returns (reply, function results).
+    """
+    timings = turn["timings"]
+    provider = model_provider(turn["model_id"])
+    logger.info(f"Using {provider} with native tool calling for generation")
+    
+    def run_functions(calls):
+        with span("functions", timings):
+            return function_handler.execute_calls(calls, turn["session_id"])
+    
+    started = time.perf_counter()
+    function_ms = timings.get("functions", 0.0)
+    result = model_handler.generate(provider, turn["prompt"].prefix, turn["prompt"].suffix, run_functions,
+                                    policy=turn["generation"])
+    
+    function_ms = timings.get("functions", 0.0) - function_ms
+    timings["model"] = (time.perf_counter() - started) * 1000 - function_ms
+    if result["rounds"] > 1:
+        logger.info(f"Tool calling took {result['rounds']} model requests")
+    return result["response"], result["function_results"]
+
+def sse_event(event, data):
+    """Format one Server-Sent Events message with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Same as /chat, but relays the model's output as Server-Sent Events:
+    'token' events carry narrative text as it is generated, 'function' events
+    carry each function call result as soon as its block is complete, and a
+    final 'done' event carries the same payload /chat returns.
+    """
+    try:
+        turn = prepare_turn(request.json, stream=True)
+    except Exception as e:
+        logger.error(f"Error processing chat request: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+    
+    def generate():
+        session_id = turn["session_id"]
+        parser = function_handler.stream_parser()
+        raw_chunks = []
+        shown_chunks = []
+        function_results = []
+        
+        def relay(text, calls):
+            if text:
+                shown_chunks.append(text)
+                yield sse_event("token", {"text": text})
+            if not calls:
+                return
+            # The calls settled together (a whole fenced block) are applied as one batch
+            with span("functions", turn["timings"]):
+                results = function_handler.execute_calls(calls, session_id)
+            for result in results:
+                function_results.append(result)
+                yield sse_event("function", result)
+        
+        try:
+            if use_gemini(turn["model_id"]):
+                logger.info("Streaming from Google Gemini model")
+                chunks = stream_gemini_api(turn["prompt"].text, policy=turn["generation"])
+            else:
+                logger.info("Streaming from local Ollama model")
+                chunks = stream_ollama_api(turn["model_prompt"], context=turn["model_context"], state=turn,
+                                           policy=turn["generation"])
+            
+            yield sse_event("session", {"session_id": session_id})
+            
+            # Function calls run while the model is still generating; their time
+            # is counted under "functions" and the rest of the stream under "model"
+            timings = turn["timings"]
+            stream_started = time.perf_counter()
+            function_ms = timings.get("functions", 0.0)
+            
+            for chunk in chunks:
+                raw_chunks.append(chunk)
+                yield from relay(*parser.feed(chunk))
+            
+            # A function block still open when the stream ends is settled here
+            yield from relay(*parser.finish())
+            
+            function_ms = timings.get("functions", 0.0) - function_ms
+            timings["model"] = (time.perf_counter() - stream_started) * 1000 - function_ms
+            
+            yield sse_event("done", finish_turn(turn, "".join(raw_chunks), function_results, stream=True,
+                                               cleaned_response="".join(shown_chunks)))
+        
+        except Exception as e:
+            logger.error(f"Error streaming chat response: {str(e)}")
+            logger.error(traceback.format_exc())
+            yield sse_event("error", {"error": str(e)})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def ollama_request_body(formatted_messages, stream, context=None, policy=None):
+    """
+    Prepare the request for the Ollama API, continuing context when given and
+    limited by a generation policy (see prompts.GENERATION_POLICIES).
+    """
+    request_body = {
+        "model": DEFAULT_OLLAMA_MODEL,
+        "prompt": formatted_messages,
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE
+    }
+    if context:
+        request_body["context"] = context
+    
+    options = {}
+    if OLLAMA_NUM_CTX:
+        options["num_ctx"] = OLLAMA_NUM_CTX
+    if policy:
+        options["num_predict"] = policy["max_tokens"]
+        options["stop"] = policy["stop"]
+    if options:
+        request_body["options"] = options
+    return request_body
+
+def record_finish(provider, reason):
+    """Count why a generation ended; hitting the token budget is worth a warning."""
+    reason = (reason or "unknown").lower()
+    MODEL_FINISHED.inc(provider=provider, reason=reason)
+    if reason in ("length", "max_tokens"):
+        logger.warning(f"{provider} response was cut off by the generation budget")
+
+def call_ollama_api(formatted_messages, context=None, state=None, policy=None):
+    """
+    Call the Ollama API with the formatted messages. context continues an
+    earlier generation; the context this one ends with is put in
+    state["next_context"] when state is given. policy sets stop sequences and
+    the token budget.
+    """
     logger.info("Sending request to Ollama API")
-    start_time = datetime.now()
+    start_time = time.perf_counter()
     
-    response = requests.post(
+    response = get_transport("ollama").post(
         OLLAMA_API_URL,
-        json={
-            "model": "mistral-nemo:latest",  # Replace with your preferred model
-            "prompt": formatted_messages,
-            "stream": False
-        }
+        json=ollama_request_body(formatted_messages, False, context, policy)
     )
     
-    end_time = datetime.now()
-    duration = (end_time - start_time).total_seconds()
+    duration = time.perf_counter() - start_time
+    MODEL_SECONDS.observe(duration, provider="ollama", mode="generate")
     logger.info(f"Ollama API response received in {duration:.2f} seconds")
     
     if response.status_code != 200:
@@ -205,19 +633,18 @@ def call_ollama_api(formatted_messages):
         raise Exception(f"Error from Ollama API: {response.text}")
     
     response_data = response.json()
+    record_finish("ollama", response_data.get('done_reason'))
+    if state is not None:
+        state["next_context"] = response_data.get('context')
     return response_data.get('response', 'No response generated')
 
-def call_gemini_api(formatted_messages):
-    """Call the Google Gemini API with the formatted messages."""
-    if not GEMINI_API_KEY:
-        logger.error("Gemini API key not set")
-        raise Exception("Gemini API key not set")
-    
-    logger.info("Sending request to Google Gemini API")
-    start_time = datetime.now()
-    
-    # Prepare the request for Gemini API
-    prompt_data = {
+def gemini_headers():
+    # Send the key as a header so it never shows up in logged URLs (e.g. retry warnings)
+    return {"x-goog-api-key": GEMINI_API_KEY}
+
+def gemini_request_body(formatted_messages, policy=None):
+    """Prepare the request for Gemini API, limited by a generation policy when given."""
+    request_body = {
         "contents": [
             {
                 "parts": [
@@ -234,14 +661,28 @@ def call_gemini_api(formatted_messages):
             "maxOutputTokens": 2048
         }
     }
+    if policy:
+        request_body["generationConfig"]["maxOutputTokens"] = policy["max_tokens"]
+        request_body["generationConfig"]["stopSequences"] = policy["stop"]
+    return request_body
+
+def call_gemini_api(formatted_messages, policy=None):
+    """Call the Google Gemini API with the formatted messages."""
+    if not GEMINI_API_KEY:
+        logger.error("Gemini API key not set")
+        raise Exception("Gemini API key not set")
+    
+    logger.info("Sending request to Google Gemini API")
+    start_time = time.perf_counter()
     
-    response = requests.post(
-        f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-        json=prompt_data
+    response = get_transport("gemini").post(
+        GEMINI_API_URL,
+        json=gemini_request_body(formatted_messages, policy),
+        headers=gemini_headers()
     )
     
-    end_time = datetime.now()
-    duration = (end_time - start_time).total_seconds()
+    duration = time.perf_counter() - start_time
+    MODEL_SECONDS.observe(duration, provider="gemini", mode="generate")
     logger.info(f"Gemini API response received in {duration:.2f} seconds")
     
     if response.status_code != 200:
@@ -252,12 +693,99 @@ def call_gemini_api(formatted_messages):
     
     # Extract the response text from Gemini's response structure
     try:
-        return response_data["candidates"][0]["content"]["parts"][0]["text"]
+        candidate = response_data["candidates"][0]
+        record_finish("gemini", candidate.get("finishReason"))
+        return candidate["content"]["parts"][0]["text"]
     except (KeyError, IndexError):
         logger.error("Unexpected response structure from Gemini API")
         logger.error(f"Response: {json.dumps(response_data)}")
         raise Exception("Unexpected response structure from Gemini API")
 
+def stream_ollama_api(formatted_messages, context=None, state=None, policy=None):
+    """
+    Stream text chunks from the Ollama API as they are generated. context,
+    state and policy work as in call_ollama_api.
+    """
+    logger.info("Sending streaming request to Ollama API")
+    start_time = time.perf_counter()
+    first_token_time = None
+    
+    request_body = ollama_request_body(formatted_messages, True, context, policy)
+    
+    with get_transport("ollama").stream(OLLAMA_API_URL, json=request_body) as response:
+        if response.status_code != 200:
+            logger.error(f"Ollama API error: {response.status_code} - {response.text}")
+            raise Exception(f"Error from Ollama API: {response.text}")
+        
+        # Ollama streams one JSON object per line
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get('error'):
+                raise Exception(f"Error from Ollama API: {chunk['error']}")
+            
+            text = chunk.get('response', '')
+            if text:
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start_time
+                    MODEL_FIRST_TOKEN_SECONDS.observe(first_token_time, provider="ollama")
+                    logger.info(f"Ollama first token after {first_token_time:.2f} seconds")
+                yield text
+            
+            if chunk.get('done'):
+                record_finish("ollama", chunk.get('done_reason'))
+                if state is not None:
+                    state["next_context"] = chunk.get('context')
+                break
+    
+    duration = time.perf_counter() - start_time
+    MODEL_SECONDS.observe(duration, provider="ollama", mode="stream")
+    logger.info(f"Ollama API stream finished in {duration:.2f} seconds")
+
+def stream_gemini_api(formatted_messages, policy=None):
+    """Stream text chunks from the Google Gemini API as they are generated."""
+    if not GEMINI_API_KEY:
+        logger.error("Gemini API key not set")
+        raise Exception("Gemini API key not set")
+    
+    logger.info("Sending streaming request to Google Gemini API")
+    start_time = time.perf_counter()
+    first_token_time = None
+    
+    stream_url = f"{GEMINI_STREAM_URL}?alt=sse"
+    with get_transport("gemini").stream(stream_url, json=gemini_request_body(formatted_messages, policy),
+                                        headers=gemini_headers()) as response:
+        if response.status_code != 200:
+            logger.error(f"Gemini API error: {response.status_code} - {response.text}")
+            raise Exception(f"Error from Gemini API: {response.text}")
+        
+        # With alt=sse every event is a "data: {...}" line holding a partial response
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            chunk = json.loads(line[len("data:"):].strip())
+            
+            try:
+                candidate = chunk["candidates"][0]
+            except (KeyError, IndexError):
+                continue
+            if candidate.get("finishReason"):
+                record_finish("gemini", candidate["finishReason"])
+            parts = candidate.get("content", {}).get("parts", [])
+            
+            text = "".join(part.get("text", "") for part in parts)
+            if text:
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start_time
+                    MODEL_FIRST_TOKEN_SECONDS.observe(first_token_time, provider="gemini")
+                    logger.info(f"Gemini first token after {first_token_time:.2f} seconds")
+                yield text
+    
+    duration = time.perf_counter() - start_time
+    MODEL_SECONDS.observe(duration, provider="gemini", mode="stream")
+    logger.info(f"Gemini API stream finished in {duration:.2f} seconds")
+
 @app.route('/character', methods=['GET'])
 def get_character():
     """Get character information for a session."""
@@ -285,7 +813,7 @@ def update_character():
     
     # Also update in vector database
     if character_data:
-        vector_db.add_character_memory(session_id, character_data)
+        memory_queue.add_entity_memory(session_id, 'character', character_data)
     
     return jsonify({"character_id": character_id})
 
@@ -315,82 +843,27 @@ def get_vector_context():
     if not session_id:
         return jsonify({"error": "Session ID required"}), 400
     
+    memory_queue.flush(session_id)
     context = vector_db.generate_narrative_context(session_id, query)
     
     return jsonify({
         "context": context
     })
 
-def format_messages(history, current_message, system_prompt, character=None, 
-                   locations=None, npcs=None, quests=None, combat_state=None):
-    """Format the conversation history and current message for the LLM."""
-    # Start with the system prompt
-    formatted_prompt = system_prompt + "\n\n"
-    
-    # Add character information if available
-    if character and character.get('name'):
-        formatted_prompt += "PLAYER CHARACTER:\n"
-        for key, value in character.items():
-            if key != 'inventory':  # Handle inventory separately
-                formatted_prompt += f"{key.capitalize()}: {value}\n"
-        
-        # Add inventory if it exists
-        if 'inventory' in character and character['inventory']:
-            formatted_prompt += "Inventory:\n"
-            for item in character['inventory']:
-                formatted_prompt += f"- {item}\n"
-        
-        formatted_prompt += "\n"
-    
-    # Add world information if available
-    if locations and len(locations) > 0:
-        formatted_prompt += "KNOWN LOCATIONS:\n"
-        for loc in locations[:5]:  # Limit to 5 to keep context manageable
-            formatted_prompt += f"- {loc['name']}: {loc['type']} - {loc['description'][:100]}...\n"
-        formatted_prompt += "\n"
-    
-    if npcs and len(npcs) > 0:
-        formatted_prompt += "KNOWN NPCs:\n"
-        for npc in npcs[:5]:  # Limit to 5
-            formatted_prompt += f"- {npc['name']}: {npc['role']} - {npc['description'][:100]}...\n"
-        formatted_prompt += "\n"
-    
-    if quests and len(quests) > 0:
-        formatted_prompt += "ACTIVE QUESTS:\n"
-        for quest in [q for q in quests if q['status'] in ['not_started', 'in_progress']][:3]:
-            formatted_prompt += f"- {quest['title']} ({quest['status']}): {quest['description'][:100]}...\n"
-        formatted_prompt += "\n"
-    
-    # Add combat state if in combat
-    if combat_state and combat_state.get('is_in_combat'):
-        formatted_prompt += "CURRENT COMBAT STATE:\n"
-        formatted_prompt += f"Round: {combat_state.get('round', 1)}\n"
-        formatted_prompt += f"Current turn: {combat_state.get('current_combatant', 'Unknown')}\n"
-        
-        if 'initiative_order' in combat_state and combat_state['initiative_order']:
-            formatted_prompt += "Initiative order:\n"
-            for combatant in combat_state['initiative_order']:
-                formatted_prompt += f"- {combatant.get('name', 'Unknown')}: {combatant.get('initiative', 0)}\n"
-        
-        formatted_prompt += "\n"
-    
-    # Add conversation history
-    for message in history:
-        role = message.get('role', '')
-        content = message.get('content', '')
-        
-        if role == 'user':
-            formatted_prompt += f"Player: {content}\n"
-        elif role == 'assistant':
-            formatted_prompt += f"{content}\n"
-    
-    # Add the current message
-    formatted_prompt += f"Player: {current_message}\n"
-    
-    return formatted_prompt
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Counters, gauges and latency histograms in the Prometheus text format."""
+    return Response(registry.render(), content_type=CONTENT_TYPE)
 
 if __name__ == '__main__':
+    # Development server; in production run gunicorn -c gunicorn.conf.py wsgi:app
     logger.info("Starting D&D Game Master Assistant server...")
     logger.info(f"Local Ollama API URL: {OLLAMA_API_URL}")
     logger.info(f"Gemini API available: {bool(GEMINI_API_KEY)}")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    logger.info(f"Native tool calling: {', '.join(sorted(NATIVE_TOOL_PROVIDERS)) or 'off'}")
+    create_app().run(
+        debug=os.environ.get("FLASK_DEBUG", "1") == "1",
+        host='0.0.0.0',
+        port=int(os.environ.get("PORT", "5000")),
+        threaded=True
+    )
\ No newline at end of file
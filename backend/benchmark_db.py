@@ -0,0 +1,156 @@
+# benchmark_db.py
+# Measures session-scoped query latency in game_data.db as the shared tables
+# grow, with and without the migration-managed indexes.
+#
+#   python benchmark_db.py                      # 1k, 10k and 100k message rows
+#   python benchmark_db.py --sizes 10000 1000000 --json
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from db_manager import DatabaseManager
+
+# Index names created by migration 1 in migrations.py
+SESSION_INDEXES = [
+    "idx_messages_session_timestamp",
+    "idx_characters_session",
+    "idx_locations_session_name",
+    "idx_npcs_session_name",
+    "idx_npcs_session_location",
+    "idx_quests_session_title",
+    "idx_combat_state_session",
+]
+
+def seed_database(db, message_rows, sessions, entities_per_session=5):
+    """Fill the database with synthetic sessions; returns one session id to probe."""
+    session_ids = [str(uuid.uuid4()) for _ in range(sessions)]
+    start = datetime(2024, 1, 1)
+
+    with db.connection() as conn:
+        conn.executemany(
+            'INSERT INTO sessions (session_id, created_at, last_active) VALUES (?, ?, ?)',
+            [(sid, start, start) for sid in session_ids]
+        )
+
+        batch = []
+        for i in range(message_rows):
+            sid = session_ids[i % sessions]
+            role = "user" if i % 2 == 0 else "assistant"
+            batch.append((str(uuid.uuid4()), sid, role, f"Synthetic message {i}", start + timedelta(seconds=i)))
+            if len(batch) >= 10000:
+                conn.executemany(
+                    'INSERT INTO messages (message_id, session_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?)',
+                    batch
+                )
+                batch = []
+        if batch:
+            conn.executemany(
+                'INSERT INTO messages (message_id, session_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?)',
+                batch
+            )
+
+        for sid in session_ids:
+            conn.executemany(
+                'INSERT INTO locations (location_id, session_id, name, description, type, details, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(str(uuid.uuid4()), sid, f"Location {n}", "A place", "town", "{}", start)
+                 for n in range(entities_per_session)]
+            )
+            conn.executemany(
+                'INSERT INTO npcs (npc_id, session_id, name, description, role, details, location_id, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(str(uuid.uuid4()), sid, f"NPC {n}", "Someone", "villager", "{}", None, start)
+                 for n in range(entities_per_session)]
+            )
+            conn.executemany(
+                'INSERT INTO quests (quest_id, session_id, title, description, status, details, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(str(uuid.uuid4()), sid, f"Quest {n}", "Do a thing", "in_progress", "{}", start, start)
+                 for n in range(entities_per_session)]
+            )
+
+        conn.commit()
+
+    return session_ids[len(session_ids) // 2]
+
+def time_call(func, iterations):
+    """Return the median latency of func() in milliseconds."""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+def measure(db, session_id, iterations):
+    """Median latency of the hot-path lookups for one session."""
+    quest = {"title": "Quest 2", "description": "Do a thing", "status": "in_progress"}
+    return {
+        "get_messages_ms": time_call(lambda: db.get_messages(session_id), iterations),
+        "get_npcs_ms": time_call(lambda: db.get_npcs(session_id), iterations),
+        "get_character_ms": time_call(lambda: db.get_character(session_id), iterations),
+        "update_quest_ms": time_call(lambda: db.update_quest(session_id, quest), iterations),
+    }
+
+def drop_indexes(db):
+    with db.connection() as conn:
+        for name in SESSION_INDEXES:
+            conn.execute(f'DROP INDEX IF EXISTS {name}')
+        conn.commit()
+
+def run_benchmark(sizes, sessions, iterations, include_unindexed=True):
+    results = []
+    workdir = tempfile.mkdtemp(prefix="dnd_db_bench_")
+
+    try:
+        for size in sizes:
+            db_path = os.path.join(workdir, f"bench_{size}.db")
+            db = DatabaseManager(db_path)
+            session_id = seed_database(db, size, min(sessions, max(size // 20, 1)))
+
+            row = {"message_rows": size, "indexed": measure(db, session_id, iterations)}
+            if include_unindexed:
+                drop_indexes(db)
+                row["unindexed"] = measure(db, session_id, iterations)
+            results.append(row)
+            db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+def print_table(results):
+    columns = ["get_messages_ms", "get_npcs_ms", "get_character_ms", "update_quest_ms"]
+    header = f"{'rows':>10} {'mode':>10} " + " ".join(f"{c:>18}" for c in columns)
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        for mode in ("indexed", "unindexed"):
+            if mode in row:
+                values = " ".join(f"{row[mode][c]:>18.3f}" for c in columns)
+                print(f"{row['message_rows']:>10} {mode:>10} {values}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark session-scoped SQLite lookups")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="Total message rows to seed for each run")
+    parser.add_argument("--sessions", type=int, default=1000,
+                        help="Number of sessions sharing the database")
+    parser.add_argument("--iterations", type=int, default=50,
+                        help="Timed calls per query")
+    parser.add_argument("--indexed-only", action="store_true",
+                        help="Skip the run with indexes dropped")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.sessions, args.iterations, not args.indexed_only)
+    if args.json:
+        print(json.dumps({"sqlite_version": sqlite3.sqlite_version, "results": results}, indent=2))
+    else:
+        print_table(results)
@@ -0,0 +1,217 @@
+# benchmark_function_parser.py
+# Checks and times the single-pass function call scanner (function_parser.py).
+#
+# The fuzz pass builds random responses from narrative, fenced blocks and bare
+# calls whose arguments hold parentheses, quotes and escapes, and checks that
+# the scanner finds exactly the calls that were put in and leaves exactly the
+# narrative, both on the whole text and fed in random chunks. The benchmark
+# pass times large responses against the regex pipeline it replaced (two
+# findall and two sub passes in FunctionHandler, two more subs in the app).
+#
+#   python benchmark_function_parser.py
+#   python benchmark_function_parser.py --cases 5000 --sizes 10000 1000000 --json
+import argparse
+import json
+import random
+import re
+import statistics
+import sys
+import time
+from function_parser import FunctionCallScanner, extract_function_calls
+
+# The pipeline before function_parser.py
+FUNCTION_PATTERN = r'```function\s+(\w+)\s*\((.*?)\)\s*```'
+ALT_FUNCTION_PATTERN = r'function\s+(\w+)\s*\((.*?)\)'
+
+def regex_pipeline(text):
+    calls = re.findall(FUNCTION_PATTERN, text, re.DOTALL)
+    calls.extend(re.findall(ALT_FUNCTION_PATTERN, text, re.DOTALL))
+    cleaned = re.sub(FUNCTION_PATTERN, '', text)
+    cleaned = re.sub(ALT_FUNCTION_PATTERN, '', cleaned)
+    cleaned = re.sub(r'```function.*?```', '', cleaned, flags=re.DOTALL)
+    cleaned = re.sub(r'function\s+\w+\s*\(.*?\)', '', cleaned, flags=re.DOTALL)
+    return cleaned, calls
+
+NARRATIVE = [
+    "The tavern falls silent as you enter. ",
+    "Old Tom (the innkeeper) wipes a mug and nods. ",
+    "The golem's malfunction leaves it twitching by the gate. ",
+    "\"Careful,\" she whispers, \"the bridge won't hold.\" ",
+    "The function of the rune (if it has one) is unclear. ",
+    "A backslash \\ is carved into the door. ",
+    "Rain hammers the roof.\n\n",
+    "```\nA riddle is etched here in plain code.\n```\n",
+    "Roll for initiative! ",
+    "You hear `function` muttered in the dark. ",
+]
+
+NAMES = ["update_character", "add_world_location", "add_npc", "update_quest", "update_combat_state"]
+
+WORDS = ["Mira", "(retired)", "say \"hi\"", "a) b(", "back\\slash", "```", "function x(", "tab\there",
+         "ünïcode", ")", "(", "line\nbreak", "50% off"]
+
+def random_arguments(rng):
+    if rng.random() < 0.2:
+        # The key: value form the handler accepts besides JSON
+        return ", ".join(f"{rng.choice(['name', 'level', 'status'])}: {rng.choice(['Mira', '3', 'active'])}"
+                         for _ in range(rng.randint(1, 3)))
+    value = {
+        "name": " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))),
+        "level": rng.randint(1, 20),
+        "details": {"notes": [rng.choice(WORDS) for _ in range(rng.randint(0, 3))]},
+    }
+    return json.dumps(value, ensure_ascii=rng.random() < 0.5, indent=rng.choice([None, 2]))
+
+def random_call(rng):
+    """Return (text, calls) for one fenced block or bare call."""
+    kind = rng.random()
+    if kind < 0.4:
+        name, args = rng.choice(NAMES), random_arguments(rng)
+        layout = rng.choice(["```function {0}({1})```", "```function\n{0}({1})\n```", "```function {0} ( {1} ) \n```"])
+        return layout.format(name, args), [(name, args if "( " not in layout else f" {args} ")]
+    if kind < 0.6:
+        calls = [(rng.choice(NAMES), random_arguments(rng)) for _ in range(rng.randint(2, 3))]
+        lines = [f"{'function ' if rng.random() < 0.5 else ''}{name}({args})" for name, args in calls]
+        return "```function\n" + "\n".join(lines) + "\n```", calls
+    name, args = rng.choice(NAMES), random_arguments(rng)
+    return f"function {name}({args})", [(name, args)]
+
+def random_response(rng, pieces):
+    """A response with its expected narrative and calls."""
+    parts, narrative, calls = [], [], []
+    for _ in range(pieces):
+        if rng.random() < 0.7:
+            text = rng.choice(NARRATIVE)
+            parts.append(text)
+            narrative.append(text)
+        else:
+            text, expected = random_call(rng)
+            parts.append(text)
+            calls.extend(expected)
+    return "".join(parts), "".join(narrative), calls
+
+def streamed(text, rng, max_chunk):
+    scanner = FunctionCallScanner()
+    output, calls = [], []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, max_chunk)
+        piece, found = scanner.feed(text[pos:pos + size])
+        output.append(piece)
+        calls.extend(found)
+        pos += size
+    piece, found = scanner.finish()
+    output.append(piece)
+    calls.extend(found)
+    return "".join(output), calls
+
+# Inputs with a fixed expected result: (text, cleaned, calls)
+EDGE_CASES = [
+    ("Hi ```function add_npc({\"name\": \"Tom (old)\"})``` bye",
+     "Hi  bye", [("add_npc", "{\"name\": \"Tom (old)\"}")]),
+    ("```function\nupdate_quest({\"title\": \"x\"})\n```", "", [("update_quest", "{\"title\": \"x\"}")]),
+    ("A malfunction(yes) and a function without a call.", "A malfunction(yes) and a function without a call.", []),
+    ("function add_npc({\"name\": \"unclosed\"", "function add_npc({\"name\": \"unclosed\"", []),
+    ("Text ```function add_npc({\"name\": \"cut off", "Text ", []),
+    ("```function garbage here``` after", " after", []),
+    ("```function add_npc({})\nnot a call\n``` after", " after", [("add_npc", "{}")]),
+    ("function add_npc({\"s\": \"quote \\\" and ) paren\"})!", "!", [("add_npc", "{\"s\": \"quote \\\" and ) paren\"}")]),
+    ("```python\nprint(1)\n```", "```python\nprint(1)\n```", []),
+    ("functional functions", "functional functions", []),
+]
+
+def run_fuzz(cases, seed, max_chunk):
+    rng = random.Random(seed)
+    failures = []
+    regex_double_counts = 0
+
+    for text, cleaned, calls in EDGE_CASES:
+        for label, result in (("whole", extract_function_calls(text)), ("streamed", streamed(text, rng, max_chunk))):
+            if result != (cleaned, calls):
+                failures.append({"case": "edge", "mode": label, "text": text, "got": result})
+
+    for i in range(cases):
+        text, narrative, calls = random_response(rng, rng.randint(1, 12))
+        expected = (narrative, calls)
+        whole = extract_function_calls(text)
+        if whole != expected:
+            failures.append({"case": i, "mode": "whole", "text": text, "got": whole, "expected": expected})
+        chunked = streamed(text, rng, max_chunk)
+        if chunked != expected:
+            failures.append({"case": i, "mode": "streamed", "text": text, "got": chunked, "expected": expected})
+        if len(regex_pipeline(text)[1]) > len(calls):
+            regex_double_counts += 1
+
+    return {
+        "cases": cases + len(EDGE_CASES),
+        "failures": len(failures),
+        "first_failures": failures[:5],
+        "regex_pipeline_extra_calls": regex_double_counts,
+    }
+
+def time_ms(func, *args, iterations=5):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+def run_benchmark(sizes, seed, iterations, chunk_size):
+    rng = random.Random(seed)
+    results = []
+    for size in sizes:
+        parts = []
+        length = 0
+        while length < size:
+            text, _, _ = random_response(rng, 12)
+            parts.append(text)
+            length += len(text)
+        text = "".join(parts)
+
+        def stream():
+            scanner = FunctionCallScanner()
+            for pos in range(0, len(text), chunk_size):
+                scanner.feed(text[pos:pos + chunk_size])
+            scanner.finish()
+
+        results.append({
+            "chars": len(text),
+            "regex_pipeline_ms": time_ms(regex_pipeline, text, iterations=iterations),
+            "scanner_ms": time_ms(extract_function_calls, text, iterations=iterations),
+            "scanner_streamed_ms": time_ms(stream, iterations=iterations),
+        })
+    return results
+
+def print_report(fuzz, results, chunk_size):
+    print(f"fuzz: {fuzz['cases']} cases, {fuzz['failures']} failures; "
+          f"the regex pipeline over-counted calls in {fuzz['regex_pipeline_extra_calls']}")
+    for failure in fuzz["first_failures"]:
+        print(f"  {failure['mode']} case {failure['case']}: {failure['text']!r}")
+    print()
+    header = f"{'chars':>10} {'regex ms':>12} {'scanner ms':>12} {f'streamed/{chunk_size} ms':>16}"
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        print(f"{row['chars']:>10} {row['regex_pipeline_ms']:>12.2f} {row['scanner_ms']:>12.2f} "
+              f"{row['scanner_streamed_ms']:>16.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fuzz and benchmark the function call scanner")
+    parser.add_argument("--cases", type=int, default=2000, help="Random responses to check")
+    parser.add_argument("--max-chunk", type=int, default=8, help="Largest random chunk when streaming")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 20000, 200000],
+                        help="Response lengths in characters to time")
+    parser.add_argument("--chunk-size", type=int, default=4, help="Chunk length for the streamed timing")
+    parser.add_argument("--iterations", type=int, default=5, help="Timed runs per size (median reported)")
+    parser.add_argument("--seed", type=int, default=7, help="Random seed")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    fuzz = run_fuzz(args.cases, args.seed, args.max_chunk)
+    results = run_benchmark(args.sizes, args.seed, args.iterations, args.chunk_size)
+    if args.json:
+        print(json.dumps({"fuzz": fuzz, "results": results}, indent=2, default=str))
+    else:
+        print_report(fuzz, results, args.chunk_size)
+    sys.exit(1 if fuzz["failures"] else 0)
@@ -0,0 +1,243 @@
+# benchmark_retrieval.py
+# Measures what generate_narrative_context costs and how well it retrieves.
+# Seeds synthetic campaigns into a temporary chroma_db and game_data.db,
+# replays scripted player turns that each point at one labeled memory, and
+# reports p50/p95 latency per stage plus recall@k.
+#
+#   python benchmark_retrieval.py                         # 20 campaigns, 100 turns
+#   python benchmark_retrieval.py --sessions 200 --messages 1000 --json > retrieval.json
+#   python benchmark_retrieval.py --partitioning session --json
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from db_manager import DatabaseManager
+from embedding import SentenceTransformerEmbedder, EmbeddingCache, DEFAULT_MODEL
+from vector_db_manager import VectorDBManager, COLLECTION_NAMES, PARTITIONING_MODES
+
+FIRST_NAMES = ["Aldric", "Brenna", "Corwin", "Dagna", "Elowen", "Fenwick", "Garrick", "Hilda", "Isolde",
+               "Jorund", "Kestrel", "Lorcan", "Maelis", "Nerys", "Osric", "Perrin", "Quilla", "Rowan",
+               "Sable", "Thorne", "Ulric", "Vesna", "Wystan", "Ysolde"]
+ROLES = ["blacksmith", "innkeeper", "priestess", "smuggler", "alchemist", "ranger", "bard", "guard captain",
+         "fishmonger", "librarian", "mercenary", "herbalist"]
+PLACES = ["Ashford", "Blackmere", "Cinderfall", "Duskhollow", "Emberwatch", "Frostvale", "Greywater",
+          "Hollowmere", "Ironcrag", "Mistwood", "Ravenspire", "Stormhaven", "Thornbury", "Wolfden"]
+PLACE_TYPES = ["village", "ruined keep", "port town", "mountain pass", "swamp", "monastery", "mine"]
+ARTIFACTS = ["silver chalice", "obsidian dagger", "lost crown", "dragon egg", "sunstone", "bone flute",
+             "iron key", "star map", "jade idol", "cursed ring"]
+HIDING_PLACES = ["the old well", "the chapel crypt", "a hollow oak", "the mill cellar", "the lighthouse",
+                 "the sunken barge", "the bell tower"]
+FILLER = ["We set up camp for the night.", "The rain keeps falling on the road.", "I check my pack.",
+          "The party walks on in silence.", "You hear wolves howling far away.", "I roll to look around.",
+          "The fire crackles as the night goes on.", "Nothing seems out of place here."]
+
+class Campaign:
+    """One synthetic session and the labeled memories the scripted turns point at."""
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.targets = []  # (kind, memory id, player message)
+
+def seed_campaign(db, vector_db, rng, entities, messages):
+    session_id = db.create_session()
+    campaign = Campaign(session_id)
+
+    names = rng.sample(FIRST_NAMES, min(entities, len(FIRST_NAMES)))
+    places = rng.sample(PLACES, min(entities, len(PLACES)))
+    artifacts = rng.sample(ARTIFACTS, min(entities, len(ARTIFACTS)))
+
+    npcs = []
+    for name in names:
+        npc = {"name": name, "role": rng.choice(ROLES), "location": rng.choice(places),
+               "description": f"{name} is a {rng.choice(['gruff', 'cheerful', 'nervous', 'stern'])} local."}
+        npcs.append(npc)
+        db.add_npc(session_id, npc)
+        campaign.targets.append(("npc", f"{session_id}_{name}", f"I go and talk to {name} the {npc['role']}."))
+
+    locations = []
+    for place in places:
+        location = {"name": place, "type": rng.choice(PLACE_TYPES),
+                    "description": f"{place} lies beyond the hills, known for its markets."}
+        locations.append(location)
+        db.add_location(session_id, location)
+        campaign.targets.append(("location", f"{session_id}_{place}", f"We travel to {place}."))
+
+    quests = []
+    for artifact in artifacts:
+        quest = {"title": f"Recover the {artifact}", "status": "in_progress",
+                 "description": f"Someone stole the {artifact} and it must be returned."}
+        quests.append(quest)
+        db.update_quest(session_id, quest)
+        campaign.targets.append(("quest", f"{session_id}_{quest['title']}",
+                                 f"Any news on the {artifact} we are looking for?"))
+
+    vector_db.upsert_entities(session_id, "npc", npcs)
+    vector_db.upsert_entities(session_id, "location", locations)
+    vector_db.upsert_entities(session_id, "quest", quests)
+
+    # Mostly filler conversation with a few memorable facts buried in it
+    entries = []
+    secrets = {}
+    for i in range(messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        if role == "assistant" and i % 10 == 1:
+            artifact = rng.choice(ARTIFACTS)
+            content = f"Game Master: The stranger whispers that the {artifact} is hidden in {rng.choice(HIDING_PLACES)}."
+            secrets[artifact] = f"{session_id}_msg_{i}"  # The latest mention is the right answer
+        else:
+            content = rng.choice(FILLER)
+        memory_id = f"{session_id}_msg_{i}"
+        db.save_message(session_id, role, content)
+        entries.append({"session_id": session_id, "role": role, "content": content, "memory_id": memory_id})
+    vector_db.add_conversation_memories(entries)
+
+    for artifact, memory_id in secrets.items():
+        campaign.targets.append(("conversation", memory_id, f"Where did the stranger say the {artifact} was hidden?"))
+
+    return campaign
+
+def percentiles(samples):
+    """p50, p95 and mean of a list of millisecond samples."""
+    ordered = sorted(samples)
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+    return {
+        "p50": rank(50),
+        "p95": rank(95),
+        "mean": statistics.fmean(ordered),
+        "count": len(ordered),
+    }
+
+def timed(samples, name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    samples.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+    return result
+
+def replay_turns(vector_db, campaigns, turns, ks, rng):
+    """Run the scripted turns; returns (latency samples, recall counts)."""
+    samples = {}
+    max_k = max(ks)
+    found = {k: 0 for k in ks}
+    found_by_kind = {}
+    asked_by_kind = {}
+
+    targets = [(campaign, target) for campaign in campaigns for target in campaign.targets]
+    for _ in range(turns):
+        campaign, (kind, memory_id, message) = rng.choice(targets)
+        session_id = campaign.session_id
+
+        # Each stage on its own, the way search() runs them
+        embedding = timed(samples, "embed", vector_db.embedder.embed_query, message)
+        for collection_kind in COLLECTION_NAMES:
+            timed(samples, f"query_{COLLECTION_NAMES[collection_kind]}",
+                  vector_db._search_collection, collection_kind, embedding, session_id, max_k)
+        results = vector_db.query_by_context(session_id, message, max_k)
+        timed(samples, "format", vector_db.format_narrative_context, results)
+
+        # Then the real thing, end to end
+        timed(samples, "search_concurrent", vector_db.search, session_id, message, max_k)
+        timed(samples, "generate_narrative_context", vector_db.generate_narrative_context, session_id, message)
+
+        # Recall: is the labeled memory among the top k hits of its kind, ranked
+        # the way query_by_context ranks them?
+        hits = vector_db.search(session_id, message, max_k, kinds=[kind],
+                                overfetch={"conversation": vector_db.recency_overfetch})
+        if kind == "conversation" and vector_db.recency_weight:
+            hits = vector_db.rank_by_recency(session_id, hits)
+        hits = [hit.id for hit in hits]
+        asked_by_kind[kind] = asked_by_kind.get(kind, 0) + 1
+        for k in ks:
+            if memory_id in hits[:k]:
+                found[k] += 1
+                found_by_kind.setdefault(kind, {}).setdefault(k, 0)
+                found_by_kind[kind][k] += 1
+
+    recall = {f"recall@{k}": found[k] / turns for k in ks}
+    recall["by_kind"] = {
+        kind: {f"recall@{k}": found_by_kind.get(kind, {}).get(k, 0) / asked for k in ks}
+        for kind, asked in asked_by_kind.items()
+    }
+    return samples, recall
+
+def run_benchmark(sessions, entities, messages, turns, ks, partitioning, seed, embedding_cache):
+    rng = random.Random(seed)
+    workdir = tempfile.mkdtemp(prefix="dnd_retrieval_bench_")
+
+    try:
+        db = DatabaseManager(os.path.join(workdir, "game_data.db"))
+        embedder = SentenceTransformerEmbedder(
+            model_name=os.environ.get('EMBEDDING_MODEL', DEFAULT_MODEL),
+            backend=os.environ.get('EMBEDDING_BACKEND', 'torch'),
+            cache=embedding_cache
+        )
+        vector_db = VectorDBManager(os.path.join(workdir, "chroma_db"), embedder=embedder,
+                                    partitioning=partitioning, sequence_store=db)
+
+        start = time.perf_counter()
+        campaigns = [seed_campaign(db, vector_db, rng, entities, messages) for _ in range(sessions)]
+        seed_seconds = time.perf_counter() - start
+
+        # Warm the model and the collections before timing anything
+        vector_db.generate_narrative_context(campaigns[0].session_id, "warm up")
+
+        samples, recall = replay_turns(vector_db, campaigns, turns, ks, rng)
+        db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "config": {
+            "sessions": sessions,
+            "entities_per_kind": entities,
+            "messages_per_session": messages,
+            "turns": turns,
+            "partitioning": partitioning,
+            "embedding_backend": embedder.backend,
+            "seed": seed,
+        },
+        "seed_seconds": seed_seconds,
+        "latency_ms": {stage: percentiles(values) for stage, values in samples.items()},
+        "recall": recall,
+    }
+
+def print_report(report):
+    config = report["config"]
+    print(f"{config['sessions']} campaigns x {config['messages_per_session']} messages, "
+          f"{config['turns']} turns, {config['partitioning']} partitioning "
+          f"(seeded in {report['seed_seconds']:.1f}s)")
+    print()
+    header = f"{'stage':>30} {'p50 ms':>10} {'p95 ms':>10} {'mean ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for stage, stats in report["latency_ms"].items():
+        print(f"{stage:>30} {stats['p50']:>10.2f} {stats['p95']:>10.2f} {stats['mean']:>10.2f}")
+    print()
+    recall = report["recall"]
+    print("  ".join(f"{key} {value:.2f}" for key, value in recall.items() if key != "by_kind"))
+    for kind, values in recall["by_kind"].items():
+        print(f"  {kind:>12}: " + "  ".join(f"{key} {value:.2f}" for key, value in values.items()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark narrative context retrieval")
+    parser.add_argument("--sessions", type=int, default=20, help="Synthetic campaigns to seed")
+    parser.add_argument("--entities", type=int, default=8, help="NPCs, locations and quests per campaign")
+    parser.add_argument("--messages", type=int, default=200, help="Conversation messages per campaign")
+    parser.add_argument("--turns", type=int, default=100, help="Scripted player turns to replay")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5], help="Cutoffs for recall@k")
+    parser.add_argument("--partitioning", choices=PARTITIONING_MODES, default="global")
+    parser.add_argument("--seed", type=int, default=7, help="Random seed for the synthetic data")
+    parser.add_argument("--embedding-cache", action="store_true",
+                        help="Keep the embedding cache on (repeated turns then skip the model)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.sessions, args.entities, args.messages, args.turns, sorted(args.k),
+                           args.partitioning, args.seed, EmbeddingCache() if args.embedding_cache else None)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,79 @@
+# context_cache.py
+# Per-session cache of the context Ollama returns from /api/generate: the
+# tokens of everything the model has already processed for a session (the
+# prompt and its own reply). Passing them back lets the next turn send only
+# what is new, so the model doesn't prefill the system prompt, world state
+# and history again.
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import registry
+
+CONTEXT_LOOKUPS = registry.counter(
+    'dnd_ollama_context_lookups_total', 'Ollama context cache lookups by outcome', ('result',)
+)
+CONTEXT_TOKENS = registry.gauge(
+    'dnd_ollama_context_tokens', 'Tokens in the most recently reused Ollama context'
+)
+
+def reply_key(text):
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+class ModelContextCache:
+    def __init__(self, max_sessions=256, max_tokens=3072):
+        """
+        max_tokens caps the reused context plus the new turn; it has to leave
+        room for the reply within the model's context window (num_ctx), or
+        Ollama would shift the system prompt out. Past it the next turn sends
+        the full prompt again, which also brings back the bounded history.
+        """
+        self.max_sessions = max_sessions
+        self.max_tokens = max_tokens
+        self._entries = OrderedDict()  # session_id -> (game_state, reply key, context)
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "miss": 0, "state_changed": 0, "summary_changed": 0, "diverged": 0, "full": 0}
+
+    def lookup(self, session_id, game_state, last_message, new_tokens, summary_changed=False):
+        """
+        Return the context to continue for this turn, or None to send the full
+        prompt. The context is only reused while the system prompt (game
+        state) and the summary are unchanged and the last message in the
+        history is the reply it ended with, i.e. no turn was served elsewhere.
+        """
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is None:
+                result = "miss"
+            elif entry[0] != game_state:
+                result = "state_changed"
+            elif summary_changed:
+                result = "summary_changed"
+            elif not last_message or last_message.get('role') != 'assistant' \
+                    or reply_key(last_message.get('content')) != entry[1]:
+                result = "diverged"
+            elif len(entry[2]) + new_tokens > self.max_tokens:
+                result = "full"
+            else:
+                result = "hit"
+                self._entries[session_id] = entry  # Back in as most recently used
+            self.stats[result] += 1
+
+        CONTEXT_LOOKUPS.inc(result=result)
+        if result != "hit":
+            return None
+        CONTEXT_TOKENS.set(len(entry[2]))
+        return entry[2]
+
+    def store(self, session_id, game_state, reply, context):
+        """Remember the context a turn ended with and the reply stored for it."""
+        if not context:
+            return
+        with self._lock:
+            self._entries[session_id] = (game_state, reply_key(reply), context)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
@@ -2,256 +2,511 @@
 import sqlite3
 import json
 import uuid
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
 from datetime import datetime
+from migrations import run_migrations
+from metrics import registry, timed
+
+# Per-connection tuning. WAL lets readers run while another session commits,
+# and synchronous=NORMAL is still crash-safe in WAL mode.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",  # ~16 MB page cache
+    "PRAGMA mmap_size = 134217728",  # 128 MB memory-mapped reads
+    "PRAGMA temp_store = MEMORY",
+)
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate (~4 characters per token for English prose).
+    Migration 2 backfills existing rows with the same formula in SQL.
+    """
+    return (len(text or '') + 3) // 4
+
+DB_SECONDS = registry.histogram(
+    'dnd_db_operation_seconds', 'Time spent in DatabaseManager operations', ('operation',)
+)
+POOL_WAIT_SECONDS = registry.histogram(
+    'dnd_db_pool_wait_seconds', 'Time spent waiting for a free pooled connection'
+)
+POOL_OPEN = registry.gauge('dnd_db_pool_connections', 'Pooled SQLite connections currently open')
+TRANSACTIONS = registry.counter(
+    'dnd_db_transactions_total', 'DatabaseManager.transaction() blocks by outcome', ('result',)
+)
+
+@dataclass
+class SessionSnapshot:
+    """Everything the chat turn reads about a session, loaded in one transaction."""
+    session_id: str
+    game_state: Optional[str] = None
+    summary: Optional[dict] = None
+    messages: list = field(default_factory=list)
+    character: Optional[dict] = None
+    locations: list = field(default_factory=list)
+    npcs: list = field(default_factory=list)
+    quests: list = field(default_factory=list)
+    combat_state: dict = field(default_factory=lambda: {'is_in_combat': False})
+
+class _TransactionConnection:
+    """
+    The connection of an open transaction() as the methods called inside it
+    see it: their commits are left to the end of the block.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+    
+    def commit(self):
+        pass
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+@dataclass
+class _Transaction:
+    """A thread's open transaction()."""
+    conn: _TransactionConnection
+    savepoints: int = 0
+    # Run once the transaction commits, dropped when it rolls back
+    on_commit: list = field(default_factory=list)
+    # Sessions whose cached location ids it may have added
+    location_sessions: set = field(default_factory=set)
 
 class DatabaseManager:
-    def __init__(self, db_path="game_data.db"):
+    # Sessions whose location name lookups are kept in memory
+    LOCATION_CACHE_SESSIONS = 256
+    
+    def __init__(self, db_path="game_data.db", pool_size=5, pool_timeout=30.0,
+                 history_limit=20, history_max_tokens=None, history_max_chars=None):
+        """
+        pool_size is the maximum number of long-lived connections kept open
+        for the life of the process. Set it to 0 to open and close a fresh
+        connection for every call.
+        history_limit, history_max_tokens and history_max_chars bound the
+        message window returned by get_messages and the session snapshot.
+        """
         self.db_path = db_path
+        self.history_limit = history_limit
+        self.history_max_tokens = history_max_tokens
+        self.history_max_chars = history_max_chars
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self._pool = queue.LifoQueue()
+        self._pool_lock = threading.Lock()
+        self._pool_open = 0
+        # session_id -> {location name: location_id}, most recently used last
+        self._location_ids = OrderedDict()
+        self._location_ids_lock = threading.Lock()
+        # The calling thread's open transaction(), if any
+        self._local = threading.local()
         self.setup_database()
     
-    def get_connection(self):
-        """Create and return a database connection."""
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self):
+        """Open a new configured connection to the database file."""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.pool_timeout,
+            # Pooled connections move between request threads, but only
+            # one thread holds a connection at a time.
+            check_same_thread=not self.pool_size,
+            # Keep compiled statements around; with long-lived connections
+            # every query after the first reuses its prepared statement.
+            cached_statements=256
+        )
         conn.row_factory = sqlite3.Row  # Access rows as dictionaries
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
         return conn
     
-    def setup_database(self):
-        """Create necessary tables if they don't exist."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Create sessions table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
-            session_id TEXT PRIMARY KEY,
-            created_at TIMESTAMP,
-            last_active TIMESTAMP,
-            game_state TEXT DEFAULT 'character_creation'
-        )
-        ''')
-        
-        # Create characters table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS characters (
-            character_id TEXT PRIMARY KEY,
-            session_id TEXT,
-            name TEXT,
-            race TEXT,
-            class TEXT,
-            background TEXT,
-            stats TEXT,
-            inventory TEXT,
-            created_at TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES sessions (session_id)
-        )
-        ''')
-        # stats TEXT,  # JSON string of all character stats
-        # inventory TEXT,  # JSON string of inventory items
-        
-        # Create messages history table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            message_id TEXT PRIMARY KEY,
-            session_id TEXT,
-            role TEXT,
-            content TEXT,
-            timestamp TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES sessions (session_id)
-        )
-        ''')
-        # role TEXT,  # 'user' or 'assistant'
-        
-        # Create locations table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS locations (
-            location_id TEXT PRIMARY KEY,
-            session_id TEXT,
-            name TEXT,
-            description TEXT,
-            type TEXT,
-            details TEXT,
-            created_at TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES sessions (session_id)
-        )
-        ''')
-        # details TEXT,  # JSON string of additional details
-        
-        # Create NPCs table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS npcs (
-            npc_id TEXT PRIMARY KEY,
-            session_id TEXT,
-            name TEXT,
-            description TEXT,
-            role TEXT,
-            details TEXT,
-            location_id TEXT,
-            created_at TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES sessions (session_id),
-            FOREIGN KEY (location_id) REFERENCES locations (location_id)
-        )
-        ''')
-        # details TEXT,  # JSON string of additional details
+    def get_connection(self):
+        """
+        Return a database connection.
+        When pooling is enabled the connection comes from the pool and must be
+        handed back with release_connection(); prefer the connection() context
+        manager, which does that automatically.
+        """
+        if not self.pool_size:
+            return self._connect()
+        
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        
+        # Grow the pool until it reaches pool_size, then wait for a free one
+        with self._pool_lock:
+            can_open = self._pool_open < self.pool_size
+            if can_open:
+                self._pool_open += 1
+        
+        if not can_open:
+            try:
+                with POOL_WAIT_SECONDS.time():
+                    return self._pool.get(timeout=self.pool_timeout)
+            except queue.Empty:
+                raise sqlite3.OperationalError(
+                    f"Timed out waiting for a database connection ({self.pool_size} in use)"
+                )
+        
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._pool_lock:
+                self._pool_open -= 1
+            raise
+        POOL_OPEN.inc()
+        return conn
+    
+    def release_connection(self, conn):
+        """Return a connection to the pool, or close it when pooling is disabled."""
+        if not self.pool_size:
+            conn.close()
+            return
+        
+        # Never hand a half-finished transaction to the next caller
+        if conn.in_transaction:
+            conn.rollback()
+        self._pool.put(conn)
+    
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that checks a connection out and always releases it.
+        Inside transaction() it yields the transaction's connection instead.
+        """
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction is not None:
+            yield transaction.conn
+            return
         
-        # Create quests table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS quests (
-            quest_id TEXT PRIMARY KEY,
-            session_id TEXT,
-            title TEXT,
-            description TEXT,
-            status TEXT,
-            details TEXT,
-            created_at TIMESTAMP,
-            updated_at TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES sessions (session_id)
-        )
-        ''')
-        # details TEXT,  # JSON string of additional details
+        conn = self.get_connection()
+        try:
+            yield conn
+        finally:
+            self.release_connection(conn)
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Run every call in the block on one connection and in one SQLite
+        transaction: the commits of the methods called inside it become a
+        single commit when the block ends, and an exception rolls all of them
+        back. A nested block is a savepoint of the outer one.
+        """
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction is not None:
+            yield from self._savepoint(transaction)
+            return
         
-        # Create combat_state table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS combat_state (
-            combat_id TEXT PRIMARY KEY,
-            session_id TEXT,
-            is_in_combat BOOLEAN,
-            initiative_order TEXT,
-            current_combatant TEXT,
-            round INTEGER,
-            created_at TIMESTAMP,
-            updated_at TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES sessions (session_id)
-        )
-        ''')
-        # initiative_order TEXT,  # JSON string of initiative order
+        conn = self.get_connection()
+        transaction = _Transaction(_TransactionConnection(conn))
+        try:
+            # Take the write lock up front so reads in the block see a stable database
+            conn.execute('BEGIN IMMEDIATE')
+            self._local.transaction = transaction
+            try:
+                yield
+                conn.commit()
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._forget_location_ids(transaction.location_sessions)
+                TRANSACTIONS.inc(result='rollback')
+                raise
+        finally:
+            self._local.transaction = None
+            self.release_connection(conn)
+        
+        TRANSACTIONS.inc(result='commit')
+        for callback in transaction.on_commit:
+            callback()
+    
+    def _savepoint(self, transaction):
+        name = f"nested_{transaction.savepoints}"
+        transaction.savepoints += 1
+        callbacks = len(transaction.on_commit)
+        transaction.conn.execute(f'SAVEPOINT {name}')
+        try:
+            yield
+        except BaseException:
+            transaction.conn.execute(f'ROLLBACK TO {name}')
+            transaction.conn.execute(f'RELEASE {name}')
+            del transaction.on_commit[callbacks:]
+            self._forget_location_ids(transaction.location_sessions)
+            raise
+        else:
+            transaction.conn.execute(f'RELEASE {name}')
+        finally:
+            transaction.savepoints -= 1
+    
+    def on_commit(self, callback):
+        """
+        Call callback once the current transaction() commits, or right away
+        outside of one. It is dropped if the transaction rolls back.
+        """
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction is None:
+            callback()
+        else:
+            transaction.on_commit.append(callback)
+    
+    def close(self):
+        """Close every idle pooled connection."""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._pool_lock:
+                self._pool_open -= 1
+            POOL_OPEN.dec()
+    
+    def setup_database(self):
+        """Create necessary tables if they don't exist."""
+        with self.connection() as conn:
+            cursor = conn.cursor()
         
-        conn.commit()
-        conn.close()
+            # Create sessions table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                created_at TIMESTAMP,
+                last_active TIMESTAMP,
+                game_state TEXT DEFAULT 'character_creation'
+            )
+            ''')
+        
+            # Create characters table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS characters (
+                character_id TEXT PRIMARY KEY,
+                session_id TEXT,
+                name TEXT,
+                race TEXT,
+                class TEXT,
+                background TEXT,
+                stats TEXT,
+                inventory TEXT,
+                created_at TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions (session_id)
+            )
+            ''')
+            # stats TEXT,  # JSON string of all character stats
+            # inventory TEXT,  # JSON string of inventory items
+        
+            # Create messages history table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id TEXT PRIMARY KEY,
+                session_id TEXT,
+                role TEXT,
+                content TEXT,
+                timestamp TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions (session_id)
+            )
+            ''')
+            # role TEXT,  # 'user' or 'assistant'
+        
+            # Create locations table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS locations (
+                location_id TEXT PRIMARY KEY,
+                session_id TEXT,
+                name TEXT,
+                description TEXT,
+                type TEXT,
+                details TEXT,
+                created_at TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions (session_id)
+            )
+            ''')
+            # details TEXT,  # JSON string of additional details
+        
+            # Create NPCs table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS npcs (
+                npc_id TEXT PRIMARY KEY,
+                session_id TEXT,
+                name TEXT,
+                description TEXT,
+                role TEXT,
+                details TEXT,
+                location_id TEXT,
+                created_at TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions (session_id),
+                FOREIGN KEY (location_id) REFERENCES locations (location_id)
+            )
+            ''')
+            # details TEXT,  # JSON string of additional details
+        
+            # Create quests table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS quests (
+                quest_id TEXT PRIMARY KEY,
+                session_id TEXT,
+                title TEXT,
+                description TEXT,
+                status TEXT,
+                details TEXT,
+                created_at TIMESTAMP,
+                updated_at TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions (session_id)
+            )
+            ''')
+            # details TEXT,  # JSON string of additional details
+        
+            # Create combat_state table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS combat_state (
+                combat_id TEXT PRIMARY KEY,
+                session_id TEXT,
+                is_in_combat BOOLEAN,
+                initiative_order TEXT,
+                current_combatant TEXT,
+                round INTEGER,
+                created_at TIMESTAMP,
+                updated_at TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions (session_id)
+            )
+            ''')
+            # initiative_order TEXT,  # JSON string of initiative order
+        
+            conn.commit()
+            
+            # Bring indexes and later schema changes up to date
+            run_migrations(conn)
     
+    @timed(DB_SECONDS)
     def create_session(self):
         """Create a new game session and return the session ID."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            cursor = conn.cursor()
         
-        session_id = str(uuid.uuid4())
-        now = datetime.now()
+            session_id = str(uuid.uuid4())
+            now = datetime.now()
         
-        cursor.execute(
-            'INSERT INTO sessions (session_id, created_at, last_active) VALUES (?, ?, ?)',
-            (session_id, now, now)
-        )
+            cursor.execute(
+                'INSERT INTO sessions (session_id, created_at, last_active) VALUES (?, ?, ?)',
+                (session_id, now, now)
+            )
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         
         return session_id
     
+    @timed(DB_SECONDS)
     def update_session_activity(self, session_id):
         """Update the last_active timestamp for a session."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute(
-            'UPDATE sessions SET last_active = ? WHERE session_id = ?',
-            (datetime.now(), session_id)
-        )
+            cursor.execute(
+                'UPDATE sessions SET last_active = ? WHERE session_id = ?',
+                (datetime.now(), session_id)
+            )
         
-        conn.commit()
-        conn.close()
+            conn.commit()
     
+    @timed(DB_SECONDS)
     def update_game_state(self, session_id, game_state):
         """Update the game state for a session."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute(
-            'UPDATE sessions SET game_state = ? WHERE session_id = ?',
-            (game_state, session_id)
-        )
+            cursor.execute(
+                'UPDATE sessions SET game_state = ? WHERE session_id = ?',
+                (game_state, session_id)
+            )
         
-        conn.commit()
-        conn.close()
+            conn.commit()
     
     def get_game_state(self, session_id):
         """Get the current game state for a session."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        with self.connection() as conn:
+            return self._read_game_state(conn.cursor(), session_id)
+    
+    def _read_game_state(self, cursor, session_id):
         cursor.execute('SELECT game_state FROM sessions WHERE session_id = ?', (session_id,))
         result = cursor.fetchone()
         
-        conn.close()
-        
         if result:
             return result['game_state']
         return None
     
+    @timed(DB_SECONDS)
     def save_character(self, session_id, character_data):
         """Save or update character information."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Check if character already exists for this session
-        cursor.execute('SELECT character_id FROM characters WHERE session_id = ?', (session_id,))
-        result = cursor.fetchone()
-        
-        character_id = result['character_id'] if result else str(uuid.uuid4())
-        now = datetime.now()
-        
-        # Extract specific fields, store the rest as JSON
-        name = character_data.get('name', '')
-        race = character_data.get('race', '')
-        character_class = character_data.get('class', '')
-        background = character_data.get('background', '')
-        
-        # Create a copy of character_data to avoid modifying the original
-        stats_data = character_data.copy()
-        
-        # Remove fields that are stored separately
-        for field in ['name', 'race', 'class', 'background']:
-            if field in stats_data:
-                del stats_data[field]
-        
-        # Handle inventory separately
-        inventory = stats_data.pop('inventory', [])
-        
-        # Store remaining data as JSON
-        stats = json.dumps(stats_data)
-        inventory_json = json.dumps(inventory)
-        
-        if result:
-            # Update existing character
-            cursor.execute('''
-            UPDATE characters 
-            SET name = ?, race = ?, class = ?, background = ?, stats = ?, inventory = ?
-            WHERE character_id = ?
-            ''', (name, race, character_class, background, stats, inventory_json, character_id))
-        else:
-            # Insert new character
-            cursor.execute('''
-            INSERT INTO characters 
-            (character_id, session_id, name, race, class, background, stats, inventory, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (character_id, session_id, name, race, character_class, background, stats, 
-                 inventory_json, now))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+        
+            # Check if character already exists for this session
+            cursor.execute('SELECT character_id FROM characters WHERE session_id = ?', (session_id,))
+            result = cursor.fetchone()
+        
+            character_id = result['character_id'] if result else str(uuid.uuid4())
+            now = datetime.now()
+        
+            # Extract specific fields, store the rest as JSON
+            name = character_data.get('name', '')
+            race = character_data.get('race', '')
+            character_class = character_data.get('class', '')
+            background = character_data.get('background', '')
+        
+            # Create a copy of character_data to avoid modifying the original
+            stats_data = character_data.copy()
+        
+            # Remove fields that are stored separately
+            for field in ['name', 'race', 'class', 'background']:
+                if field in stats_data:
+                    del stats_data[field]
+        
+            # Handle inventory separately
+            inventory = stats_data.pop('inventory', [])
+        
+            # Store remaining data as JSON
+            stats = json.dumps(stats_data)
+            inventory_json = json.dumps(inventory)
+        
+            if result:
+                # Update existing character
+                cursor.execute('''
+                UPDATE characters 
+                SET name = ?, race = ?, class = ?, background = ?, stats = ?, inventory = ?
+                WHERE character_id = ?
+                ''', (name, race, character_class, background, stats, inventory_json, character_id))
+            else:
+                # Insert new character
+                cursor.execute('''
+                INSERT INTO characters 
+                (character_id, session_id, name, race, class, background, stats, inventory, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (character_id, session_id, name, race, character_class, background, stats, 
+                     inventory_json, now))
+        
+            conn.commit()
         
         return character_id
     
+    @timed(DB_SECONDS)
     def get_character(self, session_id):
         """Get character information for a session."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        with self.connection() as conn:
+            return self._read_character(conn.cursor(), session_id)
+    
+    def _read_character(self, cursor, session_id):
         cursor.execute('''
         SELECT name, race, class, background, stats, inventory
         FROM characters WHERE session_id = ?
         ''', (session_id,))
         
         result = cursor.fetchone()
-        conn.close()
         
         if not result:
             return None
@@ -273,82 +528,193 @@ class DatabaseManager:
         
         return character
     
+    @timed(DB_SECONDS)
     def save_message(self, session_id, role, content):
         """Save a message to the history."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            cursor = conn.cursor()
         
-        message_id = str(uuid.uuid4())
-        now = datetime.now()
+            message_id = str(uuid.uuid4())
+            now = datetime.now()
         
-        cursor.execute(
-            'INSERT INTO messages (message_id, session_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?)',
-            (message_id, session_id, role, content, now)
-        )
+            cursor.execute(
+                'INSERT INTO messages (message_id, session_id, role, content, timestamp, token_count) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (message_id, session_id, role, content, now, estimate_tokens(content))
+            )
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         
         return message_id
     
-    def get_messages(self, session_id, limit=20):
-        """Get recent messages for a session."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    @timed(DB_SECONDS)
+    def get_messages(self, session_id, limit=None, max_tokens=None, max_chars=None, before=None, after=None):
+        """
+        Get the most recent messages for a session, oldest first.
+        Returns at most limit messages whose combined size fits within
+        max_tokens and/or max_chars (defaults come from the constructor).
+        Pass the timestamp of the oldest returned message as before to page
+        further back, and after to skip messages already folded into a summary.
+        """
+        with self.connection() as conn:
+            return self._read_messages(conn.cursor(), session_id, limit, max_tokens, max_chars, before, after)
+    
+    def _read_messages(self, cursor, session_id, limit=None, max_tokens=None, max_chars=None, before=None,
+                       after=None):
+        limit = self.history_limit if limit is None else limit
+        max_tokens = self.history_max_tokens if max_tokens is None else max_tokens
+        max_chars = self.history_max_chars if max_chars is None else max_chars
+        
+        # Walk the (session_id, timestamp) index backwards from the newest
+        # message, or from the cursor when paging
+        query = '''
+        SELECT role, content, timestamp, token_count FROM messages
+        WHERE session_id = ?
+        '''
+        params = [session_id]
+        if before:
+            query += ' AND timestamp < ?'
+            params.append(before)
+        if after:
+            query += ' AND timestamp > ?'
+            params.append(after)
+        query += ' ORDER BY timestamp DESC LIMIT ?'
+        params.append(limit)
+        
+        cursor.execute(query, params)
+        
+        messages = []
+        total_tokens = 0
+        total_chars = 0
+        for row in cursor.fetchall():
+            content = row['content'] or ''
+            # Rows written before token counts were stored are estimated on the fly
+            tokens = row['token_count'] if row['token_count'] is not None else estimate_tokens(content)
+            
+            if max_tokens is not None and total_tokens + tokens > max_tokens:
+                break
+            if max_chars is not None and total_chars + len(content) > max_chars:
+                break
+            
+            total_tokens += tokens
+            total_chars += len(content)
+            messages.append({
+                'role': row['role'],
+                'content': row['content'],
+                'timestamp': row['timestamp']
+            })
+        
+        messages.reverse()
+        return messages
+    
+    def count_messages(self, session_id, after=None):
+        """Count messages for a session, optionally only those newer than a timestamp."""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            if after:
+                cursor.execute(
+                    'SELECT COUNT(*) FROM messages WHERE session_id = ? AND timestamp > ?',
+                    (session_id, after)
+                )
+            else:
+                cursor.execute('SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,))
+            
+            return cursor.fetchone()[0]
+    
+    def get_message_range(self, session_id, after=None, limit=100):
+        """Get up to limit messages newer than a timestamp, oldest first."""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+            SELECT role, content, timestamp FROM messages
+            WHERE session_id = ? AND timestamp > ?
+            ORDER BY timestamp ASC
+            LIMIT ?
+            ''', (session_id, after or '', limit))
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    @timed(DB_SECONDS)
+    def save_summary(self, session_id, content, covers_until, message_count):
+        """Store a summary of every message up to and including covers_until."""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            summary_id = str(uuid.uuid4())
+            
+            cursor.execute('''
+            INSERT INTO summaries
+            (summary_id, session_id, content, covers_until, message_count, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (summary_id, session_id, content, covers_until, message_count, datetime.now()))
+            
+            conn.commit()
         
+        return summary_id
+    
+    def get_latest_summary(self, session_id):
+        """Get the newest conversation summary for a session, if any."""
+        with self.connection() as conn:
+            return self._read_summary(conn.cursor(), session_id)
+    
+    def _read_summary(self, cursor, session_id):
         cursor.execute('''
-        SELECT role, content FROM messages 
-        WHERE session_id = ? 
-        ORDER BY timestamp ASC
-        LIMIT ?
-        ''', (session_id, limit))
-        
-        messages = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        SELECT summary_id, content, covers_until, message_count
+        FROM summaries WHERE session_id = ?
+        ORDER BY covers_until DESC
+        LIMIT 1
+        ''', (session_id,))
         
-        return messages
+        result = cursor.fetchone()
+        return dict(result) if result else None
     
     # New methods for world building
     
+    @timed(DB_SECONDS)
     def add_location(self, session_id, location_data):
         """Add a new location to the game world."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            cursor = conn.cursor()
         
-        location_id = str(uuid.uuid4())
-        now = datetime.now()
+            location_id = str(uuid.uuid4())
+            now = datetime.now()
         
-        name = location_data.get('name', '')
-        description = location_data.get('description', '')
-        location_type = location_data.get('type', '')
+            name = location_data.get('name', '')
+            description = location_data.get('description', '')
+            location_type = location_data.get('type', '')
         
-        # Store additional details as JSON
-        details_data = location_data.copy()
-        for field in ['name', 'description', 'type']:
-            if field in details_data:
-                del details_data[field]
+            # Store additional details as JSON
+            details_data = location_data.copy()
+            for field in ['name', 'description', 'type']:
+                if field in details_data:
+                    del details_data[field]
         
-        details = json.dumps(details_data)
+            details = json.dumps(details_data)
         
-        cursor.execute('''
-        INSERT INTO locations
-        (location_id, session_id, name, description, type, details, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (location_id, session_id, name, description, location_type, details, now))
+            cursor.execute('''
+            INSERT INTO locations
+            (location_id, session_id, name, description, type, details, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (location_id, session_id, name, description, location_type, details, now))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         
+        self._cache_location_id(session_id, name, location_id)
         return location_id
     
+    @timed(DB_SECONDS)
     def get_locations(self, session_id):
         """Get all locations for a session."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        with self.connection() as conn:
+            return self._read_locations(conn.cursor(), session_id)
+    
+    def _read_locations(self, cursor, session_id):
         cursor.execute('''
         SELECT location_id, name, description, type, details
         FROM locations WHERE session_id = ?
+        ORDER BY rowid
         ''', (session_id,))
         
         locations = []
@@ -364,65 +730,120 @@ class DatabaseManager:
             location.update(details)
             locations.append(location)
         
-        conn.close()
         return locations
     
+    @timed(DB_SECONDS)
     def add_npc(self, session_id, npc_data):
         """Add a new NPC to the game world."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            cursor = conn.cursor()
         
-        npc_id = str(uuid.uuid4())
-        now = datetime.now()
+            npc_id = str(uuid.uuid4())
+            now = datetime.now()
         
-        name = npc_data.get('name', '')
-        description = npc_data.get('description', '')
-        role = npc_data.get('role', '')
-        location_name = npc_data.get('location', '')
+            name = npc_data.get('name', '')
+            description = npc_data.get('description', '')
+            role = npc_data.get('role', '')
+            location_name = npc_data.get('location', '')
         
-        # Get location ID if provided
-        location_id = None
-        if location_name:
-            cursor.execute('SELECT location_id FROM locations WHERE name = ? AND session_id = ?', 
-                          (location_name, session_id))
-            location_result = cursor.fetchone()
-            if location_result:
-                location_id = location_result['location_id']
+            # Get location ID if provided
+            location_id = self._resolve_location_id(cursor, session_id, location_name)
         
-        # Store additional details as JSON
-        details_data = npc_data.copy()
-        for field in ['name', 'description', 'role', 'location']:
-            if field in details_data:
-                del details_data[field]
+            # Store additional details as JSON
+            details_data = npc_data.copy()
+            for field in ['name', 'description', 'role', 'location']:
+                if field in details_data:
+                    del details_data[field]
         
-        details = json.dumps(details_data)
+            details = json.dumps(details_data)
         
-        cursor.execute('''
-        INSERT INTO npcs
-        (npc_id, session_id, name, description, role, details, location_id, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (npc_id, session_id, name, description, role, details, location_id, now))
+            cursor.execute('''
+            INSERT INTO npcs
+            (npc_id, session_id, name, description, role, details, location_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (npc_id, session_id, name, description, role, details, location_id, now))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         
         return npc_id
     
-    def get_npcs(self, session_id, location_id=None):
-        """Get NPCs for a session, optionally filtered by location."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def _cache_location_id(self, session_id, name, location_id):
+        """Remember a location name -> id mapping for a session."""
+        if not name:
+            return
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction is not None:
+            transaction.location_sessions.add(session_id)
+        with self._location_ids_lock:
+            names = self._location_ids.setdefault(session_id, {})
+            self._location_ids.move_to_end(session_id)
+            # Keep the first location registered under a name, like the SQL lookup does
+            names.setdefault(name, location_id)
+            while len(self._location_ids) > self.LOCATION_CACHE_SESSIONS:
+                self._location_ids.popitem(last=False)
+    
+    def _forget_location_ids(self, session_ids):
+        """Drop the cached location ids of sessions a rolled-back transaction wrote to."""
+        with self._location_ids_lock:
+            for session_id in session_ids:
+                self._location_ids.pop(session_id, None)
+    
+    def _resolve_location_id(self, cursor, session_id, name):
+        """Map a location name to its id, going to the database only on a cache miss."""
+        if not name:
+            return None
+        
+        with self._location_ids_lock:
+            names = self._location_ids.get(session_id)
+            if names and name in names:
+                self._location_ids.move_to_end(session_id)
+                return names[name]
+        
+        cursor.execute('''
+        SELECT location_id FROM locations WHERE session_id = ? AND name = ?
+        ORDER BY rowid LIMIT 1
+        ''', (session_id, name))
+        result = cursor.fetchone()
+        if not result:
+            return None
+        
+        self._cache_location_id(session_id, name, result['location_id'])
+        return result['location_id']
+    
+    @timed(DB_SECONDS)
+    def get_npcs(self, session_id, location_id=None, location=None, limit=None, offset=0):
+        """
+        Get NPCs for a session with their location names resolved.
+        Filter by location_id or by location name, and page with limit/offset.
+        """
+        with self.connection() as conn:
+            return self._read_npcs(conn.cursor(), session_id, location_id, location, limit, offset)
+    
+    def _read_npcs(self, cursor, session_id, location_id=None, location=None, limit=None, offset=0):
+        if location and not location_id:
+            location_id = self._resolve_location_id(cursor, session_id, location)
+            if not location_id:
+                return []
+        
+        # Resolve location names with a join instead of one lookup per NPC
+        query = '''
+        SELECT n.npc_id, n.name, n.description, n.role, n.details, l.name AS location_name
+        FROM npcs n LEFT JOIN locations l ON l.location_id = n.location_id
+        WHERE n.session_id = ?
+        '''
+        params = [session_id]
         
         if location_id:
-            cursor.execute('''
-            SELECT npc_id, name, description, role, details
-            FROM npcs WHERE session_id = ? AND location_id = ?
-            ''', (session_id, location_id))
-        else:
-            cursor.execute('''
-            SELECT npc_id, name, description, role, details, location_id
-            FROM npcs WHERE session_id = ?
-            ''', (session_id,))
+            query += ' AND n.location_id = ?'
+            params.append(location_id)
+        
+        query += ' ORDER BY n.rowid'
+        
+        if limit is not None:
+            query += ' LIMIT ? OFFSET ?'
+            params.extend([limit, offset])
+        
+        cursor.execute(query, params)
         
         npcs = []
         for row in cursor.fetchall():
@@ -437,88 +858,88 @@ class DatabaseManager:
             npc.update(details)
             
             # Add location name if available
-            if 'location_id' in row and row['location_id']:
-                cursor.execute('SELECT name FROM locations WHERE location_id = ?', (row['location_id'],))
-                location_result = cursor.fetchone()
-                if location_result:
-                    npc['location'] = location_result['name']
+            if row['location_name']:
+                npc['location'] = row['location_name']
             
             npcs.append(npc)
         
-        conn.close()
         return npcs
     
+    @timed(DB_SECONDS)
     def update_quest(self, session_id, quest_data):
         """Create or update a quest."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        title = quest_data.get('title', '')
-        now = datetime.now()
-        
-        # Check if quest already exists
-        cursor.execute('SELECT quest_id FROM quests WHERE title = ? AND session_id = ?', 
-                      (title, session_id))
-        result = cursor.fetchone()
-        
-        if result:
-            quest_id = result['quest_id']
-            # Update existing quest
-            description = quest_data.get('description', '')
-            status = quest_data.get('status', 'not_started')
+        with self.connection() as conn:
+            cursor = conn.cursor()
+        
+            title = quest_data.get('title', '')
+            now = datetime.now()
+        
+            # Check if quest already exists
+            cursor.execute('SELECT quest_id FROM quests WHERE title = ? AND session_id = ?', 
+                          (title, session_id))
+            result = cursor.fetchone()
+        
+            if result:
+                quest_id = result['quest_id']
+                # Update existing quest
+                description = quest_data.get('description', '')
+                status = quest_data.get('status', 'not_started')
             
-            # Store additional details as JSON
-            details_data = quest_data.copy()
-            for field in ['title', 'description', 'status']:
-                if field in details_data:
-                    del details_data[field]
+                # Store additional details as JSON
+                details_data = quest_data.copy()
+                for field in ['title', 'description', 'status']:
+                    if field in details_data:
+                        del details_data[field]
             
-            details = json.dumps(details_data)
+                details = json.dumps(details_data)
             
-            cursor.execute('''
-            UPDATE quests 
-            SET description = ?, status = ?, details = ?, updated_at = ?
-            WHERE quest_id = ?
-            ''', (description, status, details, now, quest_id))
-        else:
-            # Create new quest
-            quest_id = str(uuid.uuid4())
-            description = quest_data.get('description', '')
-            status = quest_data.get('status', 'not_started')
+                cursor.execute('''
+                UPDATE quests 
+                SET description = ?, status = ?, details = ?, updated_at = ?
+                WHERE quest_id = ?
+                ''', (description, status, details, now, quest_id))
+            else:
+                # Create new quest
+                quest_id = str(uuid.uuid4())
+                description = quest_data.get('description', '')
+                status = quest_data.get('status', 'not_started')
             
-            # Store additional details as JSON
-            details_data = quest_data.copy()
-            for field in ['title', 'description', 'status']:
-                if field in details_data:
-                    del details_data[field]
+                # Store additional details as JSON
+                details_data = quest_data.copy()
+                for field in ['title', 'description', 'status']:
+                    if field in details_data:
+                        del details_data[field]
             
-            details = json.dumps(details_data)
+                details = json.dumps(details_data)
             
-            cursor.execute('''
-            INSERT INTO quests
-            (quest_id, session_id, title, description, status, details, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (quest_id, session_id, title, description, status, details, now, now))
+                cursor.execute('''
+                INSERT INTO quests
+                (quest_id, session_id, title, description, status, details, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (quest_id, session_id, title, description, status, details, now, now))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         
         return quest_id
     
+    @timed(DB_SECONDS)
     def get_quests(self, session_id, status=None):
         """Get quests for a session, optionally filtered by status."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        with self.connection() as conn:
+            return self._read_quests(conn.cursor(), session_id, status)
+    
+    def _read_quests(self, cursor, session_id, status=None):
         if status:
             cursor.execute('''
             SELECT quest_id, title, description, status, details
             FROM quests WHERE session_id = ? AND status = ?
+            ORDER BY rowid
             ''', (session_id, status))
         else:
             cursor.execute('''
             SELECT quest_id, title, description, status, details
             FROM quests WHERE session_id = ?
+            ORDER BY rowid
             ''', (session_id,))
         
         quests = []
@@ -534,63 +955,63 @@ class DatabaseManager:
             quest.update(details)
             quests.append(quest)
         
-        conn.close()
         return quests
     
+    @timed(DB_SECONDS)
     def update_combat_state(self, session_id, combat_data):
         """Update the combat state for a session."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        now = datetime.now()
-        is_in_combat = combat_data.get('is_in_combat', False)
-        
-        # Check if combat state already exists
-        cursor.execute('SELECT combat_id FROM combat_state WHERE session_id = ?', (session_id,))
-        result = cursor.fetchone()
-        
-        # Convert initiative order to JSON
-        initiative_order = json.dumps(combat_data.get('initiative_order', []))
-        current_combatant = combat_data.get('current_combatant', '')
-        round_num = combat_data.get('round', 1)
-        
-        if result:
-            combat_id = result['combat_id']
-            # Update existing combat state
-            cursor.execute('''
-            UPDATE combat_state 
-            SET is_in_combat = ?, initiative_order = ?, current_combatant = ?, 
-                round = ?, updated_at = ?
-            WHERE combat_id = ?
-            ''', (is_in_combat, initiative_order, current_combatant, round_num, now, combat_id))
-        else:
-            # Create new combat state
-            combat_id = str(uuid.uuid4())
-            cursor.execute('''
-            INSERT INTO combat_state
-            (combat_id, session_id, is_in_combat, initiative_order, current_combatant, 
-             round, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (combat_id, session_id, is_in_combat, initiative_order, current_combatant, 
-                 round_num, now, now))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+        
+            now = datetime.now()
+            is_in_combat = combat_data.get('is_in_combat', False)
+        
+            # Check if combat state already exists
+            cursor.execute('SELECT combat_id FROM combat_state WHERE session_id = ?', (session_id,))
+            result = cursor.fetchone()
+        
+            # Convert initiative order to JSON
+            initiative_order = json.dumps(combat_data.get('initiative_order', []))
+            current_combatant = combat_data.get('current_combatant', '')
+            round_num = combat_data.get('round', 1)
+        
+            if result:
+                combat_id = result['combat_id']
+                # Update existing combat state
+                cursor.execute('''
+                UPDATE combat_state 
+                SET is_in_combat = ?, initiative_order = ?, current_combatant = ?, 
+                    round = ?, updated_at = ?
+                WHERE combat_id = ?
+                ''', (is_in_combat, initiative_order, current_combatant, round_num, now, combat_id))
+            else:
+                # Create new combat state
+                combat_id = str(uuid.uuid4())
+                cursor.execute('''
+                INSERT INTO combat_state
+                (combat_id, session_id, is_in_combat, initiative_order, current_combatant, 
+                 round, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (combat_id, session_id, is_in_combat, initiative_order, current_combatant, 
+                     round_num, now, now))
+        
+            conn.commit()
         
         return combat_id
     
+    @timed(DB_SECONDS)
     def get_combat_state(self, session_id):
         """Get the current combat state for a session."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        with self.connection() as conn:
+            return self._read_combat_state(conn.cursor(), session_id)
+    
+    def _read_combat_state(self, cursor, session_id):
         cursor.execute('''
         SELECT combat_id, is_in_combat, initiative_order, current_combatant, round
         FROM combat_state WHERE session_id = ?
         ''', (session_id,))
         
         result = cursor.fetchone()
-        conn.close()
         
         if not result:
             return {'is_in_combat': False}
@@ -608,4 +1029,201 @@ class DatabaseManager:
         else:
             combat_state['initiative_order'] = []
         
-        return combat_state
\ No newline at end of file
+        return combat_state
+    
+    # Durable queue for vector memories waiting to be embedded
+    
+    @timed(DB_SECONDS)
+    def enqueue_memory(self, session_id, kind, payload, owner=None):
+        """Persist a pending vector memory, claimed by owner, and return its queue id."""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+            INSERT INTO memory_queue (session_id, kind, payload, created_at, claimed_by, claimed_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (session_id, kind, json.dumps(payload), datetime.now(), owner, time.time()))
+            
+            conn.commit()
+            
+            return cursor.lastrowid
+    
+    @timed(DB_SECONDS)
+    def enqueue_memories(self, session_id, entries, owner=None):
+        """Persist several pending vector memories of a session with one commit; return their queue ids."""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            now = datetime.now()
+            claimed_at = time.time()
+            queue_ids = []
+            
+            for kind, payload in entries:
+                cursor.execute('''
+                INSERT INTO memory_queue (session_id, kind, payload, created_at, claimed_by, claimed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ''', (session_id, kind, json.dumps(payload), now, owner, claimed_at))
+                queue_ids.append(cursor.lastrowid)
+            
+            conn.commit()
+            
+            return queue_ids
+    
+    @timed(DB_SECONDS)
+    def claim_memories(self, owner, lease_seconds):
+        """
+        Claim the queued vector memories that nobody holds, or whose claim was
+        not renewed for lease_seconds (their process died), and return them
+        oldest first. The claim is one UPDATE, so two processes never get the
+        same row.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            now = time.time()
+            
+            cursor.execute('''
+            UPDATE memory_queue SET claimed_by = ?, claimed_at = ?
+            WHERE claimed_by IS NULL OR claimed_at IS NULL OR claimed_at < ?
+            RETURNING queue_id, session_id, kind, payload
+            ''', (owner, now, now - lease_seconds))
+            rows = cursor.fetchall()
+            
+            conn.commit()
+            
+            return [
+                {
+                    'queue_id': row['queue_id'],
+                    'session_id': row['session_id'],
+                    'kind': row['kind'],
+                    'payload': json.loads(row['payload'])
+                }
+                for row in sorted(rows, key=lambda row: row['queue_id'])
+            ]
+    
+    @timed(DB_SECONDS)
+    def renew_memory_claims(self, owner):
+        """Keep owner's claims on its queued vector memories from expiring."""
+        with self.connection() as conn:
+            conn.execute('UPDATE memory_queue SET claimed_at = ? WHERE claimed_by = ?', (time.time(), owner))
+            conn.commit()
+    
+    @timed(DB_SECONDS)
+    def drop_queued_conversations(self, session_id, covers_until):
+        """
+        Remove a session's queued conversation memories written up to
+        covers_until, so they aren't ingested after a summary replaced them.
+        Returns how many were removed.
+        """
+        cutoff = datetime.fromisoformat(str(covers_until))
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+            SELECT queue_id, payload FROM memory_queue
+            WHERE session_id = ? AND kind = 'conversation'
+            ''', (session_id,))
+            covered = []
+            for row in cursor.fetchall():
+                timestamp = json.loads(row['payload']).get('timestamp')
+                if timestamp and datetime.fromisoformat(timestamp) <= cutoff:
+                    covered.append((row['queue_id'],))
+            
+            cursor.executemany('DELETE FROM memory_queue WHERE queue_id = ?', covered)
+            conn.commit()
+            
+            return len(covered)
+    
+    @timed(DB_SECONDS)
+    def delete_memories(self, queue_ids):
+        """Remove vector memories from the queue once they are stored."""
+        if not queue_ids:
+            return
+        
+        with self.connection() as conn:
+            conn.executemany('DELETE FROM memory_queue WHERE queue_id = ?', [(qid,) for qid in queue_ids])
+            conn.commit()
+    
+    @timed(DB_SECONDS)
+    def reserve_memory_seq(self, session_id, count=1):
+        """
+        Reserve count consecutive ordinals for a session's conversation
+        memories and return the first. Ordinals start at 1 and only increase;
+        rank_by_recency scores a memory by how far it is behind get_memory_seq().
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # The insert opens the transaction, so the read below sees our own update
+            cursor.execute('''
+            INSERT INTO memory_sequences (session_id, last_seq) VALUES (?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET last_seq = last_seq + excluded.last_seq
+            ''', (session_id, count))
+            cursor.execute('SELECT last_seq FROM memory_sequences WHERE session_id = ?', (session_id,))
+            last_seq = cursor.fetchone()['last_seq']
+            
+            conn.commit()
+            
+            return last_seq - count + 1
+    
+    def get_memory_seq(self, session_id):
+        """Highest conversation-memory ordinal reserved for a session (0 if none)."""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT last_seq FROM memory_sequences WHERE session_id = ?', (session_id,))
+            result = cursor.fetchone()
+            return result['last_seq'] if result else 0
+    
+    # Which snapshot attribute each table feeds, and how to re-read it
+    SNAPSHOT_TABLES = {
+        'sessions': ('game_state', '_read_game_state'),
+        # summaries before messages: the message window starts after the summary
+        'summaries': ('summary', '_read_summary'),
+        'messages': ('messages', '_read_messages'),
+        'characters': ('character', '_read_character'),
+        'locations': ('locations', '_read_locations'),
+        'npcs': ('npcs', '_read_npcs'),
+        'quests': ('quests', '_read_quests'),
+        'combat_state': ('combat_state', '_read_combat_state'),
+    }
+    
+    @timed(DB_SECONDS)
+    def load_session_snapshot(self, session_id):
+        """
+        Load the game state, summary and message history, character, world and combat state
+        for a session using one connection and one read transaction, so every
+        part of the snapshot reflects the same committed state.
+        """
+        return self.refresh_session_snapshot(SessionSnapshot(session_id=session_id))
+    
+    @timed(DB_SECONDS)
+    def refresh_session_snapshot(self, snapshot, tables=None):
+        """
+        Re-read the given tables into an existing snapshot in one transaction.
+        tables defaults to every table; pass only the tables a turn wrote to
+        (see FunctionHandler.tables_touched) to skip the ones that can't have changed.
+        """
+        tables = self.SNAPSHOT_TABLES.keys() if tables is None else tables
+        tables = [table for table in self.SNAPSHOT_TABLES if table in tables]
+        if not tables:
+            return snapshot
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            # Inside transaction() the reads already share its transaction
+            own_transaction = not conn.in_transaction
+            if own_transaction:
+                cursor.execute('BEGIN')
+            try:
+                for table in tables:
+                    attribute, reader = self.SNAPSHOT_TABLES[table]
+                    if table == 'messages' and snapshot.summary:
+                        # Messages already folded into the summary are not sent again
+                        value = self._read_messages(cursor, snapshot.session_id,
+                                                    after=snapshot.summary['covers_until'])
+                    else:
+                        value = getattr(self, reader)(cursor, snapshot.session_id)
+                    setattr(snapshot, attribute, value)
+            finally:
+                if own_transaction:
+                    conn.commit()
+        
+        return snapshot
@@ -0,0 +1,285 @@
+# embedding.py
+# The one text embedder used by the vector database. It is passed to every
+# Chroma collection as its embedding function, so documents and queries are
+# encoded by our SentenceTransformer (batched, on the configured device and
+# backend) instead of Chroma loading a second copy of the model.
+import os
+import array
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from chromadb.api.types import EmbeddingFunction, Documents
+from sentence_transformers import SentenceTransformer
+from metrics import registry
+
+logger = logging.getLogger('dnd_gm_assistant.embedding')
+
+CACHE_LOOKUPS = registry.counter(
+    'dnd_embedding_cache_lookups_total', 'Embedding cache lookups by outcome', ('result',)
+)
+CACHE_EVICTIONS = registry.counter(
+    'dnd_embedding_cache_evictions_total', 'Vectors dropped from the embedding cache'
+)
+
+DEFAULT_MODEL = 'all-MiniLM-L6-v2'  # A lightweight, fast model
+
+# ONNX weights to load for each backend; the int8 files ship with the model repo
+ONNX_FILES = {
+    'onnx': None,  # Let sentence-transformers pick onnx/model.onnx
+    'onnx-int8': 'onnx/model_quint8_avx2.onnx',
+}
+
+def content_hash(text, namespace=''):
+    """Stable key for a piece of text (and the model that embeds it)."""
+    return hashlib.sha256(f"{namespace}\0{text}".encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, max_entries=4096, path=None, max_disk_entries=100000):
+        """
+        Two-tier cache of embedding vectors keyed by content hash: an LRU of up
+        to max_entries vectors in memory and, when path is set, a SQLite file
+        holding up to max_disk_entries more that survives restarts.
+        """
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        self.path = path
+        self._disk = None
+        self._disk_entries = 0
+        self._pid = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._open_disk()
+    
+    def _open_disk(self):
+        self._pid = os.getpid()
+        self._disk = sqlite3.connect(self.path, check_same_thread=False)
+        self._disk.execute('''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            vector BLOB NOT NULL,
+            last_used REAL NOT NULL
+        )
+        ''')
+        self._disk.execute('CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)')
+        self._disk.commit()
+        self._disk_entries = self._disk.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+    
+    def _check_fork(self):
+        # A SQLite connection must not be used across fork (the embedder is
+        # preloaded in the gunicorn master): a forked worker opens its own and
+        # leaves the inherited one alone rather than closing the parent's locks
+        if self._disk is not None and self._pid != os.getpid():
+            self._open_disk()
+    
+    def get(self, key):
+        """Return the cached vector for key, or None."""
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(result="hit")
+                return vector
+            
+            self._check_fork()
+            if self._disk is not None:
+                row = self._disk.execute('SELECT vector FROM embeddings WHERE key = ?', (key,)).fetchone()
+                if row:
+                    vector = array.array('f', row[0]).tolist()
+                    self._disk.execute('UPDATE embeddings SET last_used = ? WHERE key = ?', (time.time(), key))
+                    self._disk.commit()
+                    self._remember(key, vector)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    CACHE_LOOKUPS.inc(result="disk_hit")
+                    return vector
+            
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result="miss")
+            return None
+    
+    def put(self, key, vector):
+        with self._lock:
+            self._remember(key, vector)
+            self._check_fork()
+            if self._disk is not None:
+                cursor = self._disk.execute(
+                    'INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)',
+                    (key, array.array('f', vector).tobytes(), time.time())
+                )
+                self._disk_entries += cursor.rowcount
+                if self._disk_entries > self.max_disk_entries:
+                    # Drop the least recently used tenth in one go rather than one row per insert
+                    excess = self._disk_entries - self.max_disk_entries + self.max_disk_entries // 10
+                    self._disk.execute('''
+                    DELETE FROM embeddings WHERE key IN (
+                        SELECT key FROM embeddings ORDER BY last_used LIMIT ?
+                    )
+                    ''', (excess,))
+                    self._disk_entries = self._disk.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+                    self.evictions += excess
+                    CACHE_EVICTIONS.inc(excess)
+                self._disk.commit()
+    
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            if self._disk is None:
+                self.evictions += 1
+                CACHE_EVICTIONS.inc()
+    
+    def stats(self):
+        """Hit/miss counters and current sizes."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "disk_entries": self._disk_entries,
+            }
+    
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+class SentenceTransformerEmbedder(EmbeddingFunction[Documents]):
+    def __init__(self, model_name=DEFAULT_MODEL, device=None, backend='torch', batch_size=64,
+                 threads=None, onnx_file=None, cache=None):
+        """
+        backend is 'torch', 'onnx' or 'onnx-int8' (quantized). The ONNX backends
+        need the sentence-transformers[onnx] extra; without it we fall back to
+        torch. threads caps the CPU threads used for inference. With an
+        EmbeddingCache, text that was embedded before is not encoded again.
+        Embeddings are normalized, like Chroma's default embedder, so vectors
+        already stored in existing collections stay comparable.
+        """
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.backend = backend
+        self.cache = cache
+        self._lock = threading.Lock()
+        
+        if threads:
+            # ONNX Runtime reads this when its session is created
+            os.environ.setdefault('OMP_NUM_THREADS', str(threads))
+            try:
+                import torch
+                torch.set_num_threads(int(threads))
+            except ImportError:
+                pass
+        
+        self.model = self._load(model_name, device, backend, onnx_file)
+    
+    def _load(self, model_name, device, backend, onnx_file):
+        if backend == 'torch':
+            return SentenceTransformer(model_name, device=device)
+        
+        if backend not in ONNX_FILES:
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        
+        model_kwargs = {}
+        file_name = onnx_file or ONNX_FILES[backend]
+        if file_name:
+            model_kwargs['file_name'] = file_name
+        
+        try:
+            return SentenceTransformer(model_name, device=device, backend='onnx', model_kwargs=model_kwargs)
+        except Exception as e:
+            logger.warning(f"Could not load {backend} embedding backend, using torch: {str(e)}")
+            self.backend = 'torch'
+            return SentenceTransformer(model_name, device=device)
+    
+    def __call__(self, input):
+        """Chroma entry point: embed a batch of documents or query texts."""
+        return self.embed(list(input))
+    
+    def embed(self, texts):
+        """Encode texts in batches of batch_size and return one vector per text."""
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._encode(texts)
+        
+        # Look everything up first, then encode each missing text once
+        keys = [content_hash(text, self.model_name) for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+        missing = OrderedDict()
+        for text, key, vector in zip(texts, keys, vectors):
+            if vector is None:
+                missing.setdefault(key, text)
+        
+        if missing:
+            encoded = dict(zip(missing, self._encode(list(missing.values()))))
+            for key, vector in encoded.items():
+                self.cache.put(key, vector)
+            vectors = [vector if vector is not None else encoded[key] for key, vector in zip(keys, vectors)]
+        
+        return vectors
+    
+    def _encode(self, texts):
+        # A single model instance is shared by the request thread and the ingestion workers
+        with self._lock:
+            vectors = self.model.encode(
+                texts,
+                batch_size=self.batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=False
+            )
+        return [vector.tolist() for vector in vectors]
+    
+    def embed_query(self, text):
+        """Encode a single query string."""
+        return self.embed([text])[0]
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+def get_embedder():
+    """
+    Return the process-wide embedder, created on first use from
+    EMBEDDING_MODEL, EMBEDDING_DEVICE, EMBEDDING_BACKEND, EMBEDDING_BATCH_SIZE,
+    EMBEDDING_THREADS and EMBEDDING_ONNX_FILE. EMBEDDING_CACHE_SIZE sets the
+    in-memory cache size (0 disables caching) and EMBEDDING_CACHE_PATH adds
+    the on-disk tier.
+    """
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            threads = os.environ.get('EMBEDDING_THREADS')
+            cache_size = int(os.environ.get('EMBEDDING_CACHE_SIZE', 4096))
+            cache = None
+            if cache_size > 0:
+                cache = EmbeddingCache(
+                    max_entries=cache_size,
+                    path=os.environ.get('EMBEDDING_CACHE_PATH') or None,
+                    max_disk_entries=int(os.environ.get('EMBEDDING_CACHE_DISK_ENTRIES', 100000))
+                )
+            _embedder = SentenceTransformerEmbedder(
+                model_name=os.environ.get('EMBEDDING_MODEL', DEFAULT_MODEL),
+                device=os.environ.get('EMBEDDING_DEVICE') or None,
+                backend=os.environ.get('EMBEDDING_BACKEND', 'torch'),
+                batch_size=int(os.environ.get('EMBEDDING_BATCH_SIZE', 64)),
+                threads=int(threads) if threads else None,
+                onnx_file=os.environ.get('EMBEDDING_ONNX_FILE') or None,
+                cache=cache
+            )
+            logger.info(f"Loaded embedding model {_embedder.model_name} ({_embedder.backend} backend)")
+        return _embedder
@@ -1,48 +1,177 @@
 # function_handler.py
 import json
-import re
 import random
+import threading
+from collections import defaultdict
 from datetime import datetime
+from metrics import registry
+from function_parser import FunctionCallScanner, extract_function_calls
+
+FUNCTION_CALLS = registry.counter(
+    'dnd_function_calls_total', 'Function calls from model responses that were executed', ('function',)
+)
+FUNCTION_FAILURES = registry.counter(
+    'dnd_function_call_failures_total', 'Function calls that returned an error', ('function',)
+)
+FUNCTION_SECONDS = registry.histogram(
+    'dnd_function_call_seconds', 'Time spent executing each function call', ('function',)
+)
+FUNCTION_BATCHES = registry.counter(
+    'dnd_function_batches_total', 'Function calls of one model response executed together, by outcome', ('result',)
+)
+
+class FunctionBatchError(Exception):
+    """A call in a batch failed, so none of the batch is applied."""
 
 class FunctionHandler:
-    def __init__(self, db_manager, vector_db_manager=None):
+    # SQLite tables each function writes to, used to refresh only what changed
+    FUNCTION_TABLES = {
+        'update_character': ['characters'],
+        'add_world_location': ['locations'],
+        'add_npc': ['npcs'],
+        'update_quest': ['quests'],
+        'update_combat_state': ['combat_state', 'sessions'],
+        'start_adventure': ['sessions'],
+    }
+    
+    def __init__(self, db_manager, vector_db_manager=None, memory_queue=None):
         self.db = db_manager
         self.vector_db = vector_db_manager  # Add vector DB manager
+        self.memory_queue = memory_queue  # Embeds vector memories in the background when set
+        # Entity memories collected by the calling thread's execute_calls()
+        self._batch = threading.local()
     
     def parse_and_execute_functions(self, ai_response, session_id):
         """Parse the AI response for function calls and execute them."""
-        # Extract all function calls using regex pattern
-        # Original pattern for backward compatibility
-        function_pattern = r'```function\s+(\w+)\s*\((.*?)\)\s*```'
-        function_calls = re.findall(function_pattern, ai_response, re.DOTALL)
+        # One pass finds the calls and removes them from the text shown to the player
+        cleaned_response, function_calls = extract_function_calls(ai_response)
+        results = self.execute_calls(function_calls, session_id)
         
-        # Alternative pattern without code blocks
-        alt_function_pattern = r'function\s+(\w+)\s*\((.*?)\)'
-        function_calls.extend(re.findall(alt_function_pattern, ai_response, re.DOTALL))
+        # Return the cleaned response and function results
+        return cleaned_response, results
+    
+    def execute_calls(self, calls, session_id):
+        """
+        Execute the calls of one model response. Calls to unknown functions
+        or with arguments that aren't an object are rejected up front and
+        don't affect the others. The valid calls run as a unit: their writes
+        share one SQLite transaction and commit once, and their entity
+        memories are queued together after it. If one of them fails to apply,
+        none of them is, and the results of the others say so.
+        """
+        results = [None] * len(calls)
+        valid = []
+        for index, (func_name, func_args_str) in enumerate(calls):
+            args, rejected = self._check_call(func_name, func_args_str)
+            if rejected:
+                results[index] = self._record(func_name, rejected)
+            else:
+                valid.append((index, func_name, args))
+        if not valid:
+            return results
         
-        results = []
+        memories = self._batch.memories = []
+        try:
+            with self.db.transaction():
+                for index, func_name, args in valid:
+                    results[index] = self._run_call(func_name, args, session_id)
+                failure = next((results[index]['error'] for index, _, _ in valid
+                                if results[index].get('error')), None)
+                if failure:
+                    raise FunctionBatchError(failure)
+                self._store_memories(session_id, memories)
+        except Exception as e:
+            FUNCTION_BATCHES.inc(result='rolled_back')
+            # Failed calls keep their own error
+            for index, func_name, _ in valid:
+                if not (results[index] or {}).get('error'):
+                    results[index] = {
+                        'success': False,
+                        'function': func_name,
+                        'error': f"Not applied, another call in the same response failed: {e}"
+                    }
+        else:
+            FUNCTION_BATCHES.inc(result='committed')
+        finally:
+            self._batch.memories = None
         
-        for func_name, func_args_str in function_calls:
-            # Try to parse arguments as JSON, fallback to simpler parsing if it fails
-            try:
-                func_args = json.loads(func_args_str)
-            except json.JSONDecodeError:
-                # Simple parsing for key-value pairs: key: value format
-                func_args = {}
-                for line in func_args_str.split('\n'):
-                    line = line.strip()
-                    if ':' in line:
-                        key, value = line.split(':', 1)
-                        func_args[key.strip()] = value.strip()
-            
-            # Execute the function if it exists
-            result = self._execute_function(func_name, func_args, session_id)
-            results.append(result)
+        return results
+    
+    def _store_memories(self, session_id, memories):
+        """Queue a batch's entity memories in its transaction, or write them once it commits."""
+        if not memories:
+            return
+        if self.memory_queue:
+            self.memory_queue.enqueue_many(session_id, memories)
+            return
         
-        # Return the cleaned response and function results
-        cleaned_response = re.sub(function_pattern, '', ai_response)
-        cleaned_response = re.sub(alt_function_pattern, '', cleaned_response)
-        return cleaned_response, results
+        by_kind = defaultdict(list)
+        for kind, data in memories:
+            by_kind[kind].append(data)
+        
+        def upsert():
+            for kind, records in by_kind.items():
+                self.vector_db.upsert_entities(session_id, kind, records)
+        self.db.on_commit(upsert)
+    
+    def strip_function_calls(self, ai_response):
+        """Remove function calls from the text shown to the player."""
+        return extract_function_calls(ai_response)[0]
+    
+    def stream_parser(self):
+        """Create an incremental parser for a streamed response."""
+        return FunctionCallScanner()
+    
+    def _check_call(self, func_name, func_args_str):
+        """Return (arguments, None) for a call that can run, or (None, error result) for one that can't."""
+        if func_name not in self.FUNCTION_TABLES:
+            return None, {'error': f"Unknown function: {func_name}"}
+        args = self._parse_arguments(func_args_str)
+        if not isinstance(args, dict):
+            return None, {'success': False, 'function': func_name, 'error': 'Arguments must be an object'}
+        return args, None
+    
+    def _run_call(self, func_name, args, session_id):
+        with FUNCTION_SECONDS.time(function=func_name):
+            result = self._execute_function(func_name, args, session_id)
+        return self._record(func_name, result)
+    
+    def _record(self, func_name, result):
+        # Unknown names all share one label so model typos can't grow the series
+        label = func_name if func_name in self.FUNCTION_TABLES else 'unknown'
+        FUNCTION_CALLS.inc(function=label)
+        if result.get('error'):
+            FUNCTION_FAILURES.inc(function=label)
+        return result
+    
+    def _parse_arguments(self, func_args_str):
+        if isinstance(func_args_str, dict):
+            return func_args_str
+        
+        # Try to parse arguments as JSON, fallback to simpler parsing if it fails
+        try:
+            return json.loads(func_args_str)
+        except json.JSONDecodeError:
+            # Simple parsing for key-value pairs: key: value format
+            func_args = {}
+            for line in func_args_str.split('\n'):
+                line = line.strip()
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    func_args[key.strip()] = value.strip()
+            return func_args
+    
+    def tables_touched(self, function_results):
+        """Return the set of tables written by the executed function calls."""
+        tables = set()
+        for result in function_results:
+            tables.update(self.FUNCTION_TABLES.get(result.get('function'), []))
+        return tables
+    
+    def _remember(self, kind, session_id, data):
+        """Collect an entity memory; execute_calls() stores the batch's memories once they commit."""
+        if self.memory_queue or self.vector_db:
+            self._batch.memories.append((kind, data))
     
     def _execute_function(self, func_name, args, session_id):
         """Execute a function with the given name and arguments."""
@@ -68,8 +197,7 @@ class FunctionHandler:
             character_id = self.db.save_character(session_id, args)
             
             # Also store in vector DB if available
-            if self.vector_db:
-                vector_character_id = self.vector_db.add_character_memory(session_id, args)
+            self._remember('character', session_id, args)
             
             return {
                 'success': True,
@@ -89,8 +217,7 @@ class FunctionHandler:
             location_id = self.db.add_location(session_id, args)
             
             # Also store in vector DB if available
-            if self.vector_db:
-                vector_location_id = self.vector_db.add_location_memory(session_id, args)
+            self._remember('location', session_id, args)
             
             return {
                 'success': True,
@@ -111,8 +238,7 @@ class FunctionHandler:
             npc_id = self.db.add_npc(session_id, args)
             
             # Also store in vector DB if available
-            if self.vector_db:
-                vector_npc_id = self.vector_db.add_npc_memory(session_id, args)
+            self._remember('npc', session_id, args)
             
             return {
                 'success': True,
@@ -133,8 +259,7 @@ class FunctionHandler:
             quest_id = self.db.update_quest(session_id, args)
             
             # Also store in vector DB if available
-            if self.vector_db:
-                vector_quest_id = self.vector_db.add_quest_memory(session_id, args)
+            self._remember('quest', session_id, args)
             
             return {
                 'success': True,
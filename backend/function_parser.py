@@ -0,0 +1,249 @@
+# function_parser.py
+# Extracts function calls from model output in a single left-to-right pass.
+# The model writes calls either fenced:
+#
+#   ```function
+#   update_character({"name": "Mira", "class": "Rogue"})
+#   ```
+#
+# or bare in the narrative: function add_npc({"name": "Old Tom"}). The
+# scanner returns the narrative with the calls removed together with the
+# calls it found. Arguments end at the parenthesis that balances the opening
+# one, ignoring parentheses inside JSON strings, so "(retired)" in a
+# description doesn't cut a call short. A fenced block is consumed whole, so
+# the calls inside it are never picked up a second time as bare calls. The
+# same scanner works on a streamed response, one chunk at a time.
+import re
+
+FENCE = '```'
+FENCE_START = '```function'
+KEYWORD = 'function'
+
+# Where a call may start; at a fence "```function" matches before the keyword inside it
+CALL_START = re.compile(r'```function|function')
+# The name and opening parenthesis after the keyword (which a fenced block may repeat)
+CALL_HEADER = re.compile(r'\s+(?:function\s+)?(\w+)\s*\(')
+# Another call within a fenced block, with or without the keyword again
+NEXT_CALL_HEADER = re.compile(r'\s*(?:function\s+)?(\w+)\s*\(')
+FENCE_END = re.compile(r'\s*```')
+# Outside strings only parentheses and quotes matter inside the arguments
+ARGUMENT_TOKEN = re.compile(r'[()"]')
+# The rest of a JSON string, up to (not including) its closing quote
+STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+# Arguments without nested parentheses, up to the closing one, in a single match
+FLAT_ARGUMENTS = re.compile(r'(?:[^()"]|"[^"\\]*(?:\\.[^"\\]*)*")*\)', re.DOTALL)
+# Text that could still grow into a header (or a closing fence) in a later chunk
+PARTIAL_HEADER = re.compile(r'(?:\s+(?:\w+\s*){0,2})?')
+PARTIAL_NEXT = re.compile(r'\s*(?:(?:\w+\s*){0,2}|`{1,2})')
+
+# Arguments longer than this are not taken for a call. This bounds the text
+# an unbalanced parenthesis can hold back while streaming, and the text that
+# is scanned again once the call is rejected.
+MAX_ARGUMENT_CHARS = 8192
+
+# Scanner states
+TEXT, HEADER, ARGUMENTS, AFTER_CALL, SKIP_BLOCK = range(5)
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+class FunctionCallScanner:
+    """
+    Single-pass function call extraction. feed() consumes a chunk and returns
+    (narrative text, [(name, args_str), ...]) for everything that can be
+    decided so far; text that might still be part of a call is held back
+    until a later chunk or finish() settles it. Scanning resumes where the
+    previous chunk stopped, so a response costs time linear in its length
+    however it is split.
+    
+    A fenced block that is never closed is dropped from the text (the model
+    ran out of tokens inside it); its complete calls still count. A bare call
+    whose parentheses never balance is left in the text.
+    """
+    def __init__(self, max_argument_chars=MAX_ARGUMENT_CHARS):
+        self.max_argument_chars = max_argument_chars
+        self._buffer = ''      # text not returned yet
+        self._before = ''      # the character preceding the buffer
+        self._state = TEXT
+        self._pos = 0          # where scanning resumes in the buffer
+        self._call_start = 0   # start of the call (or fenced block) being read
+        self._fenced = False
+        self._name = None
+        self._args_start = 0
+        self._depth = 0
+        self._in_string = False
+        self._block_calls = [] # calls read so far in the current fenced block
+    
+    def feed(self, chunk):
+        """Consume a chunk; return (text ready to display, [(name, args_str), ...])."""
+        self._buffer += chunk
+        return self._scan(final=False)
+    
+    def finish(self):
+        """Settle whatever is held back once the response has ended."""
+        return self._scan(final=True)
+    
+    def _held_suffix_length(self, text, start):
+        """Length of the tail of text[start:] that could still grow into a call start."""
+        if len(text) == start or text[-1] not in FENCE_START:
+            return 0
+        for length in range(min(len(text) - start, len(FENCE_START)), 0, -1):
+            tail = text[-length:]
+            if FENCE_START.startswith(tail) or KEYWORD.startswith(tail):
+                return length
+        return 0
+    
+    def _open_arguments(self, header):
+        self._name = header.group(1)
+        self._args_start = header.end()
+        self._depth = 1
+        self._in_string = False
+        self._state = ARGUMENTS
+        return header.end()
+    
+    def _scan_arguments(self, buffer, pos):
+        """
+        Advance through the arguments; return (position, closed). When closed
+        the position is that of the balancing ")"; otherwise it is where to
+        resume once more text arrives.
+        """
+        limit = min(len(buffer), self._args_start + self.max_argument_chars)
+        if pos == self._args_start:
+            # Most calls have no nested parentheses and arrive whole
+            flat = FLAT_ARGUMENTS.match(buffer, pos, limit)
+            if flat:
+                return flat.end() - 1, True
+        depth = self._depth
+        in_string = self._in_string
+        while True:
+            if in_string:
+                # Skip to the closing quote, stopping short of an escape split across chunks
+                pos = STRING_BODY.match(buffer, pos, limit).end()
+                if pos == limit or buffer[pos] != '"':
+                    break
+                pos += 1
+                in_string = False
+                continue
+            token = ARGUMENT_TOKEN.search(buffer, pos, limit)
+            if token is None:
+                pos = limit
+                break
+            char = token.group()
+            pos = token.end()
+            if char == '"':
+                in_string = True
+            elif char == '(':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return token.start(), True
+        self._depth = depth
+        self._in_string = in_string
+        return pos, False
+    
+    def _scan(self, final):
+        buffer = self._buffer
+        pos = self._pos
+        emitted = 0  # buffer[:emitted] has been returned as text or dropped
+        output = []
+        calls = []
+        
+        while True:
+            state = self._state
+            
+            if state == TEXT:
+                match = CALL_START.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer) if final else len(buffer) - self._held_suffix_length(buffer, pos)
+                    break
+                start = match.start()
+                if match.group() == KEYWORD and _is_word_char(buffer[start - 1] if start else self._before):
+                    # Part of a longer word, like "malfunction"
+                    pos = match.end()
+                    continue
+                self._call_start = start
+                self._fenced = match.group() == FENCE_START
+                self._block_calls = []
+                self._state = HEADER
+                pos = match.end()
+            
+            elif state == HEADER:
+                header = CALL_HEADER.match(buffer, pos)
+                if header:
+                    pos = self._open_arguments(header)
+                elif not final and PARTIAL_HEADER.fullmatch(buffer, pos):
+                    break
+                elif self._fenced:
+                    self._state = SKIP_BLOCK
+                else:
+                    # Just the word "function" in the narrative
+                    self._state = TEXT
+                    pos = self._call_start + len(KEYWORD)
+            
+            elif state == ARGUMENTS:
+                pos, closed = self._scan_arguments(buffer, pos)
+                if closed:
+                    call = (self._name, buffer[self._args_start:pos])
+                    pos += 1
+                    if self._fenced:
+                        self._block_calls.append(call)
+                        self._state = AFTER_CALL
+                    else:
+                        output.append(buffer[emitted:self._call_start])
+                        calls.append(call)
+                        emitted = pos
+                        self._state = TEXT
+                elif not final and len(buffer) - self._args_start < self.max_argument_chars:
+                    break
+                elif self._fenced:
+                    # Unbalanced; drop the block up to its closing fence
+                    self._state = SKIP_BLOCK
+                    pos = self._args_start
+                else:
+                    # Unbalanced, so not a call after all
+                    self._state = TEXT
+                    pos = self._call_start + len(KEYWORD)
+            
+            elif state == AFTER_CALL:
+                end = FENCE_END.match(buffer, pos)
+                header = None if end else NEXT_CALL_HEADER.match(buffer, pos)
+                if end:
+                    output.append(buffer[emitted:self._call_start])
+                    calls.extend(self._block_calls)
+                    emitted = pos = end.end()
+                    self._state = TEXT
+                elif header:
+                    pos = self._open_arguments(header)
+                elif not final and PARTIAL_NEXT.fullmatch(buffer, pos):
+                    break
+                else:
+                    self._state = SKIP_BLOCK
+            
+            else:  # SKIP_BLOCK: a malformed function block, dropped up to its closing fence
+                end = buffer.find(FENCE, pos)
+                if end < 0 and not final:
+                    pos = max(pos, len(buffer) - len(FENCE) + 1)
+                    break
+                output.append(buffer[emitted:self._call_start])
+                calls.extend(self._block_calls)
+                emitted = pos = len(buffer) if end < 0 else end + len(FENCE)
+                self._state = TEXT
+        
+        # Return what is decided and keep the rest for the next chunk
+        keep = pos if self._state == TEXT else self._call_start
+        output.append(buffer[emitted:keep])
+        if keep:
+            self._before = buffer[keep - 1]
+        self._buffer = buffer[keep:]
+        self._pos = pos - keep
+        self._call_start -= keep
+        self._args_start -= keep
+        return ''.join(output), calls
+
+def extract_function_calls(text):
+    """Scan a complete response; return (text without the calls, [(name, args_str), ...])."""
+    scanner = FunctionCallScanner()
+    cleaned, calls = scanner.feed(text)
+    rest, more = scanner.finish()
+    return cleaned + rest, calls + more
@@ -0,0 +1,52 @@
+# gunicorn.conf.py
+# Production serving: several worker processes behind one port.
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#   WEB_CONCURRENCY=4 GUNICORN_THREADS=16 CHROMA_HOST=localhost gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Settings come from the environment:
+#   BIND               address to listen on (default 0.0.0.0:5000)
+#   WEB_CONCURRENCY    worker processes (default 2)
+#   GUNICORN_THREADS   request threads per worker (default 8); a turn mostly
+#                      waits on the model, and /chat/stream holds its thread
+#                      for the whole generation
+#   GUNICORN_TIMEOUT   seconds a worker may go silent before it is restarted
+#                      (default 300, to match the model read timeout)
+#   CHROMA_HOST/PORT   Chroma server shared by the workers. Embedded Chroma
+#                      (chroma_db) must only be opened by one process, so run
+#                      `chroma run --path chroma_db` and set CHROMA_HOST
+#                      whenever WEB_CONCURRENCY is above 1.
+#
+# SQLite (game_data.db) is opened separately by every worker after the fork;
+# WAL mode lets the workers read while one of them writes. /metrics reports
+# the worker that answers the scrape.
+import os
+
+# Forked workers must not inherit tokenizer thread pools from the master
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "300"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# Import the app (and load the embedding model) once, before forking
+preload_app = True
+
+def post_fork(server, worker):
+    # Every worker gets its own database connections, Chroma client and background threads
+    import app
+    app.create_app()
+
+def worker_exit(server, worker):
+    # Finish queued summaries and memories before the worker goes away
+    import app
+    app.shutdown_services()
+
+def on_starting(server):
+    if workers > 1 and not os.environ.get("CHROMA_HOST"):
+        server.log.warning("Several workers share chroma_db without CHROMA_HOST; run a Chroma server "
+                           "and set CHROMA_HOST to avoid concurrent writers")
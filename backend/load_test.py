@@ -0,0 +1,175 @@
+# load_test.py
+# Drives concurrent synthetic players through the API and reports throughput,
+# tail latency and where each /chat turn spent its time. Run it against the
+# app pointed at stub_llm_server.py to measure everything but the model:
+#
+#   python stub_llm_server.py --latency 0.5 &
+#   python app.py &
+#   python load_test.py --users 20 --turns 10
+#   python load_test.py --users 50 --duration 120 --json > load.json
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+PLAYER_MESSAGES = [
+    "I walk into the tavern and look around.",
+    "I ask the bartender about rumours in town.",
+    "I head north along the road.",
+    "I draw my sword and attack the nearest bandit.",
+    "I search the room for anything useful.",
+    "I talk to the blacksmith about the missing daughter.",
+    "I rest until morning.",
+    "What do I see in the distance?",
+]
+
+STAGES = ["db", "vector", "prompt", "model", "functions", "total"]
+
+class Recorder:
+    """Thread-safe collection of latencies per endpoint and per /chat stage."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}  # endpoint -> [ms]
+        self.stages = {}  # stage -> [ms]
+        self.errors = {}  # endpoint -> count
+        self.turns = 0
+
+    def record(self, endpoint, elapsed_ms, ok, timings=None):
+        with self._lock:
+            if ok:
+                self.latencies.setdefault(endpoint, []).append(elapsed_ms)
+            else:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            if timings:
+                self.turns += 1
+                for stage, value in timings.items():
+                    self.stages.setdefault(stage, []).append(value)
+
+def summarize(samples):
+    ordered = sorted(samples)
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+    return {
+        "count": len(ordered),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": ordered[-1],
+        "mean": statistics.fmean(ordered),
+    }
+
+def call(recorder, http, method, url, endpoint, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = http.request(method, url, timeout=300, **kwargs)
+        ok = response.status_code < 400
+        payload = response.json() if ok else None
+    except (requests.RequestException, ValueError):
+        ok = False
+        payload = None
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    timings = payload.get("timings") if endpoint == "/chat" and payload else None
+    recorder.record(endpoint, elapsed_ms, ok, timings)
+    return payload
+
+def run_player(base_url, recorder, turns, deadline, model_id, think_time, seed):
+    """One synthetic session: create it, make a character, then play turns."""
+    rng = random.Random(seed)
+    http = requests.Session()
+
+    created = call(recorder, http, "POST", f"{base_url}/session", "/session")
+    if not created:
+        return
+    session_id = created["session_id"]
+
+    call(recorder, http, "POST", f"{base_url}/character", "POST /character", json={
+        "session_id": session_id,
+        "character": {"name": f"Hero {seed}", "race": rng.choice(["Elf", "Dwarf", "Human"]),
+                      "class": rng.choice(["Fighter", "Wizard", "Rogue"]), "level": 1}
+    })
+
+    turn = 0
+    while (turns is None or turn < turns) and (deadline is None or time.monotonic() < deadline):
+        call(recorder, http, "POST", f"{base_url}/chat", "/chat", json={
+            "session_id": session_id,
+            "message": rng.choice(PLAYER_MESSAGES),
+            "model_id": model_id,
+            "timings": True
+        })
+        # Players glance at the world and character sheets between turns
+        if turn % 3 == 2:
+            call(recorder, http, "GET", f"{base_url}/world", "/world", params={"session_id": session_id})
+        if turn % 5 == 4:
+            call(recorder, http, "GET", f"{base_url}/character", "GET /character", params={"session_id": session_id})
+        turn += 1
+        if think_time:
+            time.sleep(rng.uniform(0, think_time))
+
+def run_load(base_url, users, turns, duration, model_id, think_time, ramp_up):
+    recorder = Recorder()
+    deadline = time.monotonic() + duration if duration else None
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        futures = []
+        for n in range(users):
+            futures.append(pool.submit(run_player, base_url, recorder, turns, deadline, model_id, think_time, n))
+            if ramp_up:
+                time.sleep(ramp_up / users)
+        for future in futures:
+            future.result()
+
+    elapsed = time.perf_counter() - started
+    requests_done = sum(len(values) for values in recorder.latencies.values())
+    return {
+        "config": {"url": base_url, "users": users, "turns": turns, "duration": duration,
+                   "model_id": model_id, "think_time": think_time},
+        "elapsed_seconds": elapsed,
+        "throughput": {
+            "requests_per_second": requests_done / elapsed if elapsed else 0.0,
+            "turns_per_second": len(recorder.latencies.get("/chat", [])) / elapsed if elapsed else 0.0,
+        },
+        "errors": recorder.errors,
+        "latency_ms": {endpoint: summarize(values) for endpoint, values in recorder.latencies.items()},
+        "chat_stages_ms": {stage: summarize(recorder.stages[stage]) for stage in STAGES if stage in recorder.stages},
+    }
+
+def print_report(report):
+    config = report["config"]
+    print(f"{config['users']} users against {config['url']} for {report['elapsed_seconds']:.1f}s")
+    print(f"throughput: {report['throughput']['requests_per_second']:.2f} req/s, "
+          f"{report['throughput']['turns_per_second']:.2f} turns/s")
+    if report["errors"]:
+        print(f"errors: {report['errors']}")
+
+    for title, table in (("endpoint", report["latency_ms"]), ("/chat stage", report["chat_stages_ms"])):
+        print()
+        header = f"{title:>16} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}"
+        print(header)
+        print("-" * len(header))
+        for name, stats in table.items():
+            print(f"{name:>16} {stats['count']:>7} {stats['p50']:>10.1f} {stats['p95']:>10.1f} "
+                  f"{stats['p99']:>10.1f} {stats['max']:>10.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the Game Master API")
+    parser.add_argument("--url", default="http://localhost:5000", help="Base URL of the running app")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent synthetic sessions")
+    parser.add_argument("--turns", type=int, default=10, help="Chat turns per session (ignored with --duration)")
+    parser.add_argument("--duration", type=float, help="Run for this many seconds instead of a fixed turn count")
+    parser.add_argument("--model", default="local", choices=["local", "gemini"], help="model_id sent to /chat")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Max random pause between turns (seconds)")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="Seconds over which to start the users")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    report = run_load(args.url.rstrip("/"), args.users, None if args.duration else args.turns, args.duration,
+                      args.model, args.think_time, args.ramp_up)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,247 @@
+# memory_queue.py
+# Moves vector-memory ingestion off the request path. Memories are written to
+# the memory_queue table first (so nothing is lost if the process dies), then
+# a small pool of background workers embeds them in batches and removes them
+# from the queue once they are stored in the vector database. Inside a
+# DatabaseManager.transaction() the queue rows commit with the rest of it and
+# the workers only see them after the commit, so nothing from a rolled-back
+# transaction reaches the vector database.
+#
+# Every process (each gunicorn worker) claims the rows it queues and renews
+# its claim while it runs. Rows left behind by a process that died are
+# claimed by exactly one of the others once the claim has expired, so no row
+# is ingested by two processes at once.
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from datetime import datetime
+from metrics import registry
+
+logger = logging.getLogger('dnd_gm_assistant.memory_queue')
+
+# Entity memories are written with VectorDBManager.upsert_entities
+ENTITY_KINDS = ('character', 'npc', 'location', 'quest')
+
+QUEUE_PENDING = registry.gauge('dnd_memory_queue_pending', 'Memories queued but not yet stored in the vector database')
+INGEST_SECONDS = registry.histogram('dnd_memory_ingest_seconds', 'Time spent storing one batch of queued memories')
+INGEST_FAILURES = registry.counter('dnd_memory_ingest_failures_total', 'Batches of queued memories that failed to store')
+
+class MemoryIngestionQueue:
+    def __init__(self, db_manager, vector_db_manager, workers=2, batch_size=32, batch_wait=0.02,
+                 retry_delay=1.0, max_attempts=5, lease_seconds=60.0):
+        """
+        batch_size caps how many memories one worker embeds at once; after the
+        first item arrives a worker waits up to batch_wait seconds for more.
+        A batch that keeps failing is retried max_attempts times, then left in
+        the queue table to be picked up again on the next start.
+        lease_seconds is how long the rows of a process that stopped renewing
+        its claim wait before another process takes them over.
+        """
+        self.db = db_manager
+        self.vector_db = vector_db_manager
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        
+        self._items = deque()
+        self._pending = defaultdict(int)  # session_id -> memories not yet stored
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._stopped = threading.Event()  # Ends the lease thread; kept off _condition so it takes no wakeups
+        
+        # Anything left over from a previous run is ingested first
+        self._adopt()
+        
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"memory-ingest-{n}", daemon=True)
+            for n in range(workers)
+        ]
+        self._workers.append(threading.Thread(target=self._renew_leases, name="memory-lease", daemon=True))
+        for worker in self._workers:
+            worker.start()
+    
+    def _adopt(self):
+        """Claim the rows no live process holds and queue them for ingestion."""
+        items = self.db.claim_memories(self.owner, self.lease_seconds)
+        if items:
+            logger.info(f"Recovered {len(items)} queued memories")
+            self._add_items(items)
+    
+    def _renew_leases(self):
+        # Renew well within the lease, and take over the rows of processes that stopped renewing
+        interval = self.lease_seconds / 3
+        while not self._stopped.wait(interval):
+            try:
+                self.db.renew_memory_claims(self.owner)
+                self._adopt()
+            except Exception as e:
+                logger.error(f"Failed to renew memory queue claims: {str(e)}")
+    
+    def _add_item(self, item):
+        self._add_items([item])
+    
+    def _add_items(self, items):
+        # Handed over together, so the memories end up in the same batch
+        with self._condition:
+            for item in items:
+                self._items.append(item)
+                self._pending[item['session_id']] += 1
+                QUEUE_PENDING.inc()
+            self._condition.notify()
+    
+    def enqueue(self, session_id, kind, payload):
+        """Durably queue a memory for ingestion and return immediately."""
+        queue_id = self.db.enqueue_memory(session_id, kind, payload, owner=self.owner)
+        item = {'queue_id': queue_id, 'session_id': session_id, 'kind': kind, 'payload': payload}
+        self.db.on_commit(lambda: self._add_item(item))
+        return queue_id
+    
+    def enqueue_many(self, session_id, entries):
+        """
+        Durably queue several (kind, payload) memories of a session with one
+        commit; the workers receive them together. Returns their queue ids.
+        """
+        queue_ids = self.db.enqueue_memories(session_id, entries, owner=self.owner)
+        items = [
+            {'queue_id': queue_id, 'session_id': session_id, 'kind': kind, 'payload': payload}
+            for queue_id, (kind, payload) in zip(queue_ids, entries)
+        ]
+        self.db.on_commit(lambda: self._add_items(items))
+        return queue_ids
+    
+    def add_conversation_memory(self, session_id, role, content):
+        """Queue a conversation message; returns the id it will be stored under."""
+        memory_id = str(uuid.uuid4())
+        # The ordinal and the queue row are written with one commit
+        with self.db.transaction():
+            self.enqueue(session_id, 'conversation', {
+                'role': role,
+                'content': content,
+                'memory_id': memory_id,
+                # Keep the time the message happened, not the time it was embedded,
+                # and its place in the session: workers may store batches out of order
+                'timestamp': datetime.now().isoformat(),
+                'seq': self.db.reserve_memory_seq(session_id)
+            })
+        return memory_id
+    
+    def add_entity_memory(self, session_id, kind, data):
+        """Queue a character, npc, location or quest memory."""
+        if kind not in ENTITY_KINDS:
+            raise ValueError(f"Unknown memory kind: {kind}")
+        return self.enqueue(session_id, kind, data)
+    
+    def flush(self, session_id=None, timeout=10.0):
+        """
+        Block until every queued memory for session_id (or for all sessions)
+        is stored, so the next vector query sees it. Returns False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if session_id is None:
+                    remaining = sum(self._pending.values())
+                else:
+                    remaining = self._pending.get(session_id, 0)
+                if not remaining:
+                    return True
+                
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    logger.warning(f"Timed out flushing {remaining} queued memories")
+                    return False
+                self._condition.wait(wait)
+    
+    def _next_batch(self):
+        with self._condition:
+            while not self._items and not self._stopping:
+                self._condition.wait()
+            if not self._items:
+                return None
+        
+        # Give concurrent writes from the same turn a moment to join the batch
+        if len(self._items) < self.batch_size and self.batch_wait:
+            time.sleep(self.batch_wait)
+        
+        with self._condition:
+            batch = []
+            while self._items and len(batch) < self.batch_size:
+                batch.append(self._items.popleft())
+            return batch
+    
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            
+            try:
+                with INGEST_SECONDS.time():
+                    self._ingest(batch)
+                self.db.delete_memories([item['queue_id'] for item in batch])
+            except Exception as e:
+                INGEST_FAILURES.inc()
+                # Leave the rows in the queue table and try again shortly
+                logger.error(f"Failed to ingest {len(batch)} memories: {str(e)}")
+                time.sleep(self.retry_delay)
+                retry = []
+                for item in batch:
+                    item['attempts'] = item.get('attempts', 0) + 1
+                    if item['attempts'] < self.max_attempts:
+                        retry.append(item)
+                with self._condition:
+                    self._items.extendleft(reversed(retry))
+                    self._condition.notify()
+                self._done([item for item in batch if item not in retry])
+                continue
+            
+            self._done(batch)
+    
+    def _done(self, batch):
+        """Mark items as no longer pending and wake anyone flushing."""
+        with self._condition:
+            for item in batch:
+                self._pending[item['session_id']] -= 1
+                QUEUE_PENDING.dec()
+                if not self._pending[item['session_id']]:
+                    del self._pending[item['session_id']]
+            self._condition.notify_all()
+    
+    def _ingest(self, batch):
+        """Write a batch to the vector database, grouped by kind."""
+        by_kind = defaultdict(list)
+        for item in batch:
+            by_kind[item['kind']].append(item)
+        
+        conversations = by_kind.pop('conversation', [])
+        if conversations:
+            self.vector_db.add_conversation_memories([
+                dict(item['payload'], session_id=item['session_id']) for item in conversations
+            ])
+        
+        # One write per collection and session, in the order the updates were made
+        for kind, items in by_kind.items():
+            by_session = defaultdict(list)
+            for item in items:
+                by_session[item['session_id']].append(item['payload'])
+            for session_id, records in by_session.items():
+                self.vector_db.upsert_entities(session_id, kind, records)
+    
+    def shutdown(self, timeout=10.0):
+        """Drain the queue (up to timeout) and stop the workers."""
+        self.flush(timeout=timeout)
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._stopped.set()
+        for worker in self._workers:
+            worker.join(timeout)
@@ -0,0 +1,222 @@
+# metrics.py
+# Lightweight in-process instrumentation. Counters, gauges and latency
+# histograms live in memory and are rendered in the Prometheus text format
+# by the /metrics endpoint. Spans time a block of code into a histogram and,
+# when given a timings dict, add it to a per-request breakdown as well.
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper bounds in seconds, from sub-millisecond SQLite reads to long model calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    type_name = 'untyped'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # Unlabelled metrics are exported (as zero) before their first update
+            self._values[()] = self._initial()
+    
+    def _initial(self):
+        return 0
+    
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._samples(items))
+        return lines
+    
+    def _samples(self, items):
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+class Counter(Metric):
+    type_name = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    type_name = 'gauge'
+    
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+class Histogram(Metric):
+    type_name = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, documentation, labelnames)
+    
+    def _initial(self):
+        # Per-bucket (not yet cumulative) counts, then sum and count
+        return [[0] * len(self.buckets), 0.0, 0]
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = self._initial()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def snapshot(self, **labels):
+        """(count, sum) observed so far for one label set."""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return (state[2], state[1]) if state else (0, 0.0)
+    
+    def _samples(self, items):
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+class MetricsRegistry:
+    """Every metric in the process, by name, in the order they were created."""
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with a different type or labels")
+            return metric
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+    
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+    
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+# The process-wide registry the app's modules record into
+registry = MetricsRegistry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_SECONDS = registry.histogram(
+    'dnd_turn_stage_seconds', 'Time spent in each stage of a chat turn', ('stage',)
+)
+
+@contextmanager
+def span(stage, timings=None):
+    """
+    Time a stage of a chat turn. When timings is a dict the elapsed
+    milliseconds are added to timings[stage], and observe_stages() records
+    the turn's total per stage once it ends; a stage entered several times
+    in a turn still counts as one sample. Without timings the span is
+    observed into dnd_turn_stage_seconds right away.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if timings is None:
+            STAGE_SECONDS.observe(elapsed, stage=stage)
+        else:
+            timings[stage] = timings.get(stage, 0.0) + elapsed * 1000
+
+def observe_stages(timings):
+    """Record a finished turn's per-stage totals (milliseconds) into dnd_turn_stage_seconds."""
+    for stage, milliseconds in timings.items():
+        STAGE_SECONDS.observe(milliseconds / 1000, stage=stage)
+
+def timed(histogram, label='operation'):
+    """Decorator observing each call's duration, labelled with the function name."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**{label: func.__name__}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,114 @@
+# migrate_vector_partitions.py
+# Splits the global Chroma collections (one per kind of memory, shared by
+# every session) into per-session or per-shard collections, as used by
+# VectorDBManager(partitioning="session" / "shard").
+#
+#   python migrate_vector_partitions.py --partitioning session
+#   python migrate_vector_partitions.py --partitioning shard --shards 32 --drop-source
+#
+# Stored embeddings are copied as they are, so nothing is re-embedded (and the
+# embedding model is never loaded), and writes are upserts, so an interrupted
+# run can simply be started again.
+import argparse
+import logging
+from collections import defaultdict
+import chromadb
+from chromadb.api.types import EmbeddingFunction, Documents
+from chromadb.config import Settings
+from vector_db_manager import VectorDBManager, COLLECTION_NAMES
+
+logger = logging.getLogger('dnd_gm_assistant.migrate_vectors')
+
+class CopyOnlyEmbedder(EmbeddingFunction[Documents]):
+    """Stands in for the app's embedder; every record is written with its stored embedding."""
+    model = None
+
+    def __call__(self, input):
+        raise RuntimeError("The partition migration copies stored embeddings and never embeds")
+
+def migrate_kind(source_client, target, kind, batch_size):
+    """Copy one global collection into its partitions; returns (copied, skipped)."""
+    try:
+        source = source_client.get_collection(name=COLLECTION_NAMES[kind])
+    except Exception:
+        logger.info(f"No {COLLECTION_NAMES[kind]} collection, nothing to migrate")
+        return 0, 0
+
+    copied = 0
+    skipped = 0
+    offset = 0
+    while True:
+        page = source.get(
+            limit=batch_size,
+            offset=offset,
+            include=["documents", "metadatas", "embeddings"]
+        )
+        if not page["ids"]:
+            break
+        offset += len(page["ids"])
+
+        # session_id -> (ids, documents, metadatas, embeddings)
+        by_session = defaultdict(lambda: ([], [], [], []))
+        for memory_id, document, metadata, embedding in zip(
+                page["ids"], page["documents"], page["metadatas"], page["embeddings"]):
+            session_id = (metadata or {}).get("session_id")
+            if not session_id:
+                skipped += 1
+                continue
+            rows = by_session[session_id]
+            rows[0].append(memory_id)
+            rows[1].append(document)
+            rows[2].append(metadata)
+            rows[3].append(embedding)
+
+        for session_id, (ids, documents, metadatas, embeddings) in by_session.items():
+            target._collection(kind, session_id).upsert(
+                ids=ids,
+                documents=documents,
+                metadatas=metadatas,
+                embeddings=embeddings
+            )
+            copied += len(ids)
+
+        logger.info(f"{COLLECTION_NAMES[kind]}: {offset} of {source.count()} read")
+
+    return copied, skipped
+
+def main():
+    parser = argparse.ArgumentParser(description="Split global vector collections into partitions.")
+    parser.add_argument("--source", default="chroma_db", help="Chroma directory holding the global collections")
+    parser.add_argument("--dest", help="Chroma directory to write partitions to (default: same as --source)")
+    parser.add_argument("--partitioning", choices=["session", "shard"], default="session")
+    parser.add_argument("--shards", type=int, default=16, help="Collections per kind with --partitioning shard")
+    parser.add_argument("--batch-size", type=int, default=500, help="Records read per page")
+    parser.add_argument("--drop-source", action="store_true",
+                        help="Delete the global collections once every record has been copied")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    source_client = chromadb.PersistentClient(path=args.source, settings=Settings(anonymized_telemetry=False))
+    target = VectorDBManager(args.dest or args.source, embedder=CopyOnlyEmbedder(),
+                             partitioning=args.partitioning, shards=args.shards)
+
+    complete = True
+    for kind in COLLECTION_NAMES:
+        copied, skipped = migrate_kind(source_client, target, kind, args.batch_size)
+        print(f"{COLLECTION_NAMES[kind]}: copied {copied}, skipped {skipped} without a session_id")
+        complete = complete and not skipped
+
+    if args.drop_source:
+        if not complete:
+            print("Some records had no session_id; keeping the global collections")
+        else:
+            for kind in COLLECTION_NAMES:
+                try:
+                    source_client.delete_collection(name=COLLECTION_NAMES[kind])
+                except Exception:
+                    pass
+            print("Dropped the global collections")
+
+    target.close()
+
+if __name__ == '__main__':
+    main()
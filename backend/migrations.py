@@ -0,0 +1,133 @@
+# migrations.py
+# Versioned schema migrations for game_data.db.
+# The schema version lives in SQLite's user_version pragma, so databases
+# created by older releases are upgraded in place the next time they open.
+import sqlite3
+import sys
+import logging
+
+logger = logging.getLogger('dnd_gm_assistant.migrations')
+
+# Each migration is (version, description, steps). A step is either a SQL
+# statement or a callable that receives the open connection. Versions must be
+# strictly increasing; never edit a migration that has already shipped, add a
+# new one instead.
+MIGRATIONS = [
+    (1, "Session-scoped lookup indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_session_timestamp ON messages (session_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_characters_session ON characters (session_id)",
+        "CREATE INDEX IF NOT EXISTS idx_locations_session_name ON locations (session_id, name)",
+        "CREATE INDEX IF NOT EXISTS idx_npcs_session_name ON npcs (session_id, name)",
+        "CREATE INDEX IF NOT EXISTS idx_npcs_session_location ON npcs (session_id, location_id)",
+        "CREATE INDEX IF NOT EXISTS idx_quests_session_title ON quests (session_id, title)",
+        "CREATE INDEX IF NOT EXISTS idx_combat_state_session ON combat_state (session_id)",
+    ]),
+    (2, "Cached per-message token counts", [
+        "ALTER TABLE messages ADD COLUMN token_count INTEGER",
+        # Same formula as db_manager.estimate_tokens
+        "UPDATE messages SET token_count = (length(COALESCE(content, '')) + 3) / 4",
+    ]),
+    (3, "Rolling conversation summaries", [
+        '''
+        CREATE TABLE IF NOT EXISTS summaries (
+            summary_id TEXT PRIMARY KEY,
+            session_id TEXT,
+            content TEXT,
+            covers_until TIMESTAMP,
+            message_count INTEGER,
+            created_at TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES sessions (session_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_summaries_session_covers ON summaries (session_id, covers_until)",
+    ]),
+    (4, "Durable queue for pending vector memories", [
+        '''
+        CREATE TABLE IF NOT EXISTS memory_queue (
+            queue_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            kind TEXT,
+            payload TEXT,
+            created_at TIMESTAMP
+        )
+        ''',
+    ]),
+    (5, "Per-session ordinals for conversation memories", [
+        '''
+        CREATE TABLE IF NOT EXISTS memory_sequences (
+            session_id TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL
+        )
+        ''',
+    ]),
+    (6, "Leases on queued vector memories", [
+        # The process ingesting a row and when it last renewed its claim (unix time)
+        "ALTER TABLE memory_queue ADD COLUMN claimed_by TEXT",
+        "ALTER TABLE memory_queue ADD COLUMN claimed_at REAL",
+    ]),
+]
+
+def get_schema_version(conn):
+    """Return the migration version the database is currently at."""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def run_migrations(conn, migrations=None):
+    """
+    Apply every migration newer than the database's schema version.
+    Each migration runs in its own write transaction together with the version
+    bump, so a failed migration leaves the database at the previous version.
+    Returns the list of versions that were applied.
+    """
+    migrations = MIGRATIONS if migrations is None else migrations
+    applied = []
+
+    for version, description, steps in migrations:
+        if version <= get_schema_version(conn):
+            continue
+
+        if conn.in_transaction:
+            conn.commit()
+
+        # Take the write lock first, then re-check: another process may have
+        # applied this migration while we were waiting for it
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"Migration {version} ({description}) failed")
+            raise
+
+        logger.info(f"Applied migration {version}: {description}")
+        applied.append(version)
+
+    return applied
+
+if __name__ == '__main__':
+    # Upgrade a database in place: python migrations.py [path/to/game_data.db]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    from db_manager import DatabaseManager
+
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "game_data.db"
+    conn = sqlite3.connect(db_path)
+    before = get_schema_version(conn)
+    conn.close()
+
+    # Opening the manager creates any missing tables and runs the migrations
+    db = DatabaseManager(db_path, pool_size=0)
+    with db.connection() as conn:
+        after = get_schema_version(conn)
+
+    print(f"{db_path}: schema version {before} -> {after}")
@@ -1,142 +1,266 @@
 # model_handler.py
-import requests
-import os
-from google import genai
-from dotenv import load_dotenv
+# Native tool calling. The functions in FUNCTION_SCHEMAS are declared to the
+# model API (Gemini function declarations, the tools of Ollama's /api/chat)
+# and the model returns structured calls next to its narrative, so the prompt
+# doesn't carry the function documentation and the reply needs no parsing.
+# When a response holds only calls, their results are sent back and the
+# model is asked again for the narrative.
+import re
+import json
+import time
+import logging
+import threading
+from function_schemas import FUNCTION_SCHEMAS
+from model_transport import get_transport
+from metrics import registry
 
-# Load environment variables from .env file
-load_dotenv()
+logger = logging.getLogger('dnd_gm_assistant.models')
 
-# Initialize Gemini API with key from environment variables
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+# The same series app.py records its text-protocol requests in
+MODEL_SECONDS = registry.histogram(
+    'dnd_model_request_seconds', 'Time spent waiting on a model API', ('provider', 'mode')
+)
+MODEL_FINISHED = registry.counter(
+    'dnd_model_finish_total', 'Model generations by provider and why they ended', ('provider', 'reason')
+)
+TOOL_CALLS = registry.counter(
+    'dnd_model_tool_calls_total', 'Structured function calls returned by the model APIs', ('provider',)
+)
 
-# Ollama API endpoint
-OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate")
-DEFAULT_OLLAMA_MODEL = os.getenv("DEFAULT_OLLAMA_MODEL", "mistral-nemo:latest")
+def gemini_tools():
+    """FUNCTION_SCHEMAS as Gemini function declarations."""
+    return [{
+        "functionDeclarations": [
+            {
+                "name": schema["name"],
+                "description": schema["description"],
+                "parameters": schema["parameters"]
+            } for schema in FUNCTION_SCHEMAS.values()
+        ]
+    }]
 
-class ModelHandler:
-    def __init__(self):
-        # Configure available models
-        self.models = {
-            "gemini-1.5-pro": {
-                "type": "gemini",
-                "name": "gemini-1.5-pro", 
-                "description": "Google Gemini 1.5 Pro"
-            },
-            "gemini-1.5-flash": {
-                "type": "gemini",
-                "name": "gemini-1.5-flash", 
-                "description": "Google Gemini 1.5 Flash (Faster)"
-            },
-            "local": {
-                "type": "ollama",
-                "name": DEFAULT_OLLAMA_MODEL,
-                "description": f"Local Ollama ({DEFAULT_OLLAMA_MODEL})"
+def ollama_tools():
+    """FUNCTION_SCHEMAS as Ollama (OpenAI-style) tools."""
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": schema["name"],
+                "description": schema["description"],
+                "parameters": schema["parameters"]
             }
-        }
-        
-    def get_available_models(self):
-        """Return a list of available models."""
-        return self.models
+        } for schema in FUNCTION_SCHEMAS.values()
+    ]
+
+class ModelHandler:
+    # Seconds to answer "no tools" after a failed capability check before asking again
+    FAILED_CHECK_TTL = 30.0
+    # Ollama's num_ctx when neither the request nor the model's Modelfile sets one
+    OLLAMA_DEFAULT_NUM_CTX = 2048
     
-    async def generate_response(self, model_id, prompt, function_schemas=None):
-        """Generate a response from the selected model."""
-        if model_id not in self.models:
-            raise ValueError(f"Model {model_id} not available")
-            
-        model_info = self.models[model_id]
-        model_type = model_info["type"]
+    def __init__(self, ollama_base_url, ollama_model, gemini_api_url=None, gemini_api_key=None,
+                 keep_alive=None, num_ctx=0, max_rounds=3):
+        """
+        max_rounds caps the requests per turn: a response with calls but no
+        text is answered with the call results, and the last round is sent
+        without tools so the model has to reply with narrative.
+        """
+        self.ollama_chat_url = f"{ollama_base_url}/api/chat"
+        self.ollama_show_url = f"{ollama_base_url}/api/show"
+        self.ollama_model = ollama_model
+        self.gemini_api_url = gemini_api_url
+        self.gemini_api_key = gemini_api_key
+        self.keep_alive = keep_alive
+        self.num_ctx = num_ctx
+        self.max_rounds = max(1, max_rounds)
         
-        if model_type == "gemini":
-            return await self._generate_with_gemini(model_info["name"], prompt, function_schemas)
-        elif model_type == "ollama":
-            return self._generate_with_ollama(model_info["name"], prompt)
-        else:
-            raise ValueError(f"Unsupported model type: {model_type}")
+        # Built once; the declarations are identical for every request
+        self._tools = {"ollama": ollama_tools(), "gemini": gemini_tools()}
+        self._tool_support = {}  # provider -> whether the model accepts tools
+        self._check_failed = {}  # provider -> when the capability check last failed
+        self._lock = threading.Lock()
     
-    async def _generate_with_gemini(self, model_name, prompt, function_schemas=None):
-        """Generate a response using Google Gemini API."""
-        if not GEMINI_API_KEY:
-            raise ValueError("GEMINI_API_KEY not set in environment variables")
+    def supports_tools(self, provider):
+        """
+        Whether the provider's model can be called with tools. Ollama is asked
+        once; while it can't be reached the answer is no, asked again after
+        FAILED_CHECK_TTL seconds.
+        """
+        if provider == "gemini":
+            return bool(self.gemini_api_key)
+        
+        with self._lock:
+            if provider in self._tool_support:
+                return self._tool_support[provider]
+            failed_at = self._check_failed.get(provider)
+            if failed_at is not None and time.monotonic() - failed_at < self.FAILED_CHECK_TTL:
+                return False
         
         try:
-            # Create a model instance
-            model = genai.GenerativeModel(model_name)
-            
-            # If function schemas provided, set up function calling
-            if function_schemas:
-                tools = [
-                    {
-                        "function_declarations": [
-                            {
-                                "name": schema["name"],
-                                "description": schema["description"],
-                                "parameters": schema["parameters"]
-                            } for schema in function_schemas.values()
-                        ]
-                    }
-                ]
-                response = await model.generate_content_async(
-                    prompt,
-                    generation_config={"temperature": 0.7},
-                    tools=tools
-                )
-            else:
-                response = await model.generate_content_async(
-                    prompt,
-                    generation_config={"temperature": 0.7}
-                )
-            
-            # Check for function calls in the response
-            function_calls = []
-            if hasattr(response, 'candidates') and response.candidates:
-                for candidate in response.candidates:
-                    if hasattr(candidate, 'content') and candidate.content.parts:
-                        for part in candidate.content.parts:
-                            if hasattr(part, 'function_call'):
-                                function_calls.append({
-                                    "function": part.function_call.name,
-                                    "arguments": part.function_call.args
-                                })
-            
-            # Extract the text response
-            text_response = response.text
-            
-            return {
-                "response": text_response,
-                "function_calls": function_calls,
-                "raw_response": response
-            }
-            
+            response = get_transport("ollama").post(self.ollama_show_url, json={"model": self.ollama_model})
+            if response.status_code != 200:
+                raise Exception(response.text)
+            details = response.json()
         except Exception as e:
-            raise Exception(f"Error generating content with Gemini: {str(e)}")
+            # Remembered only briefly, so the check runs again once Ollama is reachable
+            logger.warning(f"Could not check whether {self.ollama_model} supports tools: {str(e)}")
+            with self._lock:
+                self._check_failed[provider] = time.monotonic()
+            return False
+        
+        # Older Ollama versions don't list capabilities; their tool-capable templates use .Tools
+        supported = "tools" in details.get("capabilities", []) or ".Tools" in details.get("template", "")
+        logger.info(f"Ollama model {self.ollama_model} {'supports' if supported else 'does not support'} tools")
+        with self._lock:
+            self._tool_support[provider] = supported
+        return supported
     
-    def _generate_with_ollama(self, model_name, prompt):
-        """Generate a response using Ollama API."""
+    def context_window(self):
+        """
+        The context window (num_ctx) Ollama runs the model with: the num_ctx
+        sent with every request when one is configured, otherwise the model's
+        own num_ctx parameter. Falls back to OLLAMA_DEFAULT_NUM_CTX when the
+        model sets none or Ollama can't be asked, so a wrong guess errs small.
+        """
+        if self.num_ctx:
+            return self.num_ctx
+        
         try:
-            response = requests.post(
-                OLLAMA_API_URL,
-                json={
-                    "model": model_name,
-                    "prompt": prompt,
-                    "stream": False
-                }
-            )
-            
+            response = get_transport("ollama").post(self.ollama_show_url, json={"model": self.ollama_model})
             if response.status_code != 200:
-                raise Exception(f"Error from Ollama API: {response.text}")
-                
-            response_data = response.json()
-            ai_response = response_data.get('response', 'No response generated')
+                raise Exception(response.text)
+            parameters = response.json().get("parameters") or ""
+        except Exception as e:
+            logger.warning(f"Could not read the context window of {self.ollama_model}: {str(e)}")
+            return self.OLLAMA_DEFAULT_NUM_CTX
+        
+        # parameters is the Modelfile's PARAMETER lines, e.g. "num_ctx 8192\nstop ..."
+        match = re.search(r'^num_ctx\s+(\d+)', parameters, re.MULTILINE)
+        return int(match.group(1)) if match else self.OLLAMA_DEFAULT_NUM_CTX
+    
+    def generate(self, provider, system, prompt, run_functions, policy=None):
+        """
+        Generate a reply with the functions available as tools. system and
+        prompt are the stable and the per-turn part of the prompt;
+        run_functions([(name, arguments), ...]) executes the calls of one
+        response together and returns their results in order.
+        Returns {"response": text, "function_results": [...], "rounds": n}.
+        """
+        if provider == "gemini":
+            request, results_message = self._gemini_request, self._gemini_results
+            conversation = [{"role": "user", "parts": [{"text": prompt}]}]
+        else:
+            request, results_message = self._ollama_request, self._ollama_results
+            conversation = [{"role": "system", "content": system}, {"role": "user", "content": prompt}]
+        
+        function_results = []
+        text = ""
+        for round_number in range(1, self.max_rounds + 1):
+            text, calls, reply = request(system, conversation, policy, use_tools=round_number < self.max_rounds)
+            if not calls:
+                break
             
-            # Ollama doesn't have native function calling, so we'll parse it later
-            return {
-                "response": ai_response,
-                "function_calls": [],
-                "raw_response": response_data
-            }
+            TOOL_CALLS.inc(len(calls), provider=provider)
+            results = run_functions(calls)
+            function_results.extend(results)
+            if text.strip():
+                break  # The narrative came with the calls
             
-        except Exception as e:
-            raise Exception(f"Error generating content with Ollama: {str(e)}")
\ No newline at end of file
+            conversation.append(reply)
+            conversation.extend(results_message(calls, results))
+        
+        return {"response": text, "function_results": function_results, "rounds": round_number}
+    
+    def _ollama_request(self, system, messages, policy, use_tools):
+        request_body = {
+            "model": self.ollama_model,
+            "messages": messages,
+            "stream": False
+        }
+        if use_tools:
+            request_body["tools"] = self._tools["ollama"]
+        if self.keep_alive:
+            request_body["keep_alive"] = self.keep_alive
+        
+        options = {}
+        if self.num_ctx:
+            options["num_ctx"] = self.num_ctx
+        if policy:
+            options["num_predict"] = policy["max_tokens"]
+            options["stop"] = policy["stop"]
+        if options:
+            request_body["options"] = options
+        
+        response_data = self._post("ollama", self.ollama_chat_url, request_body)
+        MODEL_FINISHED.inc(provider="ollama", reason=(response_data.get("done_reason") or "unknown").lower())
+        
+        message = response_data.get("message", {})
+        calls = []
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            calls.append((function.get("name", ""), function.get("arguments") or {}))
+        return message.get("content", ""), calls, message
+    
+    def _ollama_results(self, calls, results):
+        return [
+            {"role": "tool", "tool_name": name, "content": json.dumps(result, default=str)}
+            for (name, _), result in zip(calls, results)
+        ]
+    
+    def _gemini_request(self, system, contents, policy, use_tools):
+        if not self.gemini_api_key:
+            raise Exception("Gemini API key not set")
+        
+        generation_config = {"temperature": 0.7, "topK": 40, "topP": 0.95, "maxOutputTokens": 2048}
+        if policy:
+            generation_config["maxOutputTokens"] = policy["max_tokens"]
+            generation_config["stopSequences"] = policy["stop"]
+        
+        request_body = {
+            "systemInstruction": {"parts": [{"text": system}]},
+            "contents": contents,
+            # Declared in every round (earlier rounds' calls refer to them); NONE forces text
+            "tools": self._tools["gemini"],
+            "toolConfig": {"functionCallingConfig": {"mode": "AUTO" if use_tools else "NONE"}},
+            "generationConfig": generation_config
+        }
+        
+        response_data = self._post("gemini", self.gemini_api_url, request_body,
+                                   headers={"x-goog-api-key": self.gemini_api_key})
+        try:
+            candidate = response_data["candidates"][0]
+        except (KeyError, IndexError):
+            logger.error(f"Unexpected response structure from Gemini API: {json.dumps(response_data)}")
+            raise Exception("Unexpected response structure from Gemini API")
+        MODEL_FINISHED.inc(provider="gemini", reason=(candidate.get("finishReason") or "unknown").lower())
+        
+        content = candidate.get("content", {"role": "model", "parts": []})
+        text = []
+        calls = []
+        for part in content.get("parts", []):
+            if "functionCall" in part:
+                calls.append((part["functionCall"].get("name", ""), part["functionCall"].get("args") or {}))
+            elif "text" in part:
+                text.append(part["text"])
+        return "".join(text), calls, content
+    
+    def _gemini_results(self, calls, results):
+        return [{
+            "role": "user",
+            "parts": [
+                {"functionResponse": {"name": name, "response": result}}
+                for (name, _), result in zip(calls, results)
+            ]
+        }]
+    
+    def _post(self, provider, url, request_body, headers=None):
+        start_time = time.perf_counter()
+        response = get_transport(provider).post(url, json=request_body, headers=headers)
+        duration = time.perf_counter() - start_time
+        MODEL_SECONDS.observe(duration, provider=provider, mode="tools")
+        logger.info(f"{provider} tool-calling response received in {duration:.2f} seconds")
+        
+        if response.status_code != 200:
+            logger.error(f"{provider} API error: {response.status_code} - {response.text}")
+            raise Exception(f"Error from {provider} API: {response.text}")
+        return response.json()
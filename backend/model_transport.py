@@ -0,0 +1,110 @@
+# model_transport.py
+# Shared HTTP transport for model backends (Ollama, Gemini).
+# Each backend gets one keep-alive requests.Session with a connection pool,
+# connect/read timeouts, bounded retries with backoff and a cap on how many
+# requests may be in flight at once.
+import os
+import threading
+import logging
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('dnd_gm_assistant.transport')
+
+class ModelBackendBusy(Exception):
+    """Raised when no concurrency slot frees up within the queue timeout."""
+
+class ModelTransport:
+    def __init__(self, name, connect_timeout=5.0, read_timeout=300.0, retries=2, backoff=0.5,
+                 max_concurrency=4, queue_timeout=60.0, pool_size=10):
+        """
+        retries applies to connection failures and 502/503/504 responses, where
+        the backend never started generating; read timeouts are not retried so
+        a slow generation is never run twice.
+        """
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @contextmanager
+    def _slot(self):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise ModelBackendBusy(f"{self.name} backend is busy: no free request slot "
+                                   f"after {self.queue_timeout:.0f} seconds")
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def post(self, url, json=None, headers=None):
+        """POST and read the whole response body before giving the slot back."""
+        with self._slot():
+            response = self.session.post(url, json=json, headers=headers, timeout=self.timeout)
+            response.content  # Read the body while we still hold the slot
+            return response
+
+    @contextmanager
+    def stream(self, url, json=None, headers=None):
+        """POST with a streamed body; the slot is held until the block exits."""
+        with self._slot():
+            response = self.session.post(url, json=json, headers=headers, timeout=self.timeout, stream=True)
+            try:
+                yield response
+            finally:
+                response.close()
+
+    def close(self):
+        self.session.close()
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+def get_transport(backend):
+    """
+    Return the process-wide transport for a backend ("ollama" or "gemini").
+    Settings come from <BACKEND>_CONNECT_TIMEOUT, <BACKEND>_READ_TIMEOUT,
+    <BACKEND>_RETRIES, <BACKEND>_MAX_CONCURRENCY and <BACKEND>_QUEUE_TIMEOUT.
+    """
+    with _transports_lock:
+        transport = _transports.get(backend)
+        if transport is None:
+            prefix = backend.upper()
+            transport = ModelTransport(
+                backend,
+                connect_timeout=_env_float(f"{prefix}_CONNECT_TIMEOUT", 5),
+                read_timeout=_env_float(f"{prefix}_READ_TIMEOUT", 300),
+                retries=int(os.environ.get(f"{prefix}_RETRIES", 2)),
+                max_concurrency=int(os.environ.get(f"{prefix}_MAX_CONCURRENCY", 4)),
+                queue_timeout=_env_float(f"{prefix}_QUEUE_TIMEOUT", 60)
+            )
+            _transports[backend] = transport
+        return transport
+
+def close_transports():
+    """Close every pooled connection, e.g. on worker shutdown."""
+    with _transports_lock:
+        for transport in _transports.values():
+            transport.close()
+        _transports.clear()
@@ -0,0 +1,216 @@
+# prompt_builder.py
+# Assembles the text prompt for each turn. The layout keeps everything that
+# rarely changes at the front (system prompt, then world state, then the
+# rolling summary) so consecutive turns share a long identical prefix that
+# the model server can reuse, and puts per-turn retrieval context last.
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from prompts import get_base_prompt
+
+@dataclass
+class BuiltPrompt:
+    """A rendered prompt plus where its stable prefix ends."""
+    text: str
+    prefix_length: int
+    metrics: dict = field(default_factory=dict)
+    turn_offset: int = 0  # Where this turn's retrieval context and message start
+    updates: str = ""  # World sections that changed since the session's previous prompt
+
+    @property
+    def prefix(self):
+        """System prompt, world state and summary: identical between turns unless they changed."""
+        return self.text[:self.prefix_length]
+
+    @property
+    def suffix(self):
+        """History, retrieval context and the current message."""
+        return self.text[self.prefix_length:]
+
+    @property
+    def turn(self):
+        """Only what is new this turn: retrieval context and the current message."""
+        return self.text[self.turn_offset:]
+
+def render_character(character):
+    if not character or not character.get('name'):
+        return ""
+
+    parts = ["PLAYER CHARACTER:\n"]
+    for key, value in character.items():
+        if key != 'inventory':  # Handle inventory separately
+            parts.append(f"{key.capitalize()}: {value}\n")
+
+    # Add inventory if it exists
+    if character.get('inventory'):
+        parts.append("Inventory:\n")
+        parts.extend(f"- {item}\n" for item in character['inventory'])
+
+    parts.append("\n")
+    return "".join(parts)
+
+def render_locations(locations):
+    if not locations:
+        return ""
+    parts = ["KNOWN LOCATIONS:\n"]
+    for loc in locations[:5]:  # Limit to 5 to keep context manageable
+        parts.append(f"- {loc['name']}: {loc['type']} - {loc['description'][:100]}...\n")
+    parts.append("\n")
+    return "".join(parts)
+
+def render_npcs(npcs):
+    if not npcs:
+        return ""
+    parts = ["KNOWN NPCs:\n"]
+    for npc in npcs[:5]:  # Limit to 5
+        parts.append(f"- {npc['name']}: {npc['role']} - {npc['description'][:100]}...\n")
+    parts.append("\n")
+    return "".join(parts)
+
+def render_quests(quests):
+    if not quests:
+        return ""
+    parts = ["ACTIVE QUESTS:\n"]
+    for quest in [q for q in quests if q['status'] in ['not_started', 'in_progress']][:3]:
+        parts.append(f"- {quest['title']} ({quest['status']}): {quest['description'][:100]}...\n")
+    parts.append("\n")
+    return "".join(parts)
+
+def render_combat_state(combat_state):
+    # Only shown while in combat
+    if not combat_state or not combat_state.get('is_in_combat'):
+        return ""
+
+    parts = [
+        "CURRENT COMBAT STATE:\n",
+        f"Round: {combat_state.get('round', 1)}\n",
+        f"Current turn: {combat_state.get('current_combatant', 'Unknown')}\n",
+    ]
+    if combat_state.get('initiative_order'):
+        parts.append("Initiative order:\n")
+        for combatant in combat_state['initiative_order']:
+            parts.append(f"- {combatant.get('name', 'Unknown')}: {combatant.get('initiative', 0)}\n")
+
+    parts.append("\n")
+    return "".join(parts)
+
+def render_summary(summary):
+    if not summary or not summary.get('content'):
+        return ""
+    return f"STORY SO FAR:\n{summary['content']}\n\n"
+
+def render_history(history):
+    parts = []
+    for message in history:
+        role = message.get('role', '')
+        content = message.get('content', '')
+        if role == 'user':
+            parts.append(f"Player: {content}\n")
+        elif role == 'assistant':
+            parts.append(f"{content}\n")
+    return "".join(parts)
+
+# World sections in prompt order
+SECTION_RENDERERS = (
+    ('character', render_character),
+    ('locations', render_locations),
+    ('npcs', render_npcs),
+    ('quests', render_quests),
+    ('combat_state', render_combat_state),
+    ('summary', render_summary),
+)
+
+class PromptBuilder:
+    def __init__(self, max_sessions=256):
+        """max_sessions bounds how many sessions' rendered sections stay cached."""
+        self.max_sessions = max_sessions
+        self._prefixes = {}  # (game_state, native_tools) -> system prefix
+        self._sections = OrderedDict()  # session_id -> {section: (fingerprint, text)}
+        self._lock = threading.Lock()
+        self.stats = {"builds": 0, "prefix_hits": 0, "sections_rendered": 0, "sections_reused": 0}
+
+    def system_prefix(self, game_state, native_tools=False):
+        """The immutable system prompt for a game state, rendered once."""
+        key = (game_state, native_tools)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            prefix = self._prefixes[key] = get_base_prompt(game_state, native_tools) + "\n\n"
+        return prefix
+
+    def _section(self, cache, name, renderer, data):
+        """Render a section, or reuse the last rendering if its data is unchanged."""
+        fingerprint = json.dumps(data, sort_keys=True, default=str)
+        cached = cache.get(name)
+        if cached and cached[0] == fingerprint:
+            return cached[1], False
+
+        text = renderer(data)
+        cache[name] = (fingerprint, text)
+        return text, True
+
+    def build(self, session_id, game_state, current_message, history=(), character=None,
+              locations=None, npcs=None, quests=None, combat_state=None, summary=None,
+              vector_context=None, native_tools=False):
+        """
+        Assemble the prompt for one turn and record how long it took. With
+        native_tools the function documentation is left out, as the functions
+        are declared to the model API instead.
+        """
+        start = time.perf_counter()
+
+        prefix_hit = (game_state, native_tools) in self._prefixes
+        parts = [self.system_prefix(game_state, native_tools)]
+
+        data = {
+            'character': character,
+            'locations': locations,
+            'npcs': npcs,
+            'quests': quests,
+            'combat_state': combat_state,
+            'summary': summary,
+        }
+
+        rendered = []
+        updates = []
+        with self._lock:
+            cache = self._sections.setdefault(session_id, {})
+            self._sections.move_to_end(session_id)
+            while len(self._sections) > self.max_sessions:
+                self._sections.popitem(last=False)
+
+            for name, renderer in SECTION_RENDERERS:
+                text, was_rendered = self._section(cache, name, renderer, data[name])
+                parts.append(text)
+                if was_rendered:
+                    rendered.append(name)
+                    if name != 'summary':
+                        updates.append(text)
+
+        prefix_length = sum(len(part) for part in parts)
+
+        parts.append(render_history(history))
+        turn_offset = sum(len(part) for part in parts)
+        if vector_context:
+            parts.append(f"# ADDITIONAL CONTEXT FROM PREVIOUS INTERACTIONS\n{vector_context}\n\n")
+        parts.append(f"Player: {current_message}\n")
+
+        text = "".join(parts)
+
+        metrics = {
+            "build_ms": (time.perf_counter() - start) * 1000,
+            "prefix_cache_hit": prefix_hit,
+            "sections_rendered": rendered,
+            "prompt_chars": len(text),
+            "prefix_chars": prefix_length,
+        }
+
+        with self._lock:
+            self.stats["builds"] += 1
+            self.stats["prefix_hits"] += int(prefix_hit)
+            self.stats["sections_rendered"] += len(rendered)
+            self.stats["sections_reused"] += len(SECTION_RENDERERS) - len(rendered)
+
+        return BuiltPrompt(text=text, prefix_length=prefix_length, metrics=metrics,
+                           turn_offset=turn_offset, updates="".join(updates))
@@ -0,0 +1,283 @@
+# stub_llm_server.py
+# A stand-in for Ollama and the Gemini REST API for load testing. It answers
+# with canned Game Master responses (some with ```function``` blocks) after a
+# configurable delay, and streams them token by token when asked to. Requests
+# that declare tools (Ollama's /api/chat, Gemini function declarations) get
+# the same responses with their function blocks as structured calls.
+#
+#   python stub_llm_server.py --port 11434 --latency 0.5 --token-delay 0.01
+#   OLLAMA_API_URL=http://localhost:11434/api/generate python app.py
+#   GEMINI_API_BASE=http://localhost:11434/v1beta GEMINI_API_KEY=stub python app.py
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from function_parser import extract_function_calls
+
+CANNED_RESPONSES = [
+    "Game Master: The tavern falls quiet as you step inside. A hooded figure in the corner raises a hand.",
+    "Game Master: You follow the muddy road north until the ruins of an old watchtower rise out of the mist.\n\n"
+    "```function add_world_location({\"name\": \"Old Watchtower\", \"type\": \"ruin\", "
+    "\"description\": \"A crumbling tower on the northern road\"})```",
+    "Game Master: A broad-shouldered smith wipes soot from her hands and sizes you up.\n\n"
+    "```function add_npc({\"name\": \"Marta\", \"role\": \"blacksmith\", "
+    "\"description\": \"A blunt, kind-hearted smith\", \"location\": \"Old Watchtower\"})```",
+    "Game Master: The mayor begs you to find his missing daughter before the next full moon.\n\n"
+    "```function update_quest({\"title\": \"The Missing Daughter\", \"status\": \"in_progress\", "
+    "\"description\": \"Find the mayor's daughter before the full moon\", \"giver\": \"Mayor\"})```",
+    "Game Master: Steel rings as the bandits draw their blades. Roll for initiative!\n\n"
+    "```function update_combat_state({\"is_in_combat\": true, \"round\": 1, \"current_combatant\": \"Bandit\", "
+    "\"initiative_order\": [{\"name\": \"Bandit\", \"initiative\": 15}, {\"name\": \"Player\", \"initiative\": 12}]})```",
+    "Game Master: You find a small pouch of coins and a rusty key among the bandit's belongings.\n\n"
+    "```function update_character({\"inventory\": [\"Longsword\", \"Rusty key\", \"12 gold\"]})```",
+    # Runs on into the player's next line, which stop sequences should cut off
+    "Game Master: The innkeeper slides a mug across the bar. \"Anything else, traveller?\"\n"
+    "Player: I ask about the ruins to the north.\n"
+    "Game Master: She leans in and lowers her voice, telling a long story about the old watchtower.",
+]
+
+class StubConfig:
+    def __init__(self, latency=0.2, jitter=0.0, token_delay=0.01, chars_per_token=4, responses=None,
+                 shuffle=False, error_rate=0.0, prefill_delay=0.0, tools=True, split_tool_calls=False):
+        self.latency = latency  # Seconds before the first byte
+        self.jitter = jitter  # +/- random seconds added to latency
+        self.prefill_delay = prefill_delay  # Extra seconds per 1000 prompt characters processed
+        self.token_delay = token_delay  # Seconds between streamed tokens
+        self.chars_per_token = chars_per_token
+        self.responses = responses or CANNED_RESPONSES
+        self.shuffle = shuffle
+        self.error_rate = error_rate  # Fraction of requests answered with a 503
+        self.tools = tools  # Whether /api/show reports tool support
+        self.split_tool_calls = split_tool_calls  # Calls alone first, narrative after their results
+        self._cycle = itertools.cycle(range(len(self.responses)))
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def next_response(self):
+        with self._lock:
+            self.requests += 1
+            if self.shuffle:
+                return random.choice(self.responses)
+            return self.responses[next(self._cycle)]
+
+    def first_byte_delay(self, prompt=""):
+        prefill = self.prefill_delay * len(prompt) / 1000
+        return max(0.0, self.latency + prefill + random.uniform(-self.jitter, self.jitter))
+
+    def tokens(self, text):
+        # Split on whitespace boundaries roughly every chars_per_token characters
+        return re.findall(r'\S{1,%d}\s*|\s+' % max(self.chars_per_token, 1), text)
+
+    def generation_time(self, text, prompt=""):
+        """How long a non-streamed response takes: as if every token was generated."""
+        return self.first_byte_delay(prompt) + self.token_delay * len(self.tokens(text))
+
+    def limit(self, text, stop=None, max_tokens=None):
+        """Cut a response at the first stop sequence or after max_tokens; returns (text, reason)."""
+        reason = "stop"
+        for sequence in stop or []:
+            if sequence in text:
+                text = text[:text.index(sequence)]
+        if max_tokens:
+            tokens = self.tokens(text)
+            if len(tokens) > max_tokens:
+                text = "".join(tokens[:max_tokens])
+                reason = "length"
+        return text, reason
+
+    def context(self, request_body, text):
+        """Stand-in for Ollama's context: one number per token of everything processed so far."""
+        processed = len(request_body.get('prompt', '')) + len(text)
+        return list(request_body.get('context') or []) + [0] * (processed // max(self.chars_per_token, 1))
+
+    def tool_reply(self, text, tools_allowed, answering_results):
+        """
+        Split a response into narrative and (name, arguments) calls for a tool
+        calling request. With split_tool_calls a response with calls comes
+        back as the calls alone; the request that returns their results gets
+        the narrative of the next response.
+        """
+        narrative, calls = extract_function_calls(text)
+        if not tools_allowed or answering_results:
+            return narrative, []
+        calls = [(name, json.loads(args)) for name, args in calls]
+        if calls and self.split_tool_calls:
+            return "", calls
+        return narrative, calls
+
+def make_handler(config):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, like the real servers
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _start_stream(self, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+        def _write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        def _end_stream(self):
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.startswith('/api/tags'):
+                self._send_json(200, {"models": [{"name": "stub:latest"}]})
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            request_body = self._read_json()
+            if self.path.startswith('/api/show'):
+                self._send_json(200, {"capabilities": ["completion", "tools"] if config.tools else ["completion"]})
+                return
+            if config.error_rate and random.random() < config.error_rate:
+                self._send_json(503, {"error": "stub overloaded"})
+                return
+
+            text = config.next_response()
+            if self.path.startswith('/api/generate'):
+                self._ollama(request_body, text)
+            elif self.path.startswith('/api/chat'):
+                self._ollama_chat(request_body, text)
+            elif ':generateContent' in self.path or ':streamGenerateContent' in self.path:
+                generation_config = request_body.get('generationConfig') or {}
+                text, reason = config.limit(text, generation_config.get('stopSequences'),
+                                            generation_config.get('maxOutputTokens'))
+                reason = "STOP" if reason == "stop" else "MAX_TOKENS"
+                if ':streamGenerateContent' in self.path:
+                    self._gemini_stream(text, gemini_prompt(request_body), reason)
+                else:
+                    calls = []
+                    if request_body.get('tools'):
+                        mode = request_body.get('toolConfig', {}).get('functionCallingConfig', {}).get('mode', 'AUTO')
+                        contents = request_body.get('contents') or [{}]
+                        answering = any('functionResponse' in part for part in contents[-1].get('parts', []))
+                        text, calls = config.tool_reply(text, mode != 'NONE', answering)
+                    time.sleep(config.generation_time(text, gemini_prompt(request_body)))
+                    self._send_json(200, gemini_payload(text, reason, calls))
+            else:
+                self._send_json(404, {"error": f"unknown endpoint {self.path}"})
+
+        def _ollama(self, request_body, text):
+            prompt = request_body.get('prompt', '')
+            options = request_body.get('options') or {}
+            text, reason = config.limit(text, options.get('stop'), options.get('num_predict'))
+            context = config.context(request_body, text)
+            if not request_body.get('stream', True):
+                time.sleep(config.generation_time(text, prompt))
+                self._send_json(200, {"model": request_body.get('model'), "response": text, "done": True,
+                                      "done_reason": reason, "context": context})
+                return
+
+            time.sleep(config.first_byte_delay(prompt))
+            self._start_stream('application/x-ndjson')
+            for token in config.tokens(text):
+                self._write_chunk((json.dumps({"response": token, "done": False}) + "\n").encode('utf-8'))
+                time.sleep(config.token_delay)
+            self._write_chunk((json.dumps({"response": "", "done": True, "done_reason": reason,
+                                           "context": context}) + "\n").encode('utf-8'))
+            self._end_stream()
+
+        def _ollama_chat(self, request_body, text):
+            # Only the non-streamed form, which tool calling uses
+            messages = request_body.get('messages') or []
+            prompt = "".join(message.get('content', '') for message in messages)
+            options = request_body.get('options') or {}
+            text, reason = config.limit(text, options.get('stop'), options.get('num_predict'))
+            answering = bool(messages) and messages[-1].get('role') == 'tool'
+            text, calls = config.tool_reply(text, bool(request_body.get('tools')), answering)
+
+            time.sleep(config.generation_time(text, prompt))
+            message = {"role": "assistant", "content": text}
+            if calls:
+                message["tool_calls"] = [{"function": {"name": name, "arguments": arguments}}
+                                         for name, arguments in calls]
+            self._send_json(200, {"model": request_body.get('model'), "message": message, "done": True,
+                                  "done_reason": reason})
+
+        def _gemini_stream(self, text, prompt, reason):
+            time.sleep(config.first_byte_delay(prompt))
+            self._start_stream('text/event-stream')
+            tokens = config.tokens(text)
+            for n, token in enumerate(tokens):
+                payload = gemini_payload(token, reason if n == len(tokens) - 1 else None)
+                self._write_chunk(f"data: {json.dumps(payload)}\r\n\r\n".encode('utf-8'))
+                time.sleep(config.token_delay)
+            self._end_stream()
+
+    return StubHandler
+
+def gemini_prompt(request_body):
+    system = request_body.get('systemInstruction', {}).get('parts', [])
+    return "".join(part.get('text', '') for content in [{"parts": system}] + request_body.get('contents', [])
+                   for part in content.get('parts', []))
+
+def gemini_payload(text, finish_reason=None, calls=()):
+    parts = [{"text": text}] if text or not calls else []
+    parts.extend({"functionCall": {"name": name, "args": arguments}} for name, arguments in calls)
+    candidate = {"content": {"role": "model", "parts": parts}}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    return {"candidates": [candidate]}
+
+def serve(host, port, config):
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stub Ollama/Gemini server with canned responses")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- seconds on the latency")
+    parser.add_argument("--prefill-delay", type=float, default=0.0,
+                        help="Extra seconds per 1000 prompt characters, to model prompt processing")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Seconds between tokens")
+    parser.add_argument("--chars-per-token", type=int, default=4)
+    parser.add_argument("--responses", help="JSON file with a list of response strings to use instead")
+    parser.add_argument("--shuffle", action="store_true", help="Pick responses at random instead of in turn")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failed with 503")
+    parser.add_argument("--no-tools", action="store_true", help="Report the Ollama model as not supporting tools")
+    parser.add_argument("--split-tool-calls", action="store_true",
+                        help="Return tool calls without narrative, which then needs a second request")
+    args = parser.parse_args()
+
+    responses = None
+    if args.responses:
+        with open(args.responses) as f:
+            responses = json.load(f)
+
+    config = StubConfig(args.latency, args.jitter, args.token_delay, args.chars_per_token, responses,
+                        args.shuffle, args.error_rate, args.prefill_delay, not args.no_tools,
+                        args.split_tool_calls)
+    server = serve(args.host, args.port, config)
+    print(f"Stub LLM server on http://{args.host}:{args.port} "
+          f"(latency {args.latency}s, {args.token_delay}s per token)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
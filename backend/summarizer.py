@@ -0,0 +1,159 @@
+# summarizer.py
+# Background compaction of long conversations into rolling summaries.
+# Older turns are folded into a stored summary so the prompt only needs the
+# summary plus a short recent tail, and the vector store only keeps
+# conversation entries that have not been summarized yet.
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('dnd_gm_assistant.summarizer')
+
+SUMMARY_PROMPT = """You are keeping the campaign log for a D&D game.
+Rewrite the story so far as a concise summary of at most {max_words} words.
+Keep names of characters, NPCs, places and quests, important decisions, items gained or lost, and unresolved threads.
+Write in past tense, third person. Do not invent anything that is not in the log.
+
+PREVIOUS SUMMARY:
+{previous_summary}
+
+NEW EVENTS:
+{transcript}
+
+SUMMARY:"""
+
+def format_transcript(messages):
+    """Render messages the same way they appear in the game prompt."""
+    lines = []
+    for message in messages:
+        content = (message.get('content') or '').strip()
+        if message.get('role') == 'user':
+            lines.append(f"Player: {content}")
+        else:
+            lines.append(content)
+    return "\n".join(lines)
+
+def local_summary(previous_summary, messages, max_chars=2000):
+    """
+    Extractive stand-in used when no model is available: keep the first
+    sentence of every message and drop the oldest lines once over max_chars.
+    """
+    lines = [previous_summary] if previous_summary else []
+    for message in messages:
+        content = (message.get('content') or '').strip()
+        content = re.sub(r'^Game Master:\s*', '', content)
+        if not content:
+            continue
+        first_sentence = re.split(r'(?<=[.!?])\s', content, maxsplit=1)[0][:200]
+        speaker = "Player" if message.get('role') == 'user' else "GM"
+        lines.append(f"{speaker}: {first_sentence}")
+    
+    summary = "\n".join(lines)
+    if len(summary) > max_chars:
+        summary = summary[-max_chars:]
+        # Don't start in the middle of a line
+        summary = summary.split("\n", 1)[-1]
+    return summary
+
+class ConversationSummarizer:
+    def __init__(self, db_manager, vector_db_manager=None, summarize_fn=None,
+                 keep_recent=20, min_batch=20, max_batch=200, max_summary_chars=2000, memory_queue=None):
+        """
+        summarize_fn takes a prompt string and returns the model's text (for
+        example call_ollama_api). Without one, or when it fails, the extractive
+        local_summary is used instead.
+        memory_queue (the MemoryIngestionQueue) holds conversation memories
+        that aren't in the vector store yet; the ones a summary covers are
+        stored before it replaces them, or dropped from the queue.
+        keep_recent messages are always left raw for the prompt tail; compaction
+        runs once at least min_batch older messages are waiting.
+        """
+        self.db = db_manager
+        self.vector_db = vector_db_manager
+        self.memory_queue = memory_queue
+        self.summarize_fn = summarize_fn
+        self.keep_recent = keep_recent
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.max_summary_chars = max_summary_chars
+        
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summarizer')
+        self._scheduled = set()
+        self._lock = threading.Lock()
+    
+    def schedule(self, session_id):
+        """Queue a compaction pass for a session unless one is already waiting."""
+        with self._lock:
+            if session_id in self._scheduled:
+                return None
+            self._scheduled.add(session_id)
+        return self._executor.submit(self._run, session_id)
+    
+    def _run(self, session_id):
+        with self._lock:
+            self._scheduled.discard(session_id)
+        try:
+            return self.compact(session_id)
+        except Exception as e:
+            logger.error(f"Summarization failed for session {session_id}: {str(e)}")
+            return None
+    
+    def compact(self, session_id):
+        """
+        Fold the oldest unsummarized messages into a new summary.
+        Returns the stored summary id, or None when there was nothing to do.
+        """
+        summary = self.db.get_latest_summary(session_id)
+        covers_until = summary['covers_until'] if summary else None
+        
+        pending = self.db.count_messages(session_id, after=covers_until) - self.keep_recent
+        if pending < self.min_batch:
+            return None
+        
+        messages = self.db.get_message_range(session_id, after=covers_until,
+                                             limit=min(pending, self.max_batch))
+        if not messages:
+            return None
+        
+        previous_summary = summary['content'] if summary else ''
+        content = self._summarize(previous_summary, messages)
+        new_covers_until = messages[-1]['timestamp']
+        message_count = (summary['message_count'] if summary else 0) + len(messages)
+        
+        # Memories still queued would be ingested after the compaction below and
+        # show up next to their summary: store ours first, and drop the rows
+        # other processes haven't picked up together with saving the summary
+        if self.memory_queue:
+            self.memory_queue.flush(session_id)
+        with self.db.transaction():
+            summary_id = self.db.save_summary(session_id, content, new_covers_until, message_count)
+            self.db.drop_queued_conversations(session_id, new_covers_until)
+        
+        # Replace the summarized conversation vectors with the summary itself
+        if self.vector_db:
+            self.vector_db.compact_conversation_memory(session_id, content, new_covers_until)
+        
+        logger.info(f"Compacted {len(messages)} messages for session {session_id} "
+                    f"({message_count} summarized in total)")
+        return summary_id
+    
+    def _summarize(self, previous_summary, messages):
+        if self.summarize_fn:
+            prompt = SUMMARY_PROMPT.format(
+                max_words=self.max_summary_chars // 6,
+                previous_summary=previous_summary or "(none)",
+                transcript=format_transcript(messages)
+            )
+            try:
+                text = (self.summarize_fn(prompt) or '').strip()
+                if text:
+                    return text[:self.max_summary_chars]
+            except Exception as e:
+                logger.warning(f"Model summarization failed, using local summary: {str(e)}")
+        
+        return local_summary(previous_summary, messages, self.max_summary_chars)
+    
+    def shutdown(self, wait=True):
+        """Stop accepting work; with wait=True, finish queued compactions first."""
+        self._executor.shutdown(wait=wait)
@@ -1,77 +1,428 @@
 # VectorDBManager class for managing a vector database using ChromaDB and Sentence Transformers
 # This class handles the addition and querying of various types of memories (conversations, characters, NPCs, locations, quests)
 import os
+import re
+import zlib
+import logging
 import chromadb
 from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
+from embedding import get_embedder, content_hash
+from metrics import registry, timed
 import uuid
 import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 
+logger = logging.getLogger('dnd_gm_assistant.vector_db')
+
+VECTOR_SECONDS = registry.histogram(
+    'dnd_vector_operation_seconds', 'Time spent in VectorDBManager operations', ('operation',)
+)
+SKIPPED_WRITES = registry.counter(
+    'dnd_vector_skipped_writes_total', 'Entity upserts skipped because the document was unchanged'
+)
+
+# Field that names each kind of entity; it is also part of the entity's id
+ENTITY_KEYS = {
+    "character": "name",
+    "npc": "name",
+    "location": "name",
+    "quest": "title",
+}
+
+# Base collection name for each kind of memory
+COLLECTION_NAMES = {
+    "character": "characters",
+    "npc": "npcs",
+    "location": "locations",
+    "quest": "quests",
+    "conversation": "conversations",
+}
+
+# global: one collection per kind shared by every session, filtered by session_id
+# session: one collection per kind and session
+# shard: sessions hashed into a fixed number of collections per kind
+PARTITIONING_MODES = ("global", "session", "shard")
+
+def partition_name(kind, session_id=None, partitioning="global", shards=16):
+    """Name of the collection holding a session's memories of one kind."""
+    base = COLLECTION_NAMES[kind]
+    if partitioning == "global":
+        return base
+    if partitioning == "shard":
+        return f"{base}_shard{zlib.crc32(session_id.encode('utf-8')) % shards:03d}"
+    
+    # Chroma names only allow [a-zA-Z0-9._-] and must end with a letter or
+    # digit; session ids are UUIDs, anything else is hashed
+    suffix = session_id
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,200}', suffix) or not suffix[-1].isalnum():
+        suffix = content_hash(session_id)[:32]
+    return f"{base}_s_{suffix}"
+
+# query_by_context result key for each kind of memory
+RESULT_KEYS = {
+    "character": "characters",
+    "npc": "npcs",
+    "location": "locations",
+    "quest": "quests",
+    "conversation": "recent_conversations",
+}
+
+@dataclass
+class MemoryHit:
+    """One search result: which collection it came from and how close it was."""
+    kind: str
+    id: str
+    document: str
+    score: float  # Similarity, higher is better; blended with recency by rank_by_recency
+    data: dict = field(default_factory=dict)  # Stored entity data, if any
+    metadata: dict = field(default_factory=dict)
+    recency: float = None  # 1.0 for the newest memory, halving every recency_half_life turns
+
+def recency_decay(age, half_life):
+    """Exponential decay: 1.0 now, 0.5 after half_life turns."""
+    return 0.5 ** (max(age, 0) / half_life)
+
+def distance_to_similarity(distance, space="l2"):
+    """Turn a Chroma distance into a similarity for normalized embeddings."""
+    if space == "l2":
+        # Squared L2 between unit vectors is 2 - 2 * cosine similarity
+        return 1.0 - distance / 2.0
+    # cosine and ip distances are both 1 - similarity
+    return 1.0 - distance
+
 class VectorDBManager:
-    def __init__(self, db_directory="chroma_db"):
-        """Initialize the vector database manager."""
-        # Create the directory if it doesn't exist
-        os.makedirs(db_directory, exist_ok=True)
+    # How many entity document hashes to remember for skipping unchanged writes
+    DOC_HASH_ENTRIES = 10000
+    # Seconds a collection found missing is taken to still not exist
+    MISSING_TTL = 10.0
+    
+    def __init__(self, db_directory="chroma_db", embedder=None, partitioning="global", shards=16,
+                 max_open_partitions=64, memory_limit_bytes=None, sequence_store=None,
+                 recency_weight=0.3, recency_half_life=20, recency_overfetch=3, host=None, port=8000):
+        """
+        Initialize the vector database manager. embedder defaults to the
+        shared SentenceTransformer embedder configured from the environment.
+        partitioning is one of PARTITIONING_MODES; with "session" or "shard",
+        collections are opened lazily and at most max_open_partitions handles
+        are kept, least recently used first out. memory_limit_bytes lets
+        Chroma evict idle collection segments from memory the same way.
+        
+        sequence_store (the DatabaseManager) numbers each session's
+        conversation memories so retrieval can favour recent turns, however
+        the workers ordered their writes: conversation hits are scored
+        (1 - recency_weight) * similarity + recency_weight * recency, chosen
+        from recency_overfetch times as many candidates as are returned.
+        
+        With host set, collections live on a Chroma server instead of in
+        db_directory. Embedded Chroma must only be opened by one process, so
+        deployments running several app workers point them all at a server.
+        """
+        if partitioning not in PARTITIONING_MODES:
+            raise ValueError(f"Unknown vector partitioning: {partitioning}")
+        self.partitioning = partitioning
+        self.shards = shards
+        self.max_open_partitions = max_open_partitions
+        self.sequence_store = sequence_store
+        self.recency_weight = recency_weight
+        self.recency_half_life = recency_half_life
+        self.recency_overfetch = recency_overfetch
         
         # Initialize ChromaDB client
-        self.client = chromadb.PersistentClient(
-            path=db_directory,
-            settings=Settings(anonymized_telemetry=False)
-        )
+        settings = Settings(anonymized_telemetry=False)
+        if host:
+            self.client = chromadb.HttpClient(host=host, port=port, settings=settings)
+        else:
+            if memory_limit_bytes:
+                settings = Settings(
+                    anonymized_telemetry=False,
+                    chroma_segment_cache_policy="LRU",
+                    chroma_memory_limit_bytes=memory_limit_bytes
+                )
+            
+            # Create the directory if it doesn't exist
+            os.makedirs(db_directory, exist_ok=True)
+            self.client = chromadb.PersistentClient(
+                path=db_directory,
+                settings=settings
+            )
+        
+        # Initialize the embedding model; collections embed through it rather
+        # than Chroma's own default model, so only one copy is loaded
+        self.embedder = embedder or get_embedder()
+        self.model = self.embedder.model
         
-        # Initialize the embedding model
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')  # A lightweight, fast model
+        # Collection name -> handle, most recently used last
+        self._handles = OrderedDict()
+        # Collection name -> when it was found missing; another worker may
+        # create it, so a miss is only trusted for MISSING_TTL seconds
+        self._missing = OrderedDict()
+        self._handles_lock = threading.Lock()
         
         # Initialize collections for different types of memories
         # Create collections if they don't exist, otherwise get existing ones
-        self.conversation_collection = self._get_or_create_collection("conversations")
-        self.character_collection = self._get_or_create_collection("characters")
-        self.npc_collection = self._get_or_create_collection("npcs")
-        self.location_collection = self._get_or_create_collection("locations")
-        self.quest_collection = self._get_or_create_collection("quests")
-        
+        if partitioning == "global":
+            self.conversation_collection = self._collection("conversation")
+            self.character_collection = self._collection("character")
+            self.npc_collection = self._collection("npc")
+            self.location_collection = self._collection("location")
+            self.quest_collection = self._collection("quest")
+        
+        # search() queries every kind at once; one worker per kind
+        self._query_pool = ThreadPoolExecutor(max_workers=len(COLLECTION_NAMES), thread_name_prefix='vector-query')
+        
+        # (kind, entity id) -> hash of the last document written for it. Only
+        # kept with embedded Chroma, where this process is the only writer; on
+        # a shared server another worker may have written a newer version, so
+        # the hashes stored in the collection's metadata are read every time.
+        self._cache_doc_hashes = not host
+        self._doc_hashes = OrderedDict()
+        self._doc_hashes_lock = threading.Lock()
+        self.skipped_writes = 0
+        
+    def close(self):
+        """Stop the search threads; call on shutdown."""
+        self._query_pool.shutdown(wait=True)
+    
     def _get_or_create_collection(self, name):
         """Get an existing collection or create a new one if it doesn't exist."""
-        try:
-            return self.client.get_collection(name=name)
-        except:
-            return self.client.create_collection(name=name)
+        # Partitions are created lazily from several threads, so this has to be race-free
+        return self.client.get_or_create_collection(name=name, embedding_function=self.embedder)
+    
+    def _collection(self, kind, session_id=None, create=True):
+        """
+        Collection holding session_id's memories of one kind. With create=False
+        a partition that doesn't exist yet gives None instead of being created;
+        the miss is remembered until the collection is created here or
+        MISSING_TTL passes.
+        """
+        name = partition_name(kind, session_id, self.partitioning, self.shards)
+        with self._handles_lock:
+            collection = self._handles.get(name)
+            if collection is not None:
+                self._handles.move_to_end(name)
+                return collection
+            missing_since = self._missing.get(name)
+            if not create and missing_since is not None and time.monotonic() - missing_since < self.MISSING_TTL:
+                return None
+        
+        if create:
+            collection = self._get_or_create_collection(name)
+        else:
+            try:
+                collection = self.client.get_collection(name=name, embedding_function=self.embedder)
+            except Exception:
+                with self._handles_lock:
+                    self._missing[name] = time.monotonic()
+                    self._missing.move_to_end(name)
+                    while len(self._missing) > self.max_open_partitions:
+                        self._missing.popitem(last=False)
+                return None
+        
+        with self._handles_lock:
+            self._missing.pop(name, None)
+            self._handles[name] = collection
+            self._handles.move_to_end(name)
+            # The global collections are never evicted: there are only five
+            while len(self._handles) > max(self.max_open_partitions, len(COLLECTION_NAMES)):
+                self._handles.popitem(last=False)
+        return collection
+    
+    def _where(self, session_id, condition=None):
+        """
+        Metadata filter restricting a query to one session. Per-session
+        collections only hold that session, so they need no session filter.
+        """
+        clauses = [] if self.partitioning == "session" else [{"session_id": session_id}]
+        if condition:
+            clauses.append(condition)
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
     
     def _create_embedding(self, text):
         """Create embedding vector for the given text."""
-        return self.model.encode(text).tolist()
+        return self.embedder.embed_query(text)
     
-    def add_conversation_memory(self, session_id, role, content, metadata=None):
+    def add_conversation_memory(self, session_id, role, content, metadata=None, memory_id=None, timestamp=None):
         """Add a conversation message to the vector database."""
-        if not metadata:
-            metadata = {}
-            
-        # Add session_id and timestamp to metadata
-        metadata.update({
+        return self.add_conversation_memories([{
             "session_id": session_id,
             "role": role,
-            "timestamp": datetime.now().isoformat()
-        })
+            "content": content,
+            "metadata": metadata,
+            "memory_id": memory_id,
+            "timestamp": timestamp
+        }])[0]
+    
+    @timed(VECTOR_SECONDS)
+    def add_conversation_memories(self, entries):
+        """
+        Add several conversation messages in one write so they are embedded
+        as a single batch. Each entry is a dict with session_id, role, content
+        and optionally metadata, memory_id, timestamp (ISO string) and seq (the
+        session ordinal, reserved here when missing); entries with a memory_id
+        are idempotent and can safely be written twice.
+        """
+        ids = []
+        writes = OrderedDict()  # collection name -> (collection, documents, metadatas, ids)
+        
+        for entry in entries:
+            metadata = dict(entry.get("metadata") or {})
+            
+            # Add session_id and timestamp to metadata
+            when = datetime.fromisoformat(entry["timestamp"]) if entry.get("timestamp") else datetime.now()
+            metadata.update({
+                "session_id": entry["session_id"],
+                "role": entry["role"],
+                "timestamp": when.isoformat(),
+                "ts": when.timestamp()  # Numeric copy so compaction can filter with $lte
+            })
+            
+            seq = entry.get("seq")
+            if seq is None and self.sequence_store:
+                seq = self.sequence_store.reserve_memory_seq(entry["session_id"])
+            if seq is not None:
+                metadata["seq"] = seq
+            
+            # Create a unique ID for this memory
+            memory_id = entry.get("memory_id") or str(uuid.uuid4())
+            ids.append(memory_id)
+            
+            name = partition_name("conversation", entry["session_id"], self.partitioning, self.shards)
+            if name not in writes:
+                writes[name] = (self._collection("conversation", entry["session_id"]), [], [], [])
+            collection, documents, metadatas, write_ids = writes[name]
+            documents.append(entry["content"])
+            metadatas.append(metadata)
+            write_ids.append(memory_id)
+        
+        for collection, documents, metadatas, write_ids in writes.values():
+            # Add the text and its embedding to the collection
+            collection.upsert(
+                documents=documents,
+                metadatas=metadatas,
+                ids=write_ids
+            )
+        
+        return ids
+    
+    @timed(VECTOR_SECONDS)
+    def compact_conversation_memory(self, session_id, summary, covers_until):
+        """
+        Replace a session's conversation entries up to covers_until (the SQLite
+        timestamp of the last summarized message) with one summary document.
+        """
+        cutoff = datetime.fromisoformat(str(covers_until)).timestamp()
         
-        # Create a unique ID for this memory
-        memory_id = str(uuid.uuid4())
+        # Entries are written just after their SQLite row, so one straddling
+        # the cutoff survives until the next compaction; that's harmless
+        collection = self._collection("conversation", session_id)
+        collection.delete(
+            where=self._where(session_id, {"ts": {"$lte": cutoff}})
+        )
         
-        # Add the text and its embedding to the collection
-        self.conversation_collection.add(
-            documents=[content],
-            metadatas=[metadata],
-            ids=[memory_id]
+        # The previous summary has an older ts and was deleted above
+        collection.upsert(
+            documents=[summary],
+            metadatas=[{
+                "session_id": session_id,
+                "role": "summary",
+                "timestamp": datetime.fromtimestamp(cutoff).isoformat(),
+                "ts": cutoff
+            }],
+            ids=[f"{session_id}_summary"]
         )
+    
+    @timed(VECTOR_SECONDS)
+    def upsert_entities(self, session_id, kind, records):
+        """
+        Write several entities of one kind ("character", "npc", "location" or
+        "quest") with a single upsert. Returns the id used for each record, or
+        None for records without a name/title. Entities whose document is
+        unchanged since the last write are skipped without being embedded.
+        """
+        key_field = ENTITY_KEYS[kind]
+        render = getattr(self, f"_{kind}_document")
+        
+        ids = []
+        batch = OrderedDict()  # entity id -> (document, metadata); a later record for the same id wins
+        for record in records:
+            if key_field not in record:
+                ids.append(None)  # Skip if no name is present
+                continue
+            
+            # Create a unique ID based on session_id + entity name
+            entity_id = f"{session_id}_{record.get(key_field, 'unnamed')}"
+            ids.append(entity_id)
+            
+            document = render(record)
+            metadata = {"session_id": session_id, "data": json.dumps(record)}
+            metadata["doc_hash"] = content_hash(document + "\0" + json.dumps(metadata, sort_keys=True))
+            batch.pop(entity_id, None)
+            batch[entity_id] = (document, metadata)
+        
+        if not batch:
+            return ids
+        
+        collection = self._collection(kind, session_id)
+        with self._doc_hashes_lock:
+            known = {
+                entity_id: self._doc_hashes.get((kind, entity_id)) if self._cache_doc_hashes else None
+                for entity_id in batch
+            }
+        
+        # Entities we haven't written since startup (or every entity on a shared
+        # server): their stored hash tells us whether they changed, fetched for
+        # the whole batch in one call
+        unknown = [entity_id for entity_id, doc_hash in known.items() if doc_hash is None]
+        if unknown:
+            stored = collection.get(ids=unknown, include=["metadatas"])
+            for entity_id, metadata in zip(stored["ids"], stored["metadatas"]):
+                known[entity_id] = (metadata or {}).get("doc_hash")
+        
+        changed = [entity_id for entity_id, (document, metadata) in batch.items()
+                   if known[entity_id] != metadata["doc_hash"]]
+        self.skipped_writes += len(batch) - len(changed)
+        SKIPPED_WRITES.inc(len(batch) - len(changed))
+        
+        if changed:
+            collection.upsert(
+                ids=changed,
+                documents=[batch[entity_id][0] for entity_id in changed],
+                metadatas=[batch[entity_id][1] for entity_id in changed]
+            )
+        
+        for entity_id, (document, metadata) in batch.items():
+            self._remember_doc_hash(kind, entity_id, metadata["doc_hash"])
         
-        return memory_id
+        return ids
+    
+    def _remember_doc_hash(self, kind, entity_id, doc_hash):
+        if not self._cache_doc_hashes:
+            return
+        with self._doc_hashes_lock:
+            self._doc_hashes[(kind, entity_id)] = doc_hash
+            self._doc_hashes.move_to_end((kind, entity_id))
+            while len(self._doc_hashes) > self.DOC_HASH_ENTRIES:
+                self._doc_hashes.popitem(last=False)
+    
+    def cache_stats(self):
+        """Embedding cache counters plus how many entity writes were skipped as unchanged."""
+        stats = self.embedder.cache.stats() if getattr(self.embedder, "cache", None) else {}
+        stats["skipped_writes"] = self.skipped_writes
+        return stats
     
     def add_character_memory(self, session_id, character_data):
         """Add character information to the vector database."""
-        # Convert character data to a text description for embedding
-        if "name" not in character_data:
-            return None  # Skip if no name is present
-            
+        return self.upsert_entities(session_id, "character", [character_data])[0]
+    
+    def _character_document(self, character_data):
+        """Text that is embedded for a character."""
         # Create a textual representation of the character
         text_representation = f"Character {character_data.get('name')}: "
         text_representation += f"a {character_data.get('race', 'unknown race')} "
@@ -86,37 +437,14 @@ class VectorDBManager:
         if 'inventory' in character_data and character_data['inventory']:
             text_representation += "Inventory: " + ", ".join(character_data['inventory'])
         
-        # Create a unique ID based on session_id + character name
-        character_id = f"{session_id}_{character_data.get('name', 'unnamed')}"
-        
-        # Check if this character already exists in the collection
-        existing_results = self.character_collection.get(
-            ids=[character_id],
-            include=["metadatas"]
-        )
-        
-        # If character exists, update it
-        if existing_results and len(existing_results['ids']) > 0:
-            self.character_collection.update(
-                documents=[text_representation],
-                metadatas=[{"session_id": session_id, "data": json.dumps(character_data)}],
-                ids=[character_id]
-            )
-        else:
-            # Add the character to the collection
-            self.character_collection.add(
-                documents=[text_representation],
-                metadatas=[{"session_id": session_id, "data": json.dumps(character_data)}],
-                ids=[character_id]
-            )
-        
-        return character_id
+        return text_representation
     
     def add_npc_memory(self, session_id, npc_data):
         """Add NPC information to the vector database."""
-        if "name" not in npc_data:
-            return None  # Skip if no name is present
-            
+        return self.upsert_entities(session_id, "npc", [npc_data])[0]
+    
+    def _npc_document(self, npc_data):
+        """Text that is embedded for an NPC."""
         # Create a textual representation of the NPC
         text_representation = f"NPC {npc_data.get('name')}: "
         
@@ -132,37 +460,14 @@ class VectorDBManager:
         if 'personality' in npc_data:
             text_representation += f"Personality: {npc_data['personality']}. "
         
-        # Create a unique ID based on session_id + NPC name
-        npc_id = f"{session_id}_{npc_data.get('name', 'unnamed')}"
-        
-        # Check if this NPC already exists in the collection
-        existing_results = self.npc_collection.get(
-            ids=[npc_id],
-            include=["metadatas"]
-        )
-        
-        # If NPC exists, update it
-        if existing_results and len(existing_results['ids']) > 0:
-            self.npc_collection.update(
-                documents=[text_representation],
-                metadatas=[{"session_id": session_id, "data": json.dumps(npc_data)}],
-                ids=[npc_id]
-            )
-        else:
-            # Add the NPC to the collection
-            self.npc_collection.add(
-                documents=[text_representation],
-                metadatas=[{"session_id": session_id, "data": json.dumps(npc_data)}],
-                ids=[npc_id]
-            )
-        
-        return npc_id
+        return text_representation
     
     def add_location_memory(self, session_id, location_data):
         """Add location information to the vector database."""
-        if "name" not in location_data:
-            return None  # Skip if no name is present
-            
+        return self.upsert_entities(session_id, "location", [location_data])[0]
+    
+    def _location_document(self, location_data):
+        """Text that is embedded for a location."""
         # Create a textual representation of the location
         text_representation = f"Location {location_data.get('name')}: "
         
@@ -175,37 +480,14 @@ class VectorDBManager:
         if 'points_of_interest' in location_data and location_data['points_of_interest']:
             text_representation += "Points of interest: " + ", ".join(location_data['points_of_interest'])
         
-        # Create a unique ID based on session_id + location name
-        location_id = f"{session_id}_{location_data.get('name', 'unnamed')}"
-        
-        # Check if this location already exists in the collection
-        existing_results = self.location_collection.get(
-            ids=[location_id],
-            include=["metadatas"]
-        )
-        
-        # If location exists, update it
-        if existing_results and len(existing_results['ids']) > 0:
-            self.location_collection.update(
-                documents=[text_representation],
-                metadatas=[{"session_id": session_id, "data": json.dumps(location_data)}],
-                ids=[location_id]
-            )
-        else:
-            # Add the location to the collection
-            self.location_collection.add(
-                documents=[text_representation],
-                metadatas=[{"session_id": session_id, "data": json.dumps(location_data)}],
-                ids=[location_id]
-            )
-        
-        return location_id
+        return text_representation
     
     def add_quest_memory(self, session_id, quest_data):
         """Add quest information to the vector database."""
-        if "title" not in quest_data:
-            return None  # Skip if no title is present
-            
+        return self.upsert_entities(session_id, "quest", [quest_data])[0]
+    
+    def _quest_document(self, quest_data):
+        """Text that is embedded for a quest."""
         # Create a textual representation of the quest
         text_representation = f"Quest: {quest_data.get('title')}. "
         
@@ -224,68 +506,97 @@ class VectorDBManager:
         if 'reward' in quest_data:
             text_representation += f"Reward: {quest_data['reward']}. "
         
-        # Create a unique ID based on session_id + quest title
-        quest_id = f"{session_id}_{quest_data.get('title', 'unnamed')}"
-        
-        # Check if this quest already exists in the collection
-        existing_results = self.quest_collection.get(
-            ids=[quest_id],
-            include=["metadatas"]
-        )
-        
-        # If quest exists, update it
-        if existing_results and len(existing_results['ids']) > 0:
-            self.quest_collection.update(
-                documents=[text_representation],
-                metadatas=[{"session_id": session_id, "data": json.dumps(quest_data)}],
-                ids=[quest_id]
-            )
-        else:
-            # Add the quest to the collection
-            self.quest_collection.add(
-                documents=[text_representation],
-                metadatas=[{"session_id": session_id, "data": json.dumps(quest_data)}],
-                ids=[quest_id]
+        return text_representation
+    
+    @timed(VECTOR_SECONDS)
+    def _search_collection(self, kind, query_embedding, session_id, limit):
+        """Run one similarity search and convert the rows into MemoryHits."""
+        collection = self._collection(kind, session_id, create=False)
+        if collection is None:
+            return []  # Nothing stored for this session yet
+        
+        with VECTOR_SECONDS.time(operation=f"query_{COLLECTION_NAMES[kind]}"):
+            results = collection.query(
+                query_embeddings=[query_embedding],
+                where=self._where(session_id),
+                n_results=limit,
+                include=["documents", "metadatas", "distances"]
             )
         
-        return quest_id
+        # Chroma returns one list per query embedding; we only sent one
+        ids = (results.get("ids") or [[]])[0]
+        documents = (results.get("documents") or [[]])[0]
+        metadatas = (results.get("metadatas") or [[]])[0]
+        distances = (results.get("distances") or [[]])[0]
+        space = (collection.metadata or {}).get("hnsw:space", "l2")
+        
+        hits = []
+        for memory_id, document, metadata, distance in zip(ids, documents, metadatas, distances):
+            metadata = metadata or {}
+            data = {}
+            if "data" in metadata:
+                try:
+                    data = json.loads(metadata["data"])
+                except (TypeError, ValueError):
+                    pass
+            hits.append(MemoryHit(
+                kind=kind,
+                id=memory_id,
+                document=document,
+                score=distance_to_similarity(distance, space),
+                data=data,
+                metadata=metadata
+            ))
+        return hits
     
-    def query_recent_conversations(self, session_id, query_text=None, limit=10):
+    @timed(VECTOR_SECONDS)
+    def search(self, session_id, query_text, limit=5, kinds=None, overfetch=None):
         """
-        Query the most recent conversations for a session.
-        If query_text is provided, it will return the most relevant conversations.
-        Otherwise, it will return the most recent conversations.
+        Search several collections for a query, embedding it only once.
+        The per-collection searches run concurrently; the merged hits come
+        back best first. kinds defaults to every collection; overfetch maps a
+        kind to how many times limit results to fetch from it.
         """
-        if query_text:
-            # Search by semantic similarity if query text is provided
-            results = self.conversation_collection.query(
-                query_texts=[query_text],
-                where={"session_id": session_id},
-                n_results=limit,
-                include=["documents", "metadatas"]
-            )
-        else:
-            # Get the most recent conversations if no query text is provided
-            # This requires querying all and then sorting by timestamp
-            results = self.conversation_collection.get(
-                where={"session_id": session_id},
-                include=["documents", "metadatas"]
-            )
-            
-            # Sort by timestamp (most recent first)
-            if results and 'metadatas' in results and results['metadatas']:
-                sorted_indices = sorted(
-                    range(len(results['metadatas'])), 
-                    key=lambda i: results['metadatas'][i].get('timestamp', ''),
-                    reverse=True
-                )
-                
-                # Reorder the results based on timestamp
-                results['ids'] = [results['ids'][i] for i in sorted_indices][:limit]
-                results['documents'] = [results['documents'][i] for i in sorted_indices][:limit]
-                results['metadatas'] = [results['metadatas'][i] for i in sorted_indices][:limit]
-        
-        return results
+        kinds = list(kinds or COLLECTION_NAMES)
+        overfetch = overfetch or {}
+        with VECTOR_SECONDS.time(operation="embed_query"):
+            query_embedding = self.embedder.embed_query(query_text)
+        
+        futures = [
+            self._query_pool.submit(self._search_collection, kind, query_embedding, session_id,
+                                    limit * overfetch.get(kind, 1))
+            for kind in kinds
+        ]
+        
+        hits = []
+        for kind, future in zip(kinds, futures):
+            try:
+                hits.extend(future.result())
+            except Exception as e:
+                # One bad collection shouldn't cost us the rest of the context
+                logger.error(f"Vector search in {kind} failed: {str(e)}")
+        
+        hits.sort(key=lambda hit: hit.score, reverse=True)
+        return hits
+    
+    def rank_by_recency(self, session_id, hits):
+        """
+        Re-score conversation hits by similarity and recency and sort them
+        best first. The summary always counts as current; memories stored
+        before ordinals existed count as old.
+        """
+        last_seq = self.sequence_store.get_memory_seq(session_id) if self.sequence_store else 0
+        
+        for hit in hits:
+            if hit.metadata.get("role") == "summary":
+                hit.recency = 1.0
+            elif last_seq and hit.metadata.get("seq") is not None:
+                hit.recency = recency_decay(last_seq - hit.metadata["seq"], self.recency_half_life)
+            else:
+                hit.recency = 0.0
+            hit.score = (1 - self.recency_weight) * hit.score + self.recency_weight * hit.recency
+        
+        return sorted(hits, key=lambda hit: hit.score, reverse=True)
     
     def query_by_context(self, session_id, context_text, limit=5):
         """Query all collections for information relevant to the given context."""
@@ -297,109 +608,34 @@ class VectorDBManager:
             "recent_conversations": []
         }
         
-        # Query characters
-        character_results = self.character_collection.query(
-            query_texts=[context_text],
-            where={"session_id": session_id},
-            n_results=limit,
-            include=["documents", "metadatas"]
-        )
-        
-        if character_results and len(character_results.get('metadatas', [])) > 0:
-            for metadata in character_results['metadatas']:
-                if isinstance(metadata, dict) and 'data' in metadata:
-                    try:
-                        character_data = json.loads(metadata['data'])
-                        relevant_info["characters"].append(character_data)
-                    except:
-                        pass
-        
-        # Query NPCs
-        npc_results = self.npc_collection.query(
-            query_texts=[context_text],
-            where={"session_id": session_id},
-            n_results=limit,
-            include=["documents", "metadatas"]
-        )
-        
-        if npc_results and len(npc_results.get('metadatas', [])) > 0:
-            for metadata in npc_results['metadatas']:
-                if isinstance(metadata, dict) and 'data' in metadata:
-                    try:
-                        npc_data = json.loads(metadata['data'])
-                        relevant_info["npcs"].append(npc_data)
-                    except:
-                        pass
-        
-        # Query locations
-        location_results = self.location_collection.query(
-            query_texts=[context_text],
-            where={"session_id": session_id},
-            n_results=limit,
-            include=["documents", "metadatas"]
-        )
-        
-        if location_results and len(location_results.get('metadatas', [])) > 0:
-            for metadata in location_results['metadatas']:
-                if isinstance(metadata, dict) and 'data' in metadata:
-                    try:
-                        location_data = json.loads(metadata['data'])
-                        relevant_info["locations"].append(location_data)
-                    except:
-                        pass
-        
-        # Query quests
-        quest_results = self.quest_collection.query(
-            query_texts=[context_text],
-            where={"session_id": session_id},
-            n_results=limit,
-            include=["documents", "metadatas"]
-        )
-        
-        if quest_results and len(quest_results.get('metadatas', [])) > 0:
-            for metadata in quest_results['metadatas']:
-                if isinstance(metadata, dict) and 'data' in metadata:
-                    try:
-                        quest_data = json.loads(metadata['data'])
-                        relevant_info["quests"].append(quest_data)
-                    except:
-                        pass
-        
-        # Query recent conversations
-        conversation_results = self.conversation_collection.query(
-            query_texts=[context_text],
-            where={"session_id": session_id},
-            n_results=limit,
-            include=["documents", "metadatas"]
-        )
-        
-        if conversation_results and len(conversation_results.get('documents', [])) > 0:
-            for i, document in enumerate(conversation_results['documents']):
-                if i < len(conversation_results.get('metadatas', [])):
-                    metadata = conversation_results['metadatas'][i]
-                    if isinstance(metadata, dict):
-                        relevant_info["recent_conversations"].append({
-                            "content": document,
-                            "role": metadata.get("role", "unknown"),
-                            "timestamp": metadata.get("timestamp", "")
-                        })
-                    else:
-                        # Handle case where metadata is not a dictionary
-                        relevant_info["recent_conversations"].append({
-                            "content": document,
-                            "role": "unknown",
-                            "timestamp": ""
-                        })
+        hits = self.search(session_id, context_text, limit, overfetch={"conversation": self.recency_overfetch})
+        conversations = [hit for hit in hits if hit.kind == "conversation"]
+        if self.recency_weight:
+            conversations = self.rank_by_recency(session_id, conversations)
+        
+        for hit in [hit for hit in hits if hit.kind != "conversation"] + conversations[:limit]:
+            if hit.kind == "conversation":
+                relevant_info["recent_conversations"].append({
+                    "content": hit.document,
+                    "role": hit.metadata.get("role", "unknown"),
+                    "timestamp": hit.metadata.get("timestamp", ""),
+                    "score": hit.score
+                })
+            elif hit.data:
+                relevant_info[RESULT_KEYS[hit.kind]].append(hit.data)
         
         return relevant_info
     
+    @timed(VECTOR_SECONDS)
     def generate_narrative_context(self, session_id, user_message, limit=3):
         """
         Generate a narrative context for the AI by querying relevant information
         from all collections based on the user's message.
         """
-        context_results = self.query_by_context(session_id, user_message, limit)
-        
+        return self.format_narrative_context(self.query_by_context(session_id, user_message, limit))
+    
+    def format_narrative_context(self, context_results):
+        """Render query_by_context results as the context block for the prompt."""
         # Start building the context string
         context = "## Recent Context Information\n\n"
         
@@ -442,7 +678,10 @@ class VectorDBManager:
         if context_results["recent_conversations"] and len(context_results["recent_conversations"]) > 0:
             context += "\n### Recent Relevant Conversation\n"
             for conv in context_results["recent_conversations"]:
-                role = "Player" if conv.get("role") == "user" else "Game Master"
+                if conv.get("role") == "summary":
+                    role = "Story so far"
+                else:
+                    role = "Player" if conv.get("role") == "user" else "Game Master"
                 content = conv.get("content", "")
                 if content:
                     context += f"{role}: {content}\n"
@@ -0,0 +1,13 @@
+# wsgi.py
+# Production entry point:
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# With preload_app (see gunicorn.conf.py) this module is imported once in the
+# gunicorn master, which loads the embedding model before the workers fork;
+# each worker then creates its own database managers in the post_fork hook.
+# Other WSGI servers can serve wsgi:app as well: services are then created on
+# the first request of each process.
+from app import app, preload
+
+preload()